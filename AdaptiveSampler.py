@@ -0,0 +1,101 @@
+import random, time
+from typing import Callable, Tuple
+
+class AdaptiveSampler:
+    """
+    Load-adaptive admission controller for learning.
+
+    Below the rate that the learning path can sustain, every message is learned with weight 1.
+    Above it, messages are sampled with probability `ratio`, and every sampled message is learned
+    with a weight of 1 / `ratio` (stochastically rounded to an integer). The expected weight of
+    every message remains 1, so the learned distribution stays unbiased, while the number of
+    writes is reduced by a factor `ratio`.
+
+    The sustainable rate is estimated from the measured cost of learning a message,
+    i.e. `headroom` divided by the number of seconds spent per learned message, and optionally
+    capped by `rate_limit`. If the number of messages waiting to be written exceeds `max_backlog`,
+    the ratio is reduced further so the backlog can drain.
+    """
+    # Never sample less than 1 in 100 messages
+    MIN_RATIO = 0.01
+
+    def __init__(self,
+                 stats: Callable[[], Tuple[float, int, int]],
+                 rate_limit: float = 0,
+                 max_backlog: int = 1000,
+                 headroom: float = 0.8,
+                 interval: float = 5) -> None:
+        """Create an AdaptiveSampler.
+
+        Args:
+            stats (Callable[[], Tuple[float, int, int]]): Function returning the total number of seconds
+                spent learning, the total number of learned messages, and the number of messages waiting to be written.
+            rate_limit (float, optional): Maximum number of messages per second to learn. 0 for no limit. Defaults to 0.
+            max_backlog (int, optional): Backlog above which the ratio is reduced further. Defaults to 1000.
+            headroom (float, optional): Fraction of the learning capacity that may be used. Defaults to 0.8.
+            interval (float, optional): Number of seconds between updates of the ratio. Defaults to 5.
+        """
+        self.stats = stats
+        self.rate_limit = rate_limit
+        self.max_backlog = max_backlog
+        self.headroom = headroom
+        self.interval = interval
+
+        # The current sampling ratio, between MIN_RATIO and 1
+        self.ratio = 1.0
+        # Smoothed number of arriving messages per second
+        self.rate = 0.0
+        # Smoothed number of seconds spent per learned message
+        self.latency = 0.0
+        self.backlog = 0
+
+        self._arrivals = 0
+        self._interval_start = time.monotonic()
+        self._last_stats = stats()
+
+    def admit(self) -> int:
+        """Count an arriving message, and return the weight to learn it with.
+
+        Returns:
+            int: The weight to learn the message with. 0 if the message should not be learned.
+        """
+        self._arrivals += 1
+        now = time.monotonic()
+        if now - self._interval_start >= self.interval:
+            self.update(now)
+
+        if self.ratio >= 1:
+            return 1
+        if random.random() >= self.ratio:
+            return 0
+        weight = 1 / self.ratio
+        return int(weight) + (random.random() < weight - int(weight))
+
+    def update(self, now: float) -> None:
+        """Update the arrival rate, the learning latency and the sampling ratio.
+
+        Args:
+            now (float): The current time.monotonic().
+        """
+        rate = self._arrivals / (now - self._interval_start)
+        self.rate = rate if self.rate == 0 else (self.rate + rate) / 2
+        self._arrivals = 0
+        self._interval_start = now
+
+        seconds, learned, self.backlog = self.stats()
+        prev_seconds, prev_learned, _ = self._last_stats
+        self._last_stats = (seconds, learned, self.backlog)
+        if learned > prev_learned:
+            latency = (seconds - prev_seconds) / (learned - prev_learned)
+            self.latency = latency if self.latency == 0 else (self.latency + latency) / 2
+
+        capacity = float("inf")
+        if self.latency > 0:
+            capacity = self.headroom / self.latency
+        if self.rate_limit > 0:
+            capacity = min(capacity, self.rate_limit)
+
+        ratio = 1.0 if self.rate <= capacity else capacity / self.rate
+        if self.max_backlog > 0 and self.backlog > self.max_backlog:
+            ratio *= self.max_backlog / self.backlog
+        self.ratio = max(ratio, self.MIN_RATIO)
@@ -0,0 +1,372 @@
+import argparse, contextlib, json, logging, os, sqlite3, sys, time
+from collections import Counter
+from typing import Dict, Iterator, List, Optional
+
+from Database import Database, fcntl
+from Migrations import get_version, suffix
+from ModelStats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+class LiveWriterError(RuntimeError):
+    """Raised when a running bot writes to the database, and it is not safe to change it at the same time."""
+
+class Progress:
+    """Logs how far a bulk operation is, at most once every `interval` seconds, and once when it is done."""
+    def __init__(self, action: str, total: int, interval: float = 2) -> None:
+        self.action = action
+        self.total = total
+        self.interval = interval
+        self.done = 0
+        self.start = self.reported = time.perf_counter()
+
+    def update(self, amount: int = 1) -> None:
+        self.done += amount
+        if time.perf_counter() - self.reported > self.interval:
+            self.reported = time.perf_counter()
+            logger.info(f"{self.action}: {self.done} of {self.total} ({self.done / max(self.total, 1):.0%})...")
+
+    def finish(self) -> float:
+        """Log that the operation is done, and return the number of seconds it took."""
+        seconds = time.perf_counter() - self.start
+        logger.info(f"{self.action}: done in {seconds:.2f} seconds.")
+        return seconds
+
+class Admin:
+    """
+    Bulk operations on the database of a channel, opened directly instead of through the bot.
+
+    Every operation is a few set-based statements per table, on all of its input at once,
+    rather than a statement per word or message like the commands of the bot.
+
+    A running bot holds a shared lock on `MarkovChain_{channel}.lock`, see `Database.hold_writer_lock`.
+    Admin takes that lock exclusively while it changes the database, so a bot that starts in the
+    meantime waits for it. If a bot is already running, changes are only allowed with write-ahead
+    logging (the "WAL" setting), and are then committed per table rather than in one transaction,
+    so the bot is never blocked for long. The memory engine keeps its model in memory and would
+    not see any changes, so a bot using it must always be stopped first.
+    """
+    # Number of seconds to wait for a write lock held by a running bot
+    BUSY_TIMEOUT = 60
+
+    def __init__(self, channel: str) -> None:
+        self.channel = channel.replace("#", "").lower()
+        self.db_name = f"/app/db/MarkovChain_{self.channel}.db"
+        self.archive_name = None
+        # The description of the running bot that writes to the database, if any
+        self.live_writer: Optional[Dict] = None
+        self._lock_file = None
+        self.conn: Optional[sqlite3.Connection] = None
+
+    def open(self, write: bool = True) -> sqlite3.Connection:
+        """Check that the database can be used safely, and open a connection to it in autocommit mode.
+
+        Args:
+            write (bool, optional): Whether the operation changes the database, or reads it for
+                a long time. Defaults to True.
+
+        Raises:
+            FileNotFoundError: If the channel has no database.
+            LiveWriterError: If a running bot writes to the database, and it is not safe to change it at the same time.
+
+        Returns:
+            sqlite3.Connection: The connection, with the archive attached if there is one.
+        """
+        if not os.path.isfile(self.db_name):
+            raise FileNotFoundError(f"There is no database for {self.channel} at {self.db_name}.")
+        if write:
+            self.lock()
+        self.conn = sqlite3.connect(self.db_name, isolation_level=None, timeout=self.BUSY_TIMEOUT)
+        wal = self.conn.execute("PRAGMA journal_mode;").fetchone()[0].lower() == "wal"
+        if self.live_writer is not None:
+            description = f"A running bot (process {self.live_writer.get('pid')}) writes to {self.db_name}"
+            if self.live_writer.get("engine") == "MemoryDatabase":
+                self.close()
+                raise LiveWriterError(f"{description} with the memory engine, which would not see any changes. Stop the bot first.")
+            if not wal:
+                self.close()
+                raise LiveWriterError(f"{description}, and the database does not use write-ahead logging. "
+                                      "Stop the bot, or enable the \"WAL\" setting, first.")
+            logger.info(f"{description}. Committing per table, as the database uses write-ahead logging.")
+        if write and get_version(self.conn) < Database.VERSION:
+            self.close()
+            raise RuntimeError(f"{self.db_name} is outdated. Update it with `python Migrations.py {self.channel}` first.")
+        if os.path.isfile(self.db_name[:-3] + "_archive.db"):
+            self.archive_name = self.db_name[:-3] + "_archive.db"
+            self.conn.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+        return self.conn
+
+    def lock(self) -> None:
+        """Take the writer lock exclusively, or describe the running bot that holds it in `live_writer`."""
+        if fcntl is None:
+            logger.warning("A running bot cannot be detected on this platform. Make sure it is stopped.")
+            return
+        self._lock_file = open(self.db_name[:-3] + ".lock", "a+")
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            self._lock_file.seek(0)
+            try:
+                self.live_writer = json.loads(self._lock_file.read() or "{}")
+            except ValueError:
+                self.live_writer = {}
+            self._lock_file.close()
+            self._lock_file = None
+
+    def close(self) -> None:
+        """Close the connection, and release the writer lock."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+
+    @contextlib.contextmanager
+    def transaction(self, scope: str) -> Iterator[None]:
+        """A write transaction around the block, if `scope` is the unit of transactions.
+
+        That is the whole "operation", or every "table" while a running bot writes to the database.
+        """
+        if scope != ("table" if self.live_writer is not None else "operation"):
+            yield
+            return
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            yield
+        except BaseException:
+            self.conn.execute("ROLLBACK;")
+            raise
+        self.conn.execute("COMMIT;")
+
+    def tables(self) -> List[str]:
+        """Get the n-gram tables, including the archive if there is one."""
+        if ModelStats.trie_tables(self.conn) and self.conn.execute("SELECT 1 FROM TrieNode LIMIT 1;").fetchone():
+            logger.warning(f"The trie of {self.channel} is not changed. Only the 3-grams learned with a KeyLength of 2 are.")
+        return ModelStats.tables(self.conn)
+
+    def purge(self, words: List[str]) -> Dict[str, float]:
+        """Delete every n-gram that contains any of `words`, case insensitively, like `!purge` does for one word.
+
+        Returns:
+            Dict[str, float]: The number of deleted n-grams, and the number of seconds taken.
+        """
+        self.conn.execute("CREATE TEMP TABLE AdminWords (word TEXT PRIMARY KEY) WITHOUT ROWID;")
+        self.conn.executemany("INSERT OR IGNORE INTO temp.AdminWords (word) VALUES (?);", [(word.strip(),) for word in words])
+        tables = self.tables()
+        progress = Progress(f"Purging {len(words)} words from {self.channel}", len(tables))
+        deleted = 0
+        with self.transaction("operation"):
+            for table in tables:
+                columns = ("word1", "word2") if table.startswith("MarkovStart") else ("word1", "word2", "word3")
+                where = " OR ".join(f"{column} IN (SELECT word FROM temp.AdminWords)" for column in columns)
+                with self.transaction("table"):
+                    cur = self.conn.cursor()
+                    stats = ModelStats()
+                    stats.delete(cur, table, where)
+                    deleted += cur.execute(f"DELETE FROM {table} WHERE {where};").rowcount
+                    stats.write(cur)
+                progress.update()
+        self.conn.execute("DROP TABLE temp.AdminWords;")
+        return {"deleted": deleted, "seconds": progress.finish()}
+
+    def unlearn(self, messages: List[str]) -> Dict[str, float]:
+        """Unlearn `messages` like deleted chat messages are, reducing the count of each of their
+        n-grams by 5 for every time it occurs in them, and deleting n-grams whose count drops to 0.
+
+        Returns:
+            Dict[str, float]: The number of changed and deleted n-grams, and the number of seconds taken.
+        """
+        starts: Counter = Counter()
+        grammar: Counter = Counter()
+        for message in messages:
+            words = message.split(" ")
+            if len(words) > 1:
+                starts[(f"MarkovStart{suffix(words[0][0])}", words[0], words[1])] += 1
+            for word1, word2, word3 in zip(words, words[1:], words[2:]):
+                grammar[(f"MarkovGrammar{suffix(word1[0])}{suffix(word2[0])}", word1, word2, word3)] += 1
+        self.conn.execute("CREATE TEMP TABLE AdminStarts (tbl TEXT, word1 TEXT, word2 TEXT, times INTEGER);")
+        self.conn.execute("CREATE TEMP TABLE AdminGrammar (tbl TEXT, word1 TEXT, word2 TEXT, word3 TEXT, times INTEGER);")
+        self.conn.executemany("INSERT INTO temp.AdminStarts VALUES (?, ?, ?, ?);", [(*key, times) for key, times in starts.items()])
+        self.conn.executemany("INSERT INTO temp.AdminGrammar VALUES (?, ?, ?, ?, ?);", [(*key, times) for key, times in grammar.items()])
+
+        # Only the tables that the messages were learned in, and the archive, which holds 3-grams of every table
+        tables = sorted({key[0] for key in starts} | {key[0] for key in grammar})
+        if self.archive_name and grammar:
+            tables.append("archive.MarkovGrammar")
+        progress = Progress(f"Unlearning {len(messages)} messages from {self.channel}", len(tables))
+        changed = deleted = 0
+        with self.transaction("operation"):
+            for table in tables:
+                source, columns = ("AdminStarts", "word1, word2") if table.startswith("MarkovStart") else ("AdminGrammar", "word1, word2, word3")
+                # The archive is not split up by first characters
+                where = "1" if table.startswith("archive.") else "tbl = ?"
+                values = () if table.startswith("archive.") else (table,)
+                with self.transaction("table"):
+                    cur = self.conn.cursor()
+                    stats = ModelStats()
+                    for times, in cur.execute(f"SELECT DISTINCT times FROM temp.{source} WHERE {where};", values).fetchall():
+                        rows = f"({columns}) IN (SELECT {columns} FROM temp.{source} WHERE {where} AND times = ?)"
+                        stats.change(cur, table, rows, (*values, times), -5 * times * stats.scale(cur))
+                        changed += cur.execute(f"UPDATE {table} SET count = count - ? * (SELECT scale FROM main.Decay) WHERE {rows};",
+                                               (5 * times, *values, times)).rowcount
+                    rows = f"({columns}) IN (SELECT {columns} FROM temp.{source} WHERE {where}) AND count <= 0"
+                    stats.delete(cur, table, rows, values)
+                    deleted += cur.execute(f"DELETE FROM {table} WHERE {rows};", values).rowcount
+                    stats.write(cur)
+                progress.update()
+        self.conn.execute("DROP TABLE temp.AdminStarts;")
+        self.conn.execute("DROP TABLE temp.AdminGrammar;")
+        return {"changed": changed, "deleted": deleted, "seconds": progress.finish()}
+
+    def whisper_ignore(self, users: List[str], remove: bool = False) -> Dict[str, float]:
+        """Add `users` to the WhisperIgnore table, so the bot never whispers them, or remove them from it.
+
+        Returns:
+            Dict[str, float]: The number of added or removed users, and the number of seconds taken.
+        """
+        progress = Progress(f"{'Removing' if remove else 'Adding'} {len(users)} users {'from' if remove else 'to'} WhisperIgnore", 1)
+        with self.transaction("operation"), self.transaction("table"):
+            # Twitch sends usernames in lowercase
+            values = [(user.strip().lower(),) for user in users]
+            if remove:
+                changed = self.conn.executemany("DELETE FROM WhisperIgnore WHERE username = ?;", values).rowcount
+            else:
+                changed = self.conn.executemany("INSERT OR IGNORE INTO WhisperIgnore (username) VALUES (?);", values).rowcount
+        progress.update()
+        return {"users": changed, "seconds": progress.finish()}
+
+    def stats(self) -> Dict[str, float]:
+        """Get the model statistics, along with the size of the database files and the number of ignored users."""
+        scale = self.conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+        summary = ModelStats.summary(ModelStats.read(self.conn), scale)
+        summary["bytes"] = sum(os.path.getsize(name) for name in (self.db_name, self.archive_name) if name)
+        summary["whisper_ignore"] = self.conn.execute("SELECT count(*) FROM WhisperIgnore;").fetchone()[0]
+        summary["version"] = get_version(self.conn)
+        return summary
+
+    def compact(self, threshold: float, vacuum: bool = True) -> Dict[str, float]:
+        """Delete every n-gram with an effective count below `threshold` at once, and vacuum the database files.
+
+        Only vacuums while no bot is running, as it rewrites the whole file. Afterwards, the files
+        use incremental vacuum, so that the maintenance task of the bot can shrink them from then on.
+
+        Returns:
+            Dict[str, float]: The number of deleted n-grams, the number of reclaimed bytes, and the number of seconds taken.
+        """
+        start = time.perf_counter()
+        size_before = sum(os.path.getsize(name) for name in (self.db_name, self.archive_name) if name)
+        cutoff = threshold * self.conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+        tables = self.tables()
+        progress = Progress(f"Pruning n-grams with a count below {threshold:g} from {self.channel}", len(tables))
+        deleted = 0
+        with self.transaction("operation"):
+            for table in tables:
+                with self.transaction("table"):
+                    cur = self.conn.cursor()
+                    stats = ModelStats()
+                    stats.delete(cur, table, "count < ?", (cutoff,))
+                    deleted += cur.execute(f"DELETE FROM {table} WHERE count < ?;", (cutoff,)).rowcount
+                    stats.write(cur)
+                progress.update()
+        progress.finish()
+        if vacuum and self.live_writer is None:
+            for schema in ["main", "archive"] if self.archive_name else ["main"]:
+                logger.info(f"Vacuuming the {schema} database of {self.channel}...")
+                self.conn.execute(f"PRAGMA {schema}.auto_vacuum = INCREMENTAL;")
+                self.conn.execute(f"VACUUM {schema};")
+        elif vacuum:
+            logger.info("Not vacuuming while the bot is running. Its maintenance task returns freed pages to the filesystem over time.")
+        size_after = sum(os.path.getsize(name) for name in (self.db_name, self.archive_name) if name)
+        return {"deleted": deleted, "reclaimed": size_before - size_after, "seconds": time.perf_counter() - start}
+
+    def check(self, quick: bool = False) -> List[str]:
+        """Check the integrity of the database files, and whether the model statistics match the tables.
+
+        Args:
+            quick (bool, optional): Use `PRAGMA quick_check`, which skips checking that indexes match their tables. Defaults to False.
+
+        Returns:
+            List[str]: The problems that were found, empty if there are none.
+        """
+        problems = []
+        for schema in ["main", "archive"] if self.archive_name else ["main"]:
+            logger.info(f"Checking the integrity of the {schema} database of {self.channel}...")
+            results = [row[0] for row in self.conn.execute(f"PRAGMA {schema}.{'quick_check' if quick else 'integrity_check'};")]
+            problems += [f"{schema}: {result}" for result in results if result != "ok"]
+
+        stats = ModelStats.read(self.conn)
+        tables = ModelStats.tables(self.conn) + ModelStats.trie_tables(self.conn)
+        progress = Progress(f"Comparing the model statistics of {self.channel} to its tables", len(tables))
+        for table in tables:
+            rows = self.conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0]
+            if rows != stats.get(table, (0, 0))[0]:
+                problems.append(f"ModelStats has {stats.get(table, (0, 0))[0]} rows for {table}, which has {rows} rows. "
+                                f"Fix this with `python ModelStats.py {self.channel} --rebuild`.")
+            progress.update()
+        progress.finish()
+        return problems
+
+def read_lines(path: str) -> List[str]:
+    """Read the non-empty lines of `path`, or of standard input if it is "-"."""
+    f = sys.stdin if path == "-" else open(path, "r", encoding="utf-8")
+    try:
+        return [line.rstrip("\r\n") for line in f if line.strip()]
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Bulk operations on the database of a channel, without the bot.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    purge = commands.add_parser("purge", help="Delete every n-gram with any of the words in a file, one per line.")
+    unlearn = commands.add_parser("unlearn", help="Unlearn the messages in a file, one per line, like deleted messages are.")
+    ignore = commands.add_parser("whisper-ignore", help="Never whisper the users in a file, one per line.")
+    ignore.add_argument("--remove", action="store_true", help="Whisper the users again instead.")
+    for command in (purge, unlearn, ignore):
+        command.add_argument("channel")
+        command.add_argument("file", help="The input file, or - for standard input.")
+    commands.add_parser("stats", help="Show the model statistics.").add_argument("channel")
+    compact = commands.add_parser("compact", help="Delete rare n-grams and vacuum the database.")
+    compact.add_argument("channel")
+    compact.add_argument("--threshold", type=float, default=1, help="The effective count below which n-grams are deleted. Defaults to 1.")
+    compact.add_argument("--no-vacuum", action="store_true", help="Do not rewrite the database files afterwards.")
+    check = commands.add_parser("check", help="Check the integrity of the database and of the model statistics.")
+    check.add_argument("channel")
+    check.add_argument("--quick", action="store_true", help="Use the faster quick_check.")
+    args = parser.parse_args()
+
+    admin = Admin(args.channel)
+    try:
+        admin.open(write=args.command != "stats")
+        if args.command == "purge":
+            result = admin.purge(read_lines(args.file))
+        elif args.command == "unlearn":
+            result = admin.unlearn(read_lines(args.file))
+        elif args.command == "whisper-ignore":
+            result = admin.whisper_ignore(read_lines(args.file), remove=args.remove)
+        elif args.command == "stats":
+            result = admin.stats()
+        elif args.command == "compact":
+            result = admin.compact(args.threshold, vacuum=not args.no_vacuum)
+        else:
+            problems = admin.check(quick=args.quick)
+            for problem in problems:
+                print(problem)
+            print(f"Found {len(problems)} problems.")
+            return 1 if problems else 0
+    except (FileNotFoundError, RuntimeError) as error:
+        logger.error(error)
+        return 1
+    finally:
+        admin.close()
+    for name, value in result.items():
+        print(f"{name:<16} {value:>16.6g}" if isinstance(value, float) else f"{name:<16} {value:>16}")
+    return 0
+
+if __name__ == "__main__":
+    # Change the database of a channel in bulk, e.g. while the bot is stopped.
+    # Usage: python Admin.py purge|unlearn|whisper-ignore <channel> <file>
+    #        python Admin.py stats|compact|check <channel>
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    sys.exit(main())
@@ -0,0 +1,164 @@
+import logging, re, threading
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from TwitchWebsocket import Message
+
+from ChannelState import ChannelState
+from Metrics import MESSAGES_FILTERED, MESSAGES_ADMITTED
+from Tokenizer import tokenize
+
+logger = logging.getLogger(__name__)
+
+# A check gets the message and the state of its channel, and returns the reason to reject
+# the message, or None to pass it on to the next stage
+Check = Callable[[Message, ChannelState], Optional[str]]
+
+class Stage(NamedTuple):
+    """
+    A single step of the AdmissionPipeline.
+
+    Stages between two barriers may be reordered by their `cost`, so they must not depend on
+    each other. Stages that have side effects, or that change the message, are barriers, which
+    always run at the position they were added at.
+    """
+    name: str
+    check: Check
+    cost: int = 1
+    barrier: bool = False
+
+class AdmissionPipeline:
+    """
+    Decides whether a chat message is learned, by running it through a list of stages until
+    one of them rejects it.
+
+    Stages run cheapest first between barriers, see `Stage`. Rejections are counted per
+    channel and reason, both for the maintenance task and in the "markov_messages_filtered_total" metric.
+    """
+    def __init__(self, stages: Iterable[Stage] = ()) -> None:
+        self._added: List[Stage] = []
+        self.stages: List[Stage] = []
+        self._lock = threading.Lock()
+        # The number of rejected messages per channel and reason since the last `pop_rejections`
+        self.rejections: Dict[Tuple[str, str], int] = {}
+        for stage in stages:
+            self.add(stage)
+
+    def add(self, stage: Stage, before: Optional[str] = None) -> None:
+        """Add a stage, at the end or before the stage named `before`, and reorder the stages.
+
+        Args:
+            stage (Stage): The stage to add.
+            before (Optional[str], optional): The name of the stage to insert it before. Defaults to None, i.e. at the end.
+        """
+        index = len(self._added)
+        if before is not None:
+            index = next(i for i, added in enumerate(self._added) if added.name == before)
+        self._added.insert(index, stage)
+        self.stages = self.order(self._added)
+
+    @staticmethod
+    def order(stages: List[Stage]) -> List[Stage]:
+        """Sort every run of stages between barriers by cost, keeping the barriers in place.
+
+        Args:
+            stages (List[Stage]): The stages in the order they were added.
+
+        Returns:
+            List[Stage]: The stages in the order they are run.
+        """
+        ordered = []
+        segment = []
+        for stage in stages:
+            if stage.barrier:
+                ordered += sorted(segment, key=lambda s: s.cost)
+                ordered.append(stage)
+                segment = []
+            else:
+                segment.append(stage)
+        return ordered + sorted(segment, key=lambda s: s.cost)
+
+    def admit(self, m: Message, state: ChannelState) -> Optional[str]:
+        """Run `m` through the stages.
+
+        Args:
+            m (Message): The PRIVMSG to check. Stages may change `m.message`, e.g. to strip emotes.
+            state (ChannelState): The state of the channel `m` was sent in.
+
+        Returns:
+            Optional[str]: The reason the message was rejected, or None if it should be learned.
+        """
+        for stage in self.stages:
+            reason = stage.check(m, state)
+            if reason is not None:
+                MESSAGES_FILTERED.inc(labels=(state.name, reason))
+                with self._lock:
+                    self.rejections[(state.name, reason)] = self.rejections.get((state.name, reason), 0) + 1
+                return reason
+        MESSAGES_ADMITTED.inc(labels=(state.name,))
+        return None
+
+    def pop_rejections(self, channel: str) -> Dict[str, int]:
+        """Get and reset the number of rejected messages per reason of `channel`."""
+        with self._lock:
+            keys = [key for key in self.rejections if key[0] == channel]
+            return {key[1]: self.rejections.pop(key) for key in keys}
+
+def denied_users(users: Iterable[str]) -> Stage:
+    """Reject messages from `users`, e.g. other bots, compared in lowercase."""
+    denied = frozenset(user.lower() for user in users)
+    return Stage("denied_user", lambda m, state: "denied_user" if m.user.lower() in denied else None, cost=0)
+
+# Commands are anything starting with "!", "/" or ".", except for "/me".
+# Links should be detected in roughly the same way as Twitch does.
+COMMAND_OR_LINK_REGEX = re.compile(r"(?P<command>\A(?:[!.]|/(?!me)))|(?P<link>\w+\.[a-z]{2,})")
+
+def commands_and_links() -> Stage:
+    """Reject commands and messages with links, with a single search of one regex."""
+    def check(m: Message, state: ChannelState) -> Optional[str]:
+        match = COMMAND_OR_LINK_REGEX.search(m.message)
+        # A command matches at the start, so it is found before any link
+        return match.lastgroup if match else None
+    return Stage("command", check, cost=1)
+
+def parse_badges(tag: str) -> frozenset:
+    """Get the badge names from the "badges" tag, e.g. {"subscriber", "bits"} from "subscriber/12,bits/100"."""
+    return frozenset(badge.split("/", 1)[0] for badge in tag.split(",") if badge)
+
+def badges(allowed: Iterable[str]) -> Stage:
+    """Reject messages from users without any of the `allowed` badges."""
+    allowed = frozenset(allowed)
+    return Stage("badges", lambda m, state: None if not allowed.isdisjoint(parse_badges(m.tags.get("badges", ""))) else "badges", cost=1)
+
+def strip_emotes(emote_prefix: str, modifiers: Tuple[str, ...] = ("_BW", "_HF", "_SG", "_SQ", "_TK")) -> Stage:
+    """Remove the emotes that do not start with `emote_prefix` from the message, or all of them if it is "NA".
+
+    Emotes with a modifier, e.g. "cubieHi_BW", are always removed. Never rejects a message.
+    """
+    def check(m: Message, state: ChannelState) -> Optional[str]:
+        emotes = m.tags.get("emotes", "")
+        if not emotes:
+            return None
+        # e.g. "25:0-4,12-16/1902:6-10", the positions of the first occurrence are enough to get the name
+        names = []
+        for emote in emotes.split("/"):
+            start, end = emote.split(":")[1].split(",")[0].split("-")
+            names.append(m.message[int(start):int(end) + 1])
+        for name in names:
+            if emote_prefix == "NA" or not name.startswith(emote_prefix) or name[-3:] in modifiers:
+                m.message = m.message.replace(name, "")
+        return None
+    return Stage("emotes", check, barrier=True)
+
+def blacklist() -> Stage:
+    """Reject messages containing a banned word of the channel. Tokenizes the message, so it is expensive."""
+    def check(m: Message, state: ChannelState) -> Optional[str]:
+        banned = state.banned_words
+        if any(word.lower() in banned for word in tokenize(m.message)):
+            logger.warning(f"Sentence contained blacklisted word or phrase:\"{m.message}\"")
+            return "blacklist"
+        return None
+    return Stage("blacklist", check, cost=10)
+
+def duplicates() -> Stage:
+    """Reject messages repeated too often recently, e.g. copypasta. Counts every message it sees."""
+    return Stage("duplicate", lambda m, state: None if state.duplicate_filter.admit(m.message) else "duplicate", barrier=True)
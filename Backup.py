@@ -0,0 +1,167 @@
+import gzip, logging, os, shutil, sqlite3, sys, threading, time
+from datetime import datetime
+from typing import Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class BackupRestarted(Exception):
+    """Raised from the progress callback to abort a backup that keeps restarting."""
+
+class Backup:
+    """
+    Creates snapshots of a channel database with SQLite's online backup API, while the bot keeps running.
+
+    Snapshots are written to `directory` as `MarkovChain_{channel}_{timestamp}.db`, or `.db.gz` when
+    compressed, along with the archive of `Database.enable_archive` if there is one. Only the newest
+    `keep` snapshots are kept.
+
+    Pages are copied in small steps with a short sleep in between, so learning transactions can
+    run between the steps. In WAL mode, the snapshot is pinned with a read transaction, which never
+    blocks writers, so the copy is consistent and learning is not slowed down at all.
+
+    With the default rollback journal, every write by the bot restarts the copy. After a restart,
+    copying waits for an exponentially growing pause, hoping for a quiet moment in chat. If it keeps
+    getting restarted, the snapshot is given up rather than copied in a single step, which would keep
+    writers waiting for as long as copying the file takes.
+    """
+    # Number of pages to copy per step
+    PAGES = 1024
+    # Seconds to sleep between steps
+    SLEEP = 0.005
+    # Seconds to pause after the first restart, doubled after every further restart
+    RESTART_BACKOFF = 1
+    # Number of restarts after which the snapshot is given up
+    MAX_RESTARTS = 8
+
+    def __init__(self, db_name: str, directory: str = "/app/db/backups", keep: int = 7, compress: bool = True) -> None:
+        """Create a Backup of `db_name`.
+
+        Args:
+            db_name (str): The path of the database file, e.g. "/app/db/MarkovChain_cubiedev.db".
+            directory (str, optional): The directory to store the snapshots in. Defaults to "/app/db/backups".
+            keep (int, optional): The number of snapshots to keep. Defaults to 7.
+            compress (bool, optional): Whether to gzip the snapshots. Defaults to True.
+        """
+        self.db_name = db_name
+        self.directory = directory
+        self.keep = keep
+        self.compress = compress
+        self._lock = threading.Lock()
+        # Time of the last snapshot, so restarting the bot does not trigger a new one
+        snapshots = self.snapshots(os.path.basename(db_name)[:-3]) if os.path.isdir(directory) else []
+        self.last_run = os.path.getmtime(snapshots[-1]) if snapshots else 0.0
+
+    @property
+    def running(self) -> bool:
+        """Whether a snapshot is being created right now."""
+        return self._lock.locked()
+
+    def start(self) -> bool:
+        """Create a snapshot in a background thread, unless one is being created already.
+
+        Returns:
+            bool: Whether a new snapshot was started.
+        """
+        if self.running:
+            return False
+        threading.Thread(target=self.run, daemon=True).start()
+        return True
+
+    def run(self) -> Optional[Dict[str, float]]:
+        """Create a snapshot of the database and its archive, and remove old snapshots.
+
+        Returns:
+            Optional[Dict[str, float]]: The number of bytes copied and written, and the number of seconds taken.
+                None if a snapshot is being created already, or if it was given up because writes kept restarting it.
+        """
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            self.last_run = time.time()
+            os.makedirs(self.directory, exist_ok=True)
+            timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+            start = time.perf_counter()
+            copied = written = 0
+            sources = [self.db_name]
+            if os.path.isfile(self.db_name[:-3] + "_archive.db"):
+                sources.append(self.db_name[:-3] + "_archive.db")
+            for source in sources:
+                target = os.path.join(self.directory, f"{os.path.basename(source)[:-3]}_{timestamp}.db")
+                try:
+                    copied += self._copy(source, target + ".tmp")
+                except BackupRestarted:
+                    os.remove(target + ".tmp")
+                    logger.warning(f"Gave up backing up {os.path.basename(source)}, as new writes restarted it {self.MAX_RESTARTS} times. "
+                                   "Enable the \"WAL\" setting to create backups without restarts.")
+                    return None
+                if self.compress:
+                    with open(target + ".tmp", "rb") as f_in, gzip.open(target + ".gz.tmp", "wb", compresslevel=6) as f_out:
+                        shutil.copyfileobj(f_in, f_out, 2 ** 20)
+                    os.remove(target + ".tmp")
+                    target += ".gz"
+                os.replace(target + ".tmp", target)
+                written += os.path.getsize(target)
+                self._rotate(os.path.basename(source)[:-3])
+
+            seconds = time.perf_counter() - start
+            logger.info(f"Backed up {copied / 2 ** 20:.1f}MB of {os.path.basename(self.db_name)} into {written / 2 ** 20:.1f}MB "
+                        f"in {seconds:.2f} seconds ({copied / 2 ** 20 / max(seconds, 1e-9):.1f}MB/s).")
+            return {"copied": copied, "written": written, "seconds": seconds}
+        finally:
+            self._lock.release()
+
+    def _copy(self, source: str, target: str) -> int:
+        """Copy `source` to `target` with the backup API, and return the number of bytes copied.
+
+        Raises:
+            BackupRestarted: If writes restarted the copy `MAX_RESTARTS` times.
+        """
+        src = sqlite3.connect(source, isolation_level=None)
+        dst = sqlite3.connect(target)
+        try:
+            wal = src.execute("PRAGMA journal_mode;").fetchone()[0].lower() == "wal"
+            if wal:
+                # Pin the current snapshot, so writes by the bot do not restart the copy
+                src.execute("BEGIN;")
+                src.execute("SELECT 1 FROM sqlite_master LIMIT 1;").fetchall()
+
+            steps = {"last": 0, "restarts": 0, "reported": time.perf_counter()}
+            def progress(status: int, remaining: int, total: int) -> None:
+                if total - remaining < steps["last"]:
+                    steps["restarts"] += 1
+                    if steps["restarts"] >= self.MAX_RESTARTS:
+                        raise BackupRestarted()
+                    # Give the writes time to finish, without holding any lock
+                    time.sleep(self.RESTART_BACKOFF * 2 ** (steps["restarts"] - 1))
+                steps["last"] = total - remaining
+                if time.perf_counter() - steps["reported"] > 10:
+                    steps["reported"] = time.perf_counter()
+                    logger.info(f"Backing up {os.path.basename(source)}: copied {total - remaining} of {total} pages...")
+
+            src.backup(dst, pages=self.PAGES, progress=progress, sleep=self.SLEEP)
+            if wal:
+                src.execute("COMMIT;")
+            return dst.execute("PRAGMA page_count;").fetchone()[0] * dst.execute("PRAGMA page_size;").fetchone()[0]
+        finally:
+            src.close()
+            dst.close()
+
+    def snapshots(self, prefix: str) -> List[str]:
+        """Get the paths of all snapshots of the file `{prefix}.db`, oldest first."""
+        names = [name for name in os.listdir(self.directory)
+                 if name.startswith(prefix + "_") and name.endswith((".db", ".db.gz"))
+                 and name[len(prefix) + 1:].split(".")[0].replace("-", "").isdigit()]
+        return [os.path.join(self.directory, name) for name in sorted(names)]
+
+    def _rotate(self, prefix: str) -> None:
+        """Remove all but the newest `keep` snapshots of the file `{prefix}.db`."""
+        for path in self.snapshots(prefix)[:-self.keep] if self.keep > 0 else []:
+            os.remove(path)
+            logger.debug(f"Removed old backup {path}.")
+
+if __name__ == "__main__":
+    # Create a snapshot of the database of a channel, e.g. from a cron job.
+    # Usage: python Backup.py <channel> [number of snapshots to keep]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    keep = int(sys.argv[2]) if len(sys.argv) > 2 else 7
+    Backup(f"/app/db/MarkovChain_{sys.argv[1].replace('#', '').lower()}.db", keep=keep).run()
@@ -0,0 +1,209 @@
+import logging, os, threading, time
+from typing import Dict, List, Union
+
+from Backup import Backup
+from Compaction import Compactor
+from CompiledModel import CompiledModel
+from Database import Database
+from DuplicateFilter import DuplicateFilter
+from MemoryDatabase import MemoryDatabase
+from Settings import SettingsData
+from TrieDatabase import TrieDatabase
+from WarmCache import WarmCache
+
+logger = logging.getLogger(__name__)
+
+class ChannelState:
+    """
+    Everything the bot tracks for a single joined channel: its Database,
+    blacklist, moderator list and the learning/generation counters.
+
+    Anything that can be shared between channels (the connection, the tokenizer,
+    the settings) lives on the MarkovChain instance instead, so that every additional
+    channel only costs a Database handle and a handful of counters.
+    """
+    def __init__(self, channel: str, settings: SettingsData):
+        # Channel name without "#", in lowercase, e.g. "cubiedev"
+        self.name = channel.replace("#", "").lower()
+        # The number of words used as a key when learning and generating
+        self.key_length = self.get_key_length(settings["KeyLength"])
+        if self.key_length != 2:
+            if settings["Engine"] == "memory" or settings["CompiledModel"]:
+                logger.warning(f"[#{self.name}] The \"Engine\" and \"CompiledModel\" settings are ignored for a \"KeyLength\" other than 2.")
+            self.db = TrieDatabase(self.name, self.key_length)
+        elif settings["Engine"] == "memory":
+            self.db = MemoryDatabase(self.name, settings["SnapshotInterval"])
+        else:
+            self.db = Database(self.name)
+        # Lets Admin.py know that the bot writes to this database
+        self.db.hold_writer_lock()
+        # Optionally move rarely used 3-grams to a separate archive database in the maintenance task
+        self.use_archive = settings["Archive"] and not isinstance(self.db, MemoryDatabase)
+        self.archive_threshold = settings["ArchiveThreshold"]
+        self.archive_time_budget = settings["CompactionTimeBudget"]
+        if self.use_archive:
+            self.db.enable_archive()
+        elif settings["Archive"]:
+            logger.warning(f"[#{self.name}] The \"Archive\" setting is ignored with the memory engine, which keeps everything in memory.")
+        self.db.set_wal(settings["WAL"])
+        # Optionally cache the hottest lookups, which are prefetched in the background after a restart
+        if settings["WarmCacheSize"] > 0 and type(self.db) is Database and not settings["CompiledModel"]:
+            # The learning worker writes from another process, so what it learns is only seen once entries expire
+            self.db.warm_cache = WarmCache(self.db, int(settings["WarmCacheSize"] * 2 ** 20),
+                                           max_age=60 if settings["LearningWorker"] else 300)
+            self.db.warm_cache.prefetch()
+        # Optionally time every statement, which can also be toggled with !trace
+        self.db.tracer.enabled = settings["QueryTracing"]
+        self.db.tracer.threshold = settings["SlowQueryThreshold"] / 1000
+        # Snapshots of the Database, created every `backup_interval` hours by the maintenance task, or with !backup
+        self.backup = Backup(self.db.db_name, keep=settings["BackupKeep"], compress=settings["BackupCompress"])
+        self.backup_interval = settings["BackupInterval"]
+        # Decays and prunes the Database in the maintenance task
+        self.compactor = Compactor(self.db,
+                                   settings["DecayHalfLife"],
+                                   settings["PruneThreshold"],
+                                   settings["CompactionTimeBudget"],
+                                   settings["MaxDatabaseSize"])
+        # Counts are only ever renormalized now, before anything is learned
+        self.compactor.renormalize()
+        # Admission stage that stops learning the same message over and over
+        self.duplicate_filter = DuplicateFilter(settings["DuplicateThreshold"],
+                                                settings["DuplicateWindow"],
+                                                settings["DuplicateMode"])
+        # List of moderators used in blacklist modification, includes broadcaster
+        self.mod_list = []
+        self.learning_counter = 0
+        self.generator_counter = 0
+        self.awake = False
+        self.learning = False
+        self.learning_individuals = []
+        self.learning_average = 0
+        self.learning_average_peak = 0
+        self.set_blacklist()
+
+        # Optional read-only model used for generation, recompiled in the background by the maintenance task
+        self.use_compiled_model = settings["CompiledModel"] and self.key_length == 2
+        self.compile_interval = settings["CompileInterval"]
+        self.compiled_model = None
+        # The model statistics the model was compiled from, and the time of the last compilation
+        self.compiled_stats = None
+        self.compiled_at = 0.0
+        self._compile_lock = threading.Lock()
+        if self.use_compiled_model:
+            if os.path.isfile(CompiledModel.path_for(self.name)):
+                self.compiled_model = CompiledModel(CompiledModel.path_for(self.name))
+                self.compiled_at = os.path.getmtime(CompiledModel.path_for(self.name))
+            else:
+                self.compile_model()
+
+    def get_key_length(self, key_length: Union[int, Dict[str, int]]) -> int:
+        """Get the key length of this channel from the "KeyLength" setting.
+
+        Args:
+            key_length (Union[int, Dict[str, int]]): Either one key length for all channels,
+                or a dict mapping channel names to key lengths. Channels that are missing use 2.
+
+        Returns:
+            int: The key length of this channel, between 2 and 5.
+        """
+        if isinstance(key_length, dict):
+            key_length = {channel.replace("#", "").lower(): value for channel, value in key_length.items()}.get(self.name, 2)
+        if not 2 <= key_length <= 5:
+            logger.warning(f"[#{self.name}] \"KeyLength\" must be between 2 and 5, but is {key_length}. Using 2 instead.")
+            return 2
+        return key_length
+
+    @property
+    def model(self) -> Union[CompiledModel, Database]:
+        """The source to generate sentences from.
+
+        The compiled model if it is enabled, reopened if it was recompiled by another process,
+        and the Database otherwise.
+        """
+        if self.compiled_model is not None and self.compiled_model.is_stale():
+            self.compiled_model = CompiledModel(self.compiled_model.path)
+        return self.compiled_model or self.db
+
+    def start_compile(self) -> bool:
+        """Recompile the model in a background thread, if `compile_interval` minutes passed since the
+        last compilation, and the model is not being compiled already.
+
+        Returns:
+            bool: Whether a compilation was started.
+        """
+        if self._compile_lock.locked() or time.time() - self.compiled_at < self.compile_interval * 60:
+            return False
+        threading.Thread(target=self.compile_model, name=f"Compile-{self.name}", daemon=True).start()
+        return True
+
+    def compile_model(self) -> None:
+        """Compile the Database into a new model file, and start generating from it.
+
+        Skipped if the model statistics did not change since the previous compilation,
+        i.e. nothing was learned, unlearned or pruned in the meantime.
+        """
+        if not self._compile_lock.acquire(blocking=False):
+            return
+        try:
+            self.compiled_at = time.time()
+            # Make sure everything learned so far is in the database file
+            self.db.flush()
+            model_stats = self.db.model_stats()
+            if self.compiled_model is not None and model_stats == self.compiled_stats:
+                logger.debug(f"[#{self.name}] Not recompiling the model, as nothing changed.")
+                return
+            try:
+                stats = CompiledModel.compile(self.name)
+            except Exception:
+                logger.exception(f"[#{self.name}] Failed to compile the model.")
+                return
+            logger.info(f"[#{self.name}] Compiled {stats['ngrams']} n-grams into a {stats['bytes'] / 2 ** 20:.1f}MB model in {stats['seconds']:.2f} seconds.")
+            self.compiled_stats = model_stats
+            self.compiled_model = CompiledModel(CompiledModel.path_for(self.name))
+        finally:
+            self._compile_lock.release()
+
+    @property
+    def blacklist_file(self) -> str:
+        """The blacklist file for this channel.
+
+        Uses `blacklist_{channel}.txt` if it exists, and the shared `blacklist.txt` otherwise.
+        """
+        channel_file = f"blacklist_{self.name}.txt"
+        if os.path.isfile(channel_file):
+            return channel_file
+        return "blacklist.txt"
+
+    def write_blacklist(self, blacklist: List[str]) -> None:
+        """Write the blacklist file given a list of banned words.
+
+        Args:
+            blacklist (List[str]): The list of banned words to write.
+        """
+        logger.debug("Writing Blacklist...")
+        with open(self.blacklist_file, "w") as f:
+            f.write("\n".join(sorted(blacklist, key=lambda x: len(x), reverse=True)))
+        logger.debug("Written Blacklist.")
+
+    def set_blacklist(self) -> None:
+        """Read the blacklist file and set `self.blacklist` to the list of banned words, and `self.banned_words` to their set."""
+        logger.debug("Loading Blacklist...")
+        try:
+            with open(self.blacklist_file, "r") as f:
+                self.blacklist = [l.replace("\n", "") for l in f.readlines()]
+                logger.debug("Loaded Blacklist.")
+
+        except FileNotFoundError:
+            logger.warning("Loading Blacklist Failed!")
+            self.blacklist = ["<start>", "<end>"]
+            self.write_blacklist(self.blacklist)
+        self.banned_words = frozenset(self.blacklist)
+
+    def reset_activity(self) -> None:
+        """Disable learning and generation, and clear the activity counters."""
+        self.awake = False
+        self.generator_counter = 0
+        self.learning = False
+        self.learning_average_peak = 0
+        self.learning_average = 0
+        self.learning_individuals.clear()
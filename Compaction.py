@@ -0,0 +1,220 @@
+import logging, os, sqlite3, time
+from typing import Dict, List, Optional, Tuple
+
+from Database import Database
+from ModelStats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+class Compactor:
+    """
+    Keeps the size of a Database bounded by decaying old counts and pruning rare n-grams.
+
+    Decay is applied lazily. Rather than multiplying every count by a decay factor, the `scale`
+    in the Decay table grows by a factor 2 every `half_life` days, and every newly learned weight
+    is multiplied by `scale` when it is written. Sampling only compares counts with each other,
+    so this is equivalent to halving all older counts every `half_life` days, while only ever
+    updating a single row. The effective count of an n-gram is its stored count divided by `scale`.
+    When `scale` becomes very large, all stored counts are divided by it once, and it is reset to 1.
+    That rewrites every table, so it is done by `renormalize` when the bot starts, before it learns
+    anything, rather than while it is running. Floats have plenty of room left beyond `MAX_SCALE`.
+
+    Every run, n-grams with an effective count below `threshold` are deleted in small chunks,
+    table by table, until the time budget of the run is used up. The next run continues where
+    the previous one stopped. Afterwards, the remaining time is used for an incremental vacuum,
+    which returns the freed pages to the filesystem.
+
+    If the database file and its archive together are larger than `max_size`, the threshold is doubled every run until it
+    is small enough again, and is lowered again once the file is well below `max_size`.
+    """
+    # Divide all stored counts by the scale the next time the bot starts, once it grows beyond this
+    MAX_SCALE = 2.0 ** 40
+    # Stop decaying until the counts are renormalized once the scale reaches this, far before floats overflow
+    SCALE_LIMIT = 2.0 ** 900
+    # Seconds between progress messages while renormalizing
+    PROGRESS_INTERVAL = 5
+    # Number of rowids to delete from in one statement, to keep write locks short
+    CHUNK_SIZE = 5000
+    # Number of pages to free in one incremental vacuum step
+    VACUUM_PAGES = 1000
+
+    def __init__(self, db: Database, half_life: float, threshold: float, time_budget: float, max_size: float) -> None:
+        """Create a Compactor.
+
+        Args:
+            db (Database): The Database to compact.
+            half_life (float): The number of days after which counts are halved. 0 to disable decay.
+            threshold (float): The effective count below which n-grams are removed.
+            time_budget (float): The maximum number of seconds to spend per run.
+            max_size (float): The target maximum size of the database file in megabytes. 0 for no maximum.
+        """
+        self.db = db
+        self.half_life = half_life
+        self.threshold = threshold
+        self.time_budget = time_budget
+        self.max_size = max_size * 2 ** 20
+        self._warned_auto_vacuum = False
+        self._warned_scale = False
+
+    @property
+    def enabled(self) -> bool:
+        """Whether there is any work for the Compactor, i.e. whether decay or a maximum size is configured."""
+        return self.half_life > 0 or self.max_size > 0
+
+    def schemas(self) -> List[str]:
+        """Get the schemas to compact, i.e. "main", and "archive" if the Database has an archive."""
+        return ["main", "archive"] if self.db.archive_name else ["main"]
+
+    def tables(self, conn: sqlite3.Connection) -> List[str]:
+        """Get the qualified names of all tables holding counts, in a fixed order."""
+        return [f"{schema}.{name}" for schema in self.schemas() for name, in conn.execute(f"""
+            SELECT name FROM {schema}.sqlite_master
+            WHERE type = 'table' AND (name LIKE 'MarkovStart%' OR name LIKE 'MarkovGrammar%' OR name = 'TrieNode')
+            ORDER BY name;""")]
+
+    def size(self) -> int:
+        """Get the total size in bytes of the database file and its archive."""
+        return sum(os.path.getsize(name) for name in (self.db.db_name, self.db.archive_name) if name)
+
+    def run(self) -> Optional[Dict[str, float]]:
+        """Decay, prune and vacuum for at most `time_budget` seconds.
+
+        Returns:
+            Optional[Dict[str, float]]: The number of removed rows, the number of reclaimed bytes,
+                the size of the database file, the current cutoff and the number of seconds taken.
+                None if the Compactor is not enabled.
+        """
+        if not self.enabled:
+            return None
+        start = time.monotonic()
+        deadline = start + self.time_budget
+
+        # Write everything that was learned so far, so it is decayed and pruned as well
+        self.db.flush()
+        size_before = self.size()
+
+        # Autocommit mode, so every chunk is its own short transaction
+        conn = self.db.connect(isolation_level=None)
+        try:
+            if self.db.archive_name:
+                conn.execute("ATTACH DATABASE ? AS archive;", (self.db.archive_name,))
+            conn.execute("BEGIN IMMEDIATE;")
+            scale, updated, boost, cursor_table, cursor_rowid = conn.execute(
+                "SELECT scale, updated, boost, cursor_table, cursor_rowid FROM Decay;").fetchone()
+            now = time.time()
+            if self.half_life > 0:
+                scale = min(scale * 2 ** ((now - updated) / (self.half_life * 86400)), self.SCALE_LIMIT)
+            if scale > self.MAX_SCALE and not self._warned_scale:
+                logger.info(f"The decay scale of {self.db.db_name} is {scale:.3g}. All counts will be divided by it the next time the bot starts.")
+                if scale >= self.SCALE_LIMIT:
+                    logger.warning(f"Decay of {self.db.db_name} is paused until the bot is restarted.")
+                self._warned_scale = True
+
+            # Raise the threshold while the database is too large, and lower it again once it is well below
+            if self.max_size > 0:
+                if size_before > self.max_size:
+                    boost *= 2
+                elif size_before < 0.8 * self.max_size:
+                    boost = max(boost / 2, 1)
+            cutoff = self.threshold * boost * scale
+            conn.execute("UPDATE Decay SET scale = ?, updated = ?, boost = ?;", (scale, now, boost))
+            conn.execute("COMMIT;")
+
+            removed = 0
+            # The words and stored counts of the removed n-grams per table, for Databases that keep a copy of them
+            pruned: Dict[str, List[Tuple]] = {}
+            tables = self.tables(conn)
+            stats_tables = set(ModelStats.tables(conn) + ModelStats.trie_tables(conn))
+            visited = 0
+            while visited < len(tables) and time.monotonic() < deadline:
+                table = tables[cursor_table % len(tables)]
+                max_rowid = conn.execute(f"SELECT max(rowid) FROM {table};").fetchone()[0] or 0
+                name = table[len("main."):] if table.startswith("main.") else table
+                accounted = name in stats_tables
+                tracked = self.db.TRACK_PRUNED and name != ModelStats.TRIE
+                while cursor_rowid < max_rowid and time.monotonic() < deadline:
+                    where = "rowid > ? AND rowid <= ? AND count < ?"
+                    values = (cursor_rowid, cursor_rowid + self.CHUNK_SIZE, cutoff)
+                    conn.execute("BEGIN IMMEDIATE;")
+                    if accounted:
+                        stats = ModelStats()
+                        stats.delete(conn.cursor(), name, where, values)
+                    if tracked:
+                        columns = "word1, word2, word3, count" if "Grammar" in name else "word1, word2, count"
+                        pruned.setdefault(name, []).extend(conn.execute(f"SELECT {columns} FROM {table} WHERE {where};", values))
+                    removed += conn.execute(f"DELETE FROM {table} WHERE {where};", values).rowcount
+                    if accounted:
+                        stats.write(conn.cursor())
+                    conn.execute("COMMIT;")
+                    cursor_rowid += self.CHUNK_SIZE
+                if cursor_rowid >= max_rowid:
+                    cursor_table = (cursor_table + 1) % len(tables)
+                    cursor_rowid = 0
+                    visited += 1
+            conn.execute("UPDATE Decay SET cursor_table = ?, cursor_rowid = ?;", (cursor_table, cursor_rowid))
+
+            for schema in self.schemas():
+                if conn.execute(f"PRAGMA {schema}.auto_vacuum;").fetchone()[0] == 2:
+                    while time.monotonic() < deadline and conn.execute(f"PRAGMA {schema}.freelist_count;").fetchone()[0] > 0:
+                        conn.execute(f"PRAGMA {schema}.incremental_vacuum({self.VACUUM_PAGES});").fetchall()
+                elif not self._warned_auto_vacuum:
+                    logger.info(f"{self.db.db_name} was created without incremental vacuum, so pruned rows are reused, "
+                                "but the file does not shrink. Run VACUUM on it once after setting \"PRAGMA auto_vacuum = INCREMENTAL\" to change this.")
+                    self._warned_auto_vacuum = True
+        finally:
+            conn.close()
+
+        self.db.compacted(cutoff, scale, False, pruned)
+        size_after = self.size()
+        stats = {
+            "removed": removed,
+            "reclaimed": size_before - size_after,
+            "size": size_after,
+            "cutoff": cutoff / scale,
+            "seconds": time.monotonic() - start,
+        }
+        logger.info(f"Compaction of {self.db.db_name} removed {removed} n-grams with a count below {stats['cutoff']:.3g} "
+                    f"and reclaimed {stats['reclaimed'] / 2 ** 20:.1f}MB in {stats['seconds']:.2f} seconds. "
+                    f"The database is now {size_after / 2 ** 20:.1f}MB.")
+        return stats
+
+    def renormalize(self) -> bool:
+        """Divide all stored counts by the scale, and reset it to 1, if the scale grew beyond `MAX_SCALE`.
+
+        Every table is rewritten, in a single transaction, so that an interruption never leaves counts
+        with different scales behind. Called when the bot starts, before anything is learned, so it
+        does not keep learning waiting.
+
+        Returns:
+            bool: Whether the counts were renormalized.
+        """
+        start = time.monotonic()
+        conn = self.db.connect(isolation_level=None)
+        try:
+            if self.db.archive_name:
+                conn.execute("ATTACH DATABASE ? AS archive;", (self.db.archive_name,))
+            scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+            if scale <= self.MAX_SCALE:
+                return False
+            tables = self.tables(conn)
+            logger.info(f"Dividing all counts in {self.db.db_name} by the decay scale of {scale:.3g}, which rewrites all {len(tables)} tables...")
+            reported = start
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                for index, table in enumerate(tables):
+                    conn.execute(f"UPDATE {table} SET count = count / ?;", (scale,))
+                    if time.monotonic() - reported > self.PROGRESS_INTERVAL:
+                        reported = time.monotonic()
+                        logger.info(f"Divided the counts of {index + 1} of {len(tables)} tables in {self.db.db_name}...")
+                conn.execute("UPDATE ModelStats SET total = total / ?;", (scale,))
+                conn.execute("UPDATE Decay SET scale = 1;")
+            except BaseException:
+                conn.execute("ROLLBACK;")
+                raise
+            conn.execute("COMMIT;")
+        finally:
+            conn.close()
+
+        self.db.compacted(0, 1.0, True, {})
+        logger.info(f"Divided all counts in {self.db.db_name} by {scale:.3g} in {time.monotonic() - start:.2f} seconds.")
+        return True
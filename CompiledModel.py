@@ -0,0 +1,464 @@
+import bisect, heapq, itertools, logging, mmap, os, random, shutil, sqlite3, string, struct, sys, tempfile, time
+from array import array
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+from MemoryDatabase import FOLD_TABLE
+
+logger = logging.getLogger(__name__)
+
+class CompiledModel:
+    """
+    Read-only, memory-mapped version of the Markov Chain of a channel, used for generation.
+
+    `CompiledModel.compile(channel)` converts the tables in `MarkovChain_{channel}.db` into
+    `MarkovChain_{channel}.model`, a binary file consisting of a header followed by these sections,
+    each aligned to 8 bytes and stored in native byte order:
+
+    > word_offsets     uint32[words + 1]  Offsets of every word in the vocabulary blob
+    > blob             bytes[blob_size]   The UTF-8 encoded vocabulary, sorted bytewise
+    > fold_of          uint32[words]      The id of the ASCII lowercase version of every word
+    > keys             uint64[keys]       Sorted fold(word1) << 32 | fold(word2) keys
+    > key_word2        uint32[keys]       The most frequent original word2 of every key
+    > row_offsets      uint32[keys + 1]   Offsets of the successors of every key
+    > successors       uint32[ngrams]     The word3 ids of every key, with <END> first
+    > cumulative       float64[ngrams]    Running total of the counts of all successors
+    > start_offsets    uint32[28]         Offsets of the starts of every table suffix
+    > start_word1      uint32[starts]     Sorted by suffix, then by fold(word1)
+    > start_word2      uint32[starts]
+    > start_cumulative float64[starts]    Running total of the counts of all starts
+
+    Because the cumulative counts are global running totals, sampling a successor is a single
+    `bisect` between the row offsets of a key. The file is only ever read through `mmap` and
+    `memoryview.cast`, so opening a model takes milliseconds regardless of its size, nothing is
+    copied into the Python heap, and all processes using the same model share the page cache.
+
+    The model provides the same methods that `MarkovChain.generate` uses from `Database`, and
+    samples with the same weights, including the index-based weighting of "<END>".
+    """
+    MAGIC = b"MKVC"
+    VERSION = 2
+    # Written in native byte order, used to detect files compiled on a machine with a different byte order
+    BYTE_ORDER = 0x01020304
+    HEADER = struct.Struct("=4sIIIQQQQQ")
+    HEADER_SIZE = 64
+
+    # Table suffixes, in the order used by the start_offsets section
+    SUFFIXES = list(string.ascii_uppercase) + ["_"]
+
+    def __init__(self, path: str):
+        """Memory-map a compiled model.
+
+        Args:
+            path (str): The path of the compiled model file.
+
+        Raises:
+            ValueError: If the file is not a compiled model of a supported version.
+        """
+        self.path = path
+        # Random number generator for generation, which can be seeded like `Database.seed`
+        self.random = random.Random()
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        buffer = memoryview(self._mmap)
+
+        magic, version, byte_order, _, words, blob_size, keys, ngrams, starts = self.HEADER.unpack_from(buffer)
+        if magic != self.MAGIC or byte_order != self.BYTE_ORDER:
+            raise ValueError(f"{path} is not a compiled model for this machine.")
+        if version != self.VERSION:
+            raise ValueError(f"{path} has version {version}, but version {self.VERSION} is required.")
+
+        offset = self.HEADER_SIZE
+        def section(format: str, length: int) -> memoryview:
+            nonlocal offset
+            size = length * struct.calcsize(format)
+            view = buffer[offset: offset + size].cast(format)
+            offset += -(-size // 8) * 8
+            return view
+
+        self.word_offsets = section("I", words + 1)
+        self.blob = section("B", blob_size)
+        self.fold_of = section("I", words)
+        self.keys = section("Q", keys)
+        self.key_word2 = section("I", keys)
+        self.row_offsets = section("I", keys + 1)
+        self.successors = section("I", ngrams)
+        self.cumulative = section("d", ngrams)
+        self.start_offsets = section("I", len(self.SUFFIXES) + 1)
+        self.start_word1 = section("I", starts)
+        self.start_word2 = section("I", starts)
+        self.start_cumulative = section("d", starts)
+
+        self.end_id = self.word_id("<END>")
+        # Weigh every start suffix by the total count of its starts, like Database.get_start does with ModelStats
+        self.word_frequency = []
+        for suffix in range(len(self.SUFFIXES)):
+            lo, hi = self.start_offsets[suffix], self.start_offsets[suffix + 1]
+            self.word_frequency.append(self.start_cumulative[hi - 1] - (self.start_cumulative[lo - 1] if lo else 0) if hi > lo else 0)
+        if not any(self.word_frequency):
+            # Same weights as Database.word_frequency
+            self.word_frequency = [11.6, 4.4, 5.2, 3.1, 2.8, 4, 1.6, 4.2, 7.3, 0.5, 0.8, 2.4,
+                                   3.8, 2.2, 7.6, 4.3, 0.2, 2.8, 6.6, 15.9, 1.1, 0.8, 5.5, 0.1, 0.7, 0.1, 0.5]
+
+    @staticmethod
+    def path_for(channel: str) -> str:
+        """Get the path of the compiled model of `channel`, next to its database file.
+
+        Args:
+            channel (str): The channel name, e.g. "cubiedev".
+
+        Returns:
+            str: The path of the compiled model file.
+        """
+        return f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.model"
+
+    @staticmethod
+    def suffix_index(character: str) -> int:
+        """Get the index in `CompiledModel.SUFFIXES` of the table suffix of `character`, like `Database.get_suffix`."""
+        character = character.lower()
+        if character in string.ascii_lowercase:
+            return ord(character) - ord("a")
+        return len(CompiledModel.SUFFIXES) - 1
+
+    def seed(self, seed: Optional[int]) -> None:
+        """Seed the random number generator used for generation, see `Database.seed`."""
+        self.random.seed(seed)
+
+    def is_stale(self) -> bool:
+        """Whether the model file was replaced by a newer compilation since it was opened.
+
+        Returns:
+            bool: True if the model should be reopened.
+        """
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return False
+
+    def word(self, word_id: int) -> str:
+        """Get the word with id `word_id`."""
+        return bytes(self.blob[self.word_offsets[word_id]: self.word_offsets[word_id + 1]]).decode("utf-8")
+
+    def word_id(self, word: str) -> Optional[int]:
+        """Find the id of `word` with a binary search over the sorted vocabulary.
+
+        Args:
+            word (str): The word to find.
+
+        Returns:
+            Optional[int]: The id of the word, or None if it is not in the vocabulary.
+        """
+        target = word.encode("utf-8")
+        lo, hi = 0, len(self.fold_of)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if bytes(self.blob[self.word_offsets[mid]: self.word_offsets[mid + 1]]) < target:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < len(self.fold_of) and self.word(lo) == word:
+            return lo
+        return None
+
+    def fold_id(self, word: str) -> Optional[int]:
+        """Find the id of the case folded `word`, or None if it is not in the vocabulary."""
+        return self.word_id(word.translate(FOLD_TABLE))
+
+    def _row(self, words: List[str]) -> Optional[int]:
+        """Get the index of the key `words`, if it has any successors."""
+        fold1 = self.fold_id(words[0])
+        fold2 = self.fold_id(words[1])
+        if fold1 is None or fold2 is None:
+            return None
+        key = fold1 << 32 | fold2
+        row = bisect.bisect_right(self.keys, key, 0, len(self.keys)) - 1
+        if row < 0 or self.keys[row] != key:
+            return None
+        return row
+
+    def _sample(self, row: int, end_weight: float) -> Optional[str]:
+        """Pick a successor of key `row`, weighted by count, with the count of "<END>" multiplied by `end_weight`."""
+        lo, hi = self.row_offsets[row], self.row_offsets[row + 1]
+        base = self.cumulative[lo - 1] if lo else 0
+        end = 0
+        if self.successors[lo] == self.end_id:
+            # "<END>" is always the first successor of a row
+            end = self.cumulative[lo] - base
+        total = self.cumulative[hi - 1] - base - end + end * end_weight
+        if total <= 0:
+            return None
+        target = self.random.random() * total
+        if target < end * end_weight:
+            return "<END>"
+        target = base + end + (target - end * end_weight)
+        position = min(bisect.bisect_right(self.cumulative, target, lo, hi), hi - 1)
+        return self.word(self.successors[position])
+
+    def get_next(self, index: int, words: List[str]) -> Optional[str]:
+        """See `Database.get_next`."""
+        row = self._row(words)
+        return None if row is None else self._sample(row, (index + 1) / 15)
+
+    def get_next_initial(self, index: int, words) -> Optional[str]:
+        """See `Database.get_next_initial`."""
+        row = self._row(words)
+        return None if row is None else self._sample(row, 0)
+
+    def get_next_single_initial(self, index: int, word: str) -> Optional[List[str]]:
+        """See `Database.get_next_single_initial`.
+
+        The second word is picked from all keys starting with `word`, weighted by their total count.
+        """
+        fold1 = self.fold_id(word)
+        if fold1 is None:
+            return None
+        first = bisect.bisect_right(self.keys, (fold1 << 32) - 1, 0, len(self.keys))
+        last = bisect.bisect_right(self.keys, (fold1 << 32) | 0xFFFFFFFF, first, len(self.keys))
+        rows = [row for row in range(first, last) if self.keys[row] & 0xFFFFFFFF != self.end_id]
+        if not rows:
+            return None
+        weights = [self.cumulative[self.row_offsets[row + 1] - 1] - (self.cumulative[self.row_offsets[row] - 1] if self.row_offsets[row] else 0)
+                   for row in rows]
+        return [word, self.word(self.key_word2[self.random.choices(rows, weights=weights)[0]])]
+
+    def _sample_start(self, lo: int, hi: int) -> Optional[int]:
+        """Pick a start between `lo` and `hi`, weighted by count."""
+        if lo >= hi:
+            return None
+        base = self.start_cumulative[lo - 1] if lo else 0
+        total = self.start_cumulative[hi - 1] - base
+        if total <= 0:
+            return None
+        return min(bisect.bisect_right(self.start_cumulative, base + self.random.random() * total, lo, hi), hi - 1)
+
+    def get_next_single_start(self, word: str) -> Optional[List[str]]:
+        """See `Database.get_next_single_start`."""
+        fold1 = self.fold_id(word)
+        if fold1 is None:
+            return None
+        suffix = self.suffix_index(word[0])
+        lo, hi = self.start_offsets[suffix], self.start_offsets[suffix + 1]
+        # Starts are sorted by fold(word1) within a suffix
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.fold_of[self.start_word1[mid]] < fold1:
+                lo = mid + 1
+            else:
+                hi = mid
+        first = last = lo
+        while last < self.start_offsets[suffix + 1] and self.fold_of[self.start_word1[last]] == fold1:
+            last += 1
+        position = self._sample_start(first, last)
+        return None if position is None else [word, self.word(self.start_word2[position])]
+
+    def get_start(self) -> List[str]:
+        """See `Database.get_start`."""
+        suffix = self.random.choices(range(len(self.SUFFIXES)), weights=self.word_frequency)[0]
+        position = self._sample_start(self.start_offsets[suffix], self.start_offsets[suffix + 1])
+        if position is None:
+            return []
+        return [self.word(self.start_word1[position]), self.word(self.start_word2[position])]
+
+    def close(self) -> None:
+        """Unmap the model file."""
+        for name in ("word_offsets", "blob", "fold_of", "keys", "key_word2", "row_offsets", "successors",
+                     "cumulative", "start_offsets", "start_word1", "start_word2", "start_cumulative"):
+            getattr(self, name).release()
+        self._mmap.close()
+
+    @staticmethod
+    def compile(channel: str) -> Dict[str, float]:
+        """Compile the database of `channel` into a new model file.
+
+        Only the vocabulary is held in memory. The 3-grams are streamed from the tables in the
+        order of the model, one first character of word1 at a time, and written to a temporary
+        file per section, so compiling needs little memory no matter how large the model is.
+
+        The model is written to a temporary file first, and then atomically renamed,
+        so processes that are reading the previous model are never interrupted.
+
+        Args:
+            channel (str): The channel name, e.g. "cubiedev".
+
+        Returns:
+            Dict[str, float]: The number of words, keys, n-grams and starts, the file size and the number of seconds taken.
+        """
+        channel = channel.replace("#", "").lower()
+        db_name = f"/app/db/MarkovChain_{channel}.db"
+        if not os.path.isfile(db_name):
+            raise FileNotFoundError(f"{db_name} does not exist.")
+        start = time.perf_counter()
+        path = CompiledModel.path_for(channel)
+        directory = os.path.dirname(path)
+
+        archive_name = db_name[:-3] + "_archive.db"
+        conn = sqlite3.connect(db_name)
+        try:
+            tables = [f"main.MarkovGrammar{first_char}{second_char}" for first_char in CompiledModel.SUFFIXES for second_char in CompiledModel.SUFFIXES]
+            if os.path.isfile(archive_name):
+                # Include the rarely used 3-grams of Database.enable_archive
+                conn.execute("ATTACH DATABASE ? AS archive;", (archive_name,))
+                tables.append("archive.MarkovGrammar")
+            # Store the decayed counts, see Compactor
+            scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+
+            vocabulary = {"<END>"}
+            for table in tables:
+                for row in conn.execute(f"SELECT word1, word2, word3 FROM {table} WHERE count > 0;"):
+                    vocabulary.update(row)
+            for first_char in CompiledModel.SUFFIXES:
+                for row in conn.execute(f"SELECT word1, word2 FROM MarkovStart{first_char} WHERE count > 0;"):
+                    vocabulary.update(row)
+            vocabulary.update([word.translate(FOLD_TABLE) for word in vocabulary])
+            words = sorted(vocabulary, key=lambda word: word.encode("utf-8"))
+            del vocabulary
+            word_ids = {word: word_id for word_id, word in enumerate(words)}
+            encoded = [word.encode("utf-8") for word in words]
+            word_offsets = array("I", [0])
+            for word in encoded:
+                word_offsets.append(word_offsets[-1] + len(word))
+            fold_of = array("I", [word_ids[word.translate(FOLD_TABLE)] for word in words])
+
+            keys = Section("Q", directory)
+            key_word2 = Section("I", directory)
+            row_offsets = Section("I", directory)
+            row_offsets.append(0)
+            successors = Section("I", directory)
+            cumulative = Section("d", directory)
+            total = 0
+            # The rows of a key with different capitalizations of word1 and word2 are merged, so the
+            # counts of the same word3 are added up, and the most frequent word2 is kept
+            key = None
+            variants: Dict[str, float] = {}
+            word3 = None
+            count = 0
+            for row in CompiledModel._grammar_rows(conn, tables):
+                if (row[0], row[1]) != key or row[3] != word3:
+                    if word3 is not None:
+                        successors.append(word_ids[word3])
+                        total += count / scale
+                        cumulative.append(total)
+                    if (row[0], row[1]) != key:
+                        if key is not None:
+                            key_word2.append(word_ids[max(variants, key=variants.get)])
+                            row_offsets.append(successors.length)
+                        key = (row[0], row[1])
+                        keys.append(word_ids[key[0]] << 32 | word_ids[key[1]])
+                        variants = {}
+                    word3 = row[3]
+                    count = 0
+                count += row[5]
+                variants[row[4]] = variants.get(row[4], 0) + row[5]
+            if key is not None:
+                successors.append(word_ids[word3])
+                total += count / scale
+                cumulative.append(total)
+                key_word2.append(word_ids[max(variants, key=variants.get)])
+                row_offsets.append(successors.length)
+
+            # Starts are sorted by suffix, then by fold(word1), word1 and word2
+            start_offsets = array("I", [0] * (len(CompiledModel.SUFFIXES) + 1))
+            start_word1 = Section("I", directory)
+            start_word2 = Section("I", directory)
+            start_cumulative = Section("d", directory)
+            total = 0
+            for suffix, first_char in enumerate(CompiledModel.SUFFIXES):
+                for word1, word2, count in conn.execute(f"SELECT word1, word2, count FROM MarkovStart{first_char} WHERE count > 0 "
+                                                         "ORDER BY lower(word1), word1 COLLATE BINARY, word2 COLLATE BINARY;"):
+                    start_word1.append(word_ids[word1])
+                    start_word2.append(word_ids[word2])
+                    total += count / scale
+                    start_cumulative.append(total)
+                start_offsets[suffix + 1] = start_word1.length
+        finally:
+            conn.close()
+
+        with open(path + ".tmp", "wb") as f:
+            header = CompiledModel.HEADER.pack(CompiledModel.MAGIC, CompiledModel.VERSION, CompiledModel.BYTE_ORDER, 0,
+                                               len(words), word_offsets[-1], keys.length, successors.length, start_word1.length)
+            f.write(header.ljust(CompiledModel.HEADER_SIZE, b"\0"))
+            for data in (word_offsets.tobytes(), b"".join(encoded), fold_of.tobytes()):
+                f.write(data)
+                f.write(b"\0" * (-len(data) % 8))
+            for section in (keys, key_word2, row_offsets, successors, cumulative):
+                section.copy_to(f)
+            f.write(start_offsets.tobytes())
+            f.write(b"\0" * (-len(start_offsets.tobytes()) % 8))
+            for section in (start_word1, start_word2, start_cumulative):
+                section.copy_to(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+
+        return {
+            "words": len(words),
+            "keys": keys.length,
+            "ngrams": successors.length,
+            "starts": start_word1.length,
+            "bytes": os.path.getsize(path),
+            "seconds": time.perf_counter() - start,
+        }
+
+    @staticmethod
+    def _grammar_rows(conn: sqlite3.Connection, tables: List[str]) -> Iterator[Tuple[str, str, int, str, str, float]]:
+        """Stream every 3-gram of `tables` in the order of the model.
+
+        Yields (fold(word1), fold(word2), word3 != "<END>", word3, word2, count), sorted by the first four.
+        Folded words are ordered bytewise, which puts every character of the "_" tables before "a"
+        or after "z", so the tables are sorted in 28 groups of their first character, each with its
+        own query. The archive is a single table, which is merged in.
+        """
+        columns = "lower(word1), lower(word2), word3 != '<END>', word3, word2, count"
+        order = "ORDER BY 1, 2, 3, 4 COLLATE BINARY"
+        def group(first_char: str, where: str = "") -> Iterator[Tuple[str, str, int, str, str, float]]:
+            yield from conn.execute(" UNION ALL ".join(f"SELECT {columns} FROM main.MarkovGrammar{first_char}{second_char} WHERE count > 0{where}"
+                                                       for second_char in CompiledModel.SUFFIXES) + f" {order};")
+        groups = itertools.chain(group("_", " AND lower(word1) < 'a'"),
+                                 *(group(first_char) for first_char in string.ascii_uppercase),
+                                 group("_", " AND lower(word1) > 'z'"))
+        if "archive.MarkovGrammar" not in tables:
+            return groups
+        archive = conn.cursor().execute(f"SELECT {columns} FROM archive.MarkovGrammar WHERE count > 0 {order};")
+        return heapq.merge(groups, archive, key=lambda row: row[:4])
+
+class Section:
+    """A section of a model file that is being compiled, buffered in a temporary file."""
+    # Number of values buffered in memory before they are written to the temporary file
+    BUFFER = 65536
+
+    def __init__(self, typecode: str, directory: str) -> None:
+        self.file = tempfile.TemporaryFile(dir=directory)
+        self.buffer = array(typecode)
+        self.length = 0
+
+    def append(self, value: float) -> None:
+        self.buffer.append(value)
+        self.length += 1
+        if len(self.buffer) >= self.BUFFER:
+            self.file.write(self.buffer.tobytes())
+            del self.buffer[:]
+
+    def copy_to(self, f: BinaryIO) -> None:
+        """Write the section to the model file `f`, padded to 8 bytes, and remove the temporary file."""
+        self.file.write(self.buffer.tobytes())
+        del self.buffer[:]
+        size = self.file.tell()
+        self.file.seek(0)
+        shutil.copyfileobj(self.file, f)
+        f.write(b"\0" * (-size % 8))
+        self.file.close()
+
+if __name__ == "__main__":
+    # Compile the database of a channel into a model file.
+    # Usage: python CompiledModel.py <channel>
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    if len(sys.argv) != 2:
+        print("Usage: python CompiledModel.py <channel>")
+        sys.exit(1)
+    stats = CompiledModel.compile(sys.argv[1])
+    logger.info(f"Compiled {stats['ngrams']} n-grams with {stats['keys']} keys, {stats['words']} words and {stats['starts']} starts "
+                f"into {CompiledModel.path_for(sys.argv[1])} ({stats['bytes'] / 2 ** 20:.1f}MB) in {stats['seconds']:.2f} seconds.")
+
+    start = time.perf_counter()
+    model = CompiledModel(CompiledModel.path_for(sys.argv[1]))
+    logger.info(f"Opened the model in {(time.perf_counter() - start) * 1000:.2f}ms.")
@@ -4,9 +4,24 @@ import logging
 import random
 import string
 import os
-from typing import Any, List, Optional, Tuple
+import json
+import time
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple
+
+from Metrics import CACHE_REQUESTS, DB_BATCH_SIZE, DB_SECONDS
+from Migrations import get_version, migrate
+from ModelStats import ModelStats
+from Profiler import profiled
+from Tracing import QueryTracer, TracedConnection
+from WarmCache import WarmCache
 logger = logging.getLogger(__name__)
 
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, where Admin.py cannot tell whether the bot is running
+    fcntl = None
+
 
 class Database:
 
@@ -86,16 +101,119 @@ class Database:
       and "hello" differently, just like "HELLO" and "hello", but allow generating from "hello"
       to both get results from "hello" and "hello,".
     """
+    # The version of the tables created by `create_tables`. See Migrations for versions up to 3.
+    # Version 4 added the Decay table, version 5 the ModelStats tables, and version 6 the trie tables of TrieDatabase.
+    VERSION = 6
+    # Number of seconds for which the table totals of `shard_weights` are reused
+    SHARD_WEIGHTS_TTL = 60
+    # Whether Compactor passes the n-grams it removed to `compacted`, for subclasses that keep a copy of them
+    TRACK_PRUNED = False
 
     def __init__(self, channel: str):
-        self.db_name = f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.db"
+        self.channel = channel.replace('#', '').lower()
+        self.db_name = f"/app/db/MarkovChain_{self.channel}.db"
         self._execute_queue = []
+        # Random number generator for generation, see `seed`
+        self.random = random.Random()
+        # Times the statements on connections from `connect` while it is enabled, see ChannelState
+        self.tracer = QueryTracer(self.db_name[:-3] + "_slow_queries.log")
+
+        # Archive with rarely used 3-grams, see `enable_archive`.
+        # Also used by other processes for the same channel, such as the learning worker, once it exists.
+        self.archive_name = None
+        if os.path.isfile(self.db_name[:-3] + "_archive.db"):
+            self.archive_name = self.db_name[:-3] + "_archive.db"
+        # Keys that were used since the last `archive_cold`, which are never archived
+        self.hot_keys: Set[Tuple[str, str]] = set()
+        # (table, word1, word2) of keys learned since the last commit, which are moved back from the archive
+        self._learned_keys: Set[Tuple[str, str, str]] = set()
+        # Index of the grammar table where the next `archive_cold` continues
+        self._archive_cursor = 0
+        # Total stored count per table from ModelStats, and when it was read, see `shard_weights`
+        self._shard_weights: Dict[str, float] = {}
+        self._shard_weights_read = 0.0
+        # Optional read cache of successors and start tables, see ChannelState
+        self.warm_cache: Optional[WarmCache] = None
+
+        # Only migrate and create tables for new or outdated databases, so that restarts are fast
+        start = time.perf_counter()
+        version = self.get_version()
+        if version < self.VERSION:
+            # Ensure the database is updated to the newest version.
+            # This can also be done offline beforehand, with `python Migrations.py <channel>`.
+            migrate(self.db_name)
+            self.create_tables()
+        logger.debug(f"Opened {self.db_name} at version {version} in {(time.perf_counter() - start) * 1000:.1f}ms.")
+
+        # Used for randomly picking a Markov Grammar or a start if there are no ModelStats
+        # Index 0 is for "A", 1 for "B", etc. Then, 26 is for "_"
+        self.word_frequency = [11.6, 4.4, 5.2, 3.1, 2.8, 4, 1.6, 4.2, 7.3, 0.5, 0.8, 2.4,
+                               3.8, 2.2, 7.6, 4.3, 0.2, 2.8, 6.6, 15.9, 1.1, 0.8, 5.5, 0.1, 0.7, 0.1, 0.5]
+
+    def seed(self, seed: Optional[int]) -> None:
+        """Seed the random number generator used for generation, for deterministic runs such as benchmarks.
+
+        Args:
+            seed (Optional[int]): The seed, or None to seed from the operating system.
+        """
+        self.random.seed(seed)
+
+    def hold_writer_lock(self) -> None:
+        """Hold a shared lock on `MarkovChain_{channel}.lock` for as long as this process runs.
+
+        This tells `Admin.py` that a running bot writes to this database. If `Admin.py` is changing
+        the database right now, this waits until it is done.
+        """
+        if fcntl is None:
+            return
+        f = open(self.db_name[:-3] + ".lock", "a+")
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except BlockingIOError:
+            logger.info(f"Waiting for Admin.py to finish changing {self.db_name}...")
+            fcntl.flock(f, fcntl.LOCK_SH)
+        # Read by Admin.py to describe the writer
+        f.seek(0)
+        f.truncate()
+        f.write(json.dumps({"pid": os.getpid(), "engine": type(self).__name__}))
+        f.flush()
+        self._writer_lock = f
+
+    def connect(self, **kwargs) -> sqlite3.Connection:
+        """Open a connection to the database file, whose statements are timed by `tracer` if it is enabled.
+
+        Args:
+            **kwargs: Passed on to `sqlite3.connect`, e.g. `isolation_level`.
+
+        Returns:
+            sqlite3.Connection: The new connection.
+        """
+        if not self.tracer.enabled:
+            return sqlite3.connect(self.db_name, **kwargs)
+        conn = sqlite3.connect(self.db_name, factory=TracedConnection, **kwargs)
+        conn.tracer = self.tracer
+        return conn
+
+    def get_version(self) -> int:
+        """Get the version of the database file, with a single query.
+
+        Returns:
+            int: The version from the Version table, or 0 if the file or the table does not exist.
+        """
+        if not os.path.isfile(self.db_name):
+            return 0
+        with self.connect() as conn:
+            return get_version(conn)
+
+    def create_tables(self) -> None:
+        """Create all tables that do not exist yet, and set the version to `Database.VERSION`.
 
-        if os.path.isfile(self.db_name):
-            # Ensure the database is updated to the newest version
-            self.update_v1(channel)
-            self.update_v2()
-            self.update_v3(channel)
+        Only used for new databases and after migrating, as checking 756 tables on every start is slow.
+        """
+        if not os.path.isfile(self.db_name):
+            # Let Compactor return the pages freed by pruning to the filesystem.
+            # This can only be set before the first table is created.
+            self.add_execute_queue("PRAGMA auto_vacuum = INCREMENTAL;", auto_commit=False)
 
         # Create database tables.
         for first_char in list(string.ascii_uppercase) + ["_"]:
@@ -132,381 +250,340 @@ class Database:
         """
         self.add_execute_queue(sql)
         self.add_execute_queue("DELETE FROM Version;")
-        self.add_execute_queue("INSERT INTO Version (version) VALUES (3);")
+        # Scale factor by which learned weights are multiplied, see Compactor.
+        # The counts are only ever compared to each other, so a growing scale decays old counts
+        # without having to update them all.
+        sql = """
+        CREATE TABLE IF NOT EXISTS Decay (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            scale REAL NOT NULL,
+            updated REAL NOT NULL,
+            boost REAL NOT NULL,
+            cursor_table INTEGER NOT NULL,
+            cursor_rowid INTEGER NOT NULL
+        );
+        """
+        self.add_execute_queue(sql)
+        self.add_execute_queue("INSERT OR IGNORE INTO Decay (id, scale, updated, boost, cursor_table, cursor_rowid) VALUES (0, 1, strftime('%s', 'now'), 1, 0, 0);")
+        # The trie of TrieDatabase, used for key lengths other than 2, and empty otherwise
+        sql = """
+        CREATE TABLE IF NOT EXISTS Vocabulary (
+            id INTEGER PRIMARY KEY,
+            word TEXT NOT NULL UNIQUE
+        );
+        """
+        self.add_execute_queue(sql)
+        self.add_execute_queue("CREATE INDEX IF NOT EXISTS VocabularyNocase ON Vocabulary (word COLLATE NOCASE);")
+        sql = """
+        CREATE TABLE IF NOT EXISTS TrieNode (
+            id INTEGER PRIMARY KEY,
+            parent INTEGER NOT NULL,
+            word INTEGER NOT NULL,
+            count INTEGER NOT NULL,
+            UNIQUE (parent, word)
+        );
+        """
+        self.add_execute_queue(sql)
+        self.add_execute_queue("INSERT INTO Version (version) VALUES (?);", values=(self.VERSION,))
         self.execute_commit()
 
-        # Used for randomly picking a Markov Grammar if only one word is given
-        # Index 0 is for "A", 1 for "B", etc. Then, 26 is for "_"
-        self.word_frequency = [11.6, 4.4, 5.2, 3.1, 2.8, 4, 1.6, 4.2, 7.3, 0.5, 0.8, 2.4,
-                               3.8, 2.2, 7.6, 4.3, 0.2, 2.8, 6.6, 15.9, 1.1, 0.8, 5.5, 0.1, 0.7, 0.1, 0.5]
-
-    def update_v1(self, channel: str):
-        """Update the Database structure from a deprecated version to a newer one.
-
-        Args:
-            channel (str): The name of the Twitch channel on which the bot is running.
-        """
-        # If an old version of the Database is used, update the database
-        if ("MarkovGrammarA",) in self.execute("SELECT name FROM sqlite_master WHERE type='table';", fetch=True):
-
-            logger.info("Creating backup before updating Database...")
-            # Connect to both the new and backup, backup, and close both
-
-            def progress(status, remaining, total):
-                logging.debug(f'Copied {total-remaining} of {total} pages...')
-            conn = sqlite3.connect(
-                f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.db")
-            back_conn = sqlite3.connect(
-                f"/app/db/MarkovChain_{channel.replace('#', '').lower()}_backup.db")
-            with back_conn:
-                conn.backup(back_conn, pages=1000, progress=progress)
+        # Row counts and totals of every table, kept up to date by every write from now on
+        conn = self.connect(isolation_level=None)
+        try:
+            if self.archive_name:
+                conn.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+            ModelStats.create(conn)
+            if not conn.execute("SELECT 1 FROM ModelStats LIMIT 1;").fetchone():
+                ModelStats.rebuild(conn)
+            elif not conn.execute("SELECT 1 FROM ModelStats WHERE name = ?;", (ModelStats.TRIE,)).fetchone():
+                # Tries learned before version 6 were not part of ModelStats
+                conn.execute("INSERT INTO ModelStats (name, rows, total) SELECT ?, count(*), total(count) FROM TrieNode;", (ModelStats.TRIE,))
+        finally:
             conn.close()
-            back_conn.close()
-            logger.info("Created backup before updating Database...")
-
-            logger.info(
-                "Updating Database to new version for improved efficiency...")
 
-            # Rename ...Other to ..._
-            self.add_execute_queue(f"""
-            CREATE TABLE IF NOT EXISTS MarkovStart_ (
-                word1 TEXT COLLATE NOCASE, 
-                word2 TEXT COLLATE NOCASE, 
-                occurances INTEGER, 
-                PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY)
-            );
-            """)
-            self.add_execute_queue(f"""
-            CREATE TABLE IF NOT EXISTS MarkovGrammar_ (
-                word1 TEXT COLLATE NOCASE,
-                word2 TEXT COLLATE NOCASE,
-                word3 TEXT COLLATE NOCASE,
-                occurances INTEGER,
-                PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
-            );
-            """)
-            self.execute_commit()
+    def add_execute_queue(self, sql: Optional[str], values: Tuple[Any] = None, auto_commit: bool = True,
+                          account: Optional[Callable[[sqlite3.Cursor, ModelStats], None]] = None) -> None:
+        """Add query and corresponding values to a queue, to be executed all at once.
 
-            # Copy data from Other to _ and remove Other
-            self.add_execute_queue(
-                "INSERT INTO MarkovGrammar_ SELECT * FROM MarkovGrammarOther;")
-            self.add_execute_queue(
-                "INSERT INTO MarkovStart_ SELECT * FROM MarkovStartOther;")
-            self.add_execute_queue("DROP TABLE MarkovGrammarOther")
-            self.add_execute_queue("DROP TABLE MarkovStartOther")
-            self.execute_commit()
+        This entire queue can be executed with `self.execute_commit`, 
+        and the queue is automatically executed if there are more than 25 waiting queries.
 
-            # Copy all data from MarkovGrammarx where x is some digit to MarkovGrammar_,
-            # Same with MarkovStart.
-            for character in (list(string.digits)):
-                self.add_execute_queue(
-                    f"INSERT INTO MarkovGrammar_ SELECT * FROM MarkovGrammar{character}")
-                self.add_execute_queue(f"DROP TABLE MarkovGrammar{character}")
-                self.add_execute_queue(
-                    f"INSERT INTO MarkovStart_ SELECT * FROM MarkovStart{character}")
-                self.add_execute_queue(f"DROP TABLE MarkovStart{character}")
+        Args:
+            sql (Optional[str]): The SQL query to add, potentially with "?" for where 
+                a value ought to be filled in. None if `account` makes the change itself.
+            values ([Tuple[Any]], optional): Optional tuple of values to replace "?" in SQL queries.
+                Defaults to None.
+            auto_commit (bool, optional): Whether to execute the queue if there are more than 25 waiting queries.
+                Defaults to True.
+            account (Optional[Callable[[sqlite3.Cursor, ModelStats], None]], optional): Called right before
+                the query is executed, to account for its changes to the n-gram tables in the ModelStats
+                of the transaction. Defaults to None.
+        """
+        self._execute_queue.append((sql, values, account))
+        # Commit these executes if there are more than 25 queries
+        if auto_commit and len(self._execute_queue) > 25:
             self.execute_commit()
 
-            # Split up MarkovGrammarA into MarkovGrammarAA, MarkovGrammarAB, etc.
-            for first_char in list(string.ascii_uppercase) + ["_"]:
-                for second_char in list(string.ascii_uppercase):
-                    self.add_execute_queue(f"""
-                    CREATE TABLE IF NOT EXISTS MarkovGrammar{first_char}{second_char} (
-                        word1 TEXT COLLATE NOCASE,
-                        word2 TEXT COLLATE NOCASE,
-                        word3 TEXT COLLATE NOCASE,
-                        occurances INTEGER,
-                        PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
-                    );
-                    """)
-                    self.add_execute_queue(
-                        f"INSERT INTO MarkovGrammar{first_char}{second_char} SELECT * FROM MarkovGrammar{first_char} WHERE word2 LIKE \"{second_char}%\";")
-                    self.add_execute_queue(
-                        f"DELETE FROM MarkovGrammar{first_char} WHERE word2 LIKE \"{second_char}%\";")
+    @property
+    def queue_depth(self) -> int:
+        """The number of queries waiting to be executed by `execute_commit`."""
+        return len(self._execute_queue)
+
+    def memory_components(self) -> Dict[str, Any]:
+        """Get the in-memory structures of this Database by name, whose size is estimated in memory reports."""
+        components = {"execute_queue": self._execute_queue,
+                      "hot_keys": self.hot_keys,
+                      "learned_keys": self._learned_keys,
+                      "shard_weights": self._shard_weights,
+                      "tracer": self.tracer.stats}
+        if self.warm_cache is not None:
+            components.update(self.warm_cache.memory_components())
+        return components
+
+    @DB_SECONDS.time(("commit",))
+    @profiled("execute_commit", lambda db, *args, **kwargs: db.channel)
+    def execute_commit(self, fetch: bool = False) -> Any:
+        """Execute the SQL queries added to the queue with `self.add_execute_queue`.
 
-                self.add_execute_queue(f"""
-                CREATE TABLE IF NOT EXISTS MarkovGrammar{first_char}_ (
-                    word1 TEXT COLLATE NOCASE,
-                    word2 TEXT COLLATE NOCASE,
-                    word3 TEXT COLLATE NOCASE,
-                    occurances INTEGER,
-                    PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
-                );
-                """)
-                self.add_execute_queue(
-                    f"INSERT INTO MarkovGrammar{first_char}_ SELECT * FROM MarkovGrammar{first_char};")
-                self.add_execute_queue(f"DROP TABLE MarkovGrammar{first_char}")
-                self.execute_commit()
+        Args:
+            fetch (bool, optional): Whether to return the fetchall() of the SQL queries.
+                Defaults to False.
 
-            logger.info("Finished Updating Database to new version.")
+        Returns:
+            Any: The returned values from the SQL queries if `fetch` is true, otherwise None.
+        """
+        if self._execute_queue:
+            DB_BATCH_SIZE.observe(len(self._execute_queue))
+            with self.connect() as conn:
+                cur = conn.cursor()
+                if self.archive_name:
+                    cur.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+                cur.execute("begin")
+                # A separate cursor, so `fetch` still returns the result of the last query
+                stats_cur = conn.cursor()
+                stats = ModelStats()
+                if self._learned_keys:
+                    self._unarchive_learned_keys(stats_cur, stats)
+                for sql, values, account in self._execute_queue:
+                    if account is not None:
+                        account(stats_cur, stats)
+                    if sql is None:
+                        continue
+                    if values is None:
+                        cur.execute(sql)
+                    else:
+                        cur.execute(sql, values)
+                self._execute_queue.clear()
+                stats.write(stats_cur)
+                cur.execute("commit")
+                if self.warm_cache is not None:
+                    self.warm_cache.committed()
+                if fetch:
+                    return cur.fetchall()
 
-    def update_v2(self):
-        """Update the Database structure from a deprecated version to a newer one.
+    def _unarchive_learned_keys(self, cur: sqlite3.Cursor, stats: ModelStats) -> None:
+        """Move the keys that are about to be learned back from the archive, so new counts are added to the archived ones.
 
-        This update involves a typo.
+        Only keys that are actually archived are written, as writing to the archive at all makes the
+        transaction span two files, which is considerably slower to commit.
+        """
+        where = "word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY"
+        for table, word1, word2 in self._learned_keys:
+            if cur.execute(f"SELECT 1 FROM archive.MarkovGrammar WHERE {where} LIMIT 1;", (word1, word2)).fetchone():
+                stats.move(cur, "archive.MarkovGrammar", table, where, (word1, word2))
+                cur.execute(f"""
+                    INSERT INTO main.{table} (word1, word2, word3, count)
+                    SELECT word1, word2, word3, count FROM archive.MarkovGrammar WHERE {where}
+                    ON CONFLICT (word1, word2, word3) DO UPDATE SET count = count + excluded.count;""", (word1, word2))
+                cur.execute(f"DELETE FROM archive.MarkovGrammar WHERE {where};", (word1, word2))
+        self._learned_keys.clear()
+
+    def compacted(self, cutoff: float, scale: float, renormalized: bool, pruned: Optional[Dict[str, List[Tuple]]] = None) -> None:
+        """Called by Compactor after it removed n-grams with a stored count below `cutoff`.
+
+        Compactor only visits as many rows as fit in its time budget, so not every n-gram below
+        `cutoff` was necessarily removed. Clears the warm cache. Subclasses that keep learned data
+        elsewhere override this.
 
         Args:
-            channel (str): The name of the Twitch channel on which the bot is running.
+            cutoff (float): The stored count below which n-grams were removed.
+            scale (float): The current scale factor by which learned weights are multiplied.
+            renormalized (bool): Whether all stored counts were divided by the previous scale factor.
+            pruned (Optional[Dict[str, List[Tuple]]], optional): The words and stored counts of the removed
+                n-grams per table, e.g. {"MarkovGrammarAB": [("a", "b", "c", 0.5)]}, if `TRACK_PRUNED`. Defaults to None.
         """
-        # Resolve typo in Database
-        if self.execute("SELECT * FROM PRAGMA_TABLE_INFO('MarkovGrammarAA') WHERE name='occurances';", fetch=True):
-            logger.info("Updating Database to new version...")
-            for first_char in list(string.ascii_uppercase) + ["_"]:
-                for second_char in list(string.ascii_uppercase) + ["_"]:
-                    self.execute(
-                        f"ALTER TABLE MarkovGrammar{first_char}{second_char} RENAME COLUMN occurances TO count;")
-                self.execute(
-                    f"ALTER TABLE MarkovStart{first_char} RENAME COLUMN occurances TO count;")
-            logger.info("Finished Updating Database to new version.")
-
-    def update_v3(self, channel: str) -> None:
-        """Update the Database structure to mark punctuation as a separate word.
-
-        Previously, "Hello," was a valid single word. Now, it would be split as "Hello" and ",".
-        This allows people to generate "!g hello", and have the bot generate "hello, how are you?",
-        or have "!g it" result in "it's a wonderful day".
+        # Cached lookups may hold pruned n-grams, or counts with the previous scale
+        if self.warm_cache is not None:
+            self.warm_cache.clear()
 
-        This first copies `MarkovChain_{channel}.db` to `MarkovChain_{channel}_modified.db`.
-        This new copy is then modified. The original is never changed, to avoid issues when the
-        update is interrupted. As a result, running the program again will just re-attempt the
-        update. 
+    def flush(self) -> None:
+        """Write everything that was learned but not yet written to the database file.
 
-        Upon completing the update, the original database is renamed to 
-        `MarkovChain_{channel}_backup.db`, while the newly modified `MarkovChain_{channel}_modified.db`
-        is renamed to `MarkovChain_{channel}.db`.
-
-        *This `MarkovChain_{channel}_backup.db` file can safely be deleted, as it is NOT used*
+        Used on shutdown. Subclasses that keep learned data elsewhere override this.
+        """
+        self.execute_commit()
 
-        This function also adds a `Version` table, and sets the version to 3.
+    def model_stats(self) -> Dict[str, float]:
+        """Get the size of the model from the ModelStats table, with a single query.
 
-        Args:
-            channel (str): The name of the Twitch channel on which the bot is running.
+        Returns:
+            Dict[str, float]: The number of 3-grams and starts, their total effective counts,
+                the number of archived 3-grams, and the vocabulary size. See `ModelStats.summary`.
         """
+        with self.connect() as conn:
+            scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+            return ModelStats.summary(ModelStats.read(conn), scale)
 
-        # Get Database version. Throws OperationalError if the Version table does not exist,
-        # in which case we definitely want to upgrade.
-        try:
-            version = self.execute(
-                "SELECT version FROM Version ORDER BY version DESC LIMIT 1;", fetch=True)
-        except sqlite3.OperationalError:
-            version = []
-
-        # Whether to upgrade
-        if not version or version[0][0] < 3:
-            logger.info(
-                "Updating Database to new version - supports better punctuation handling.")
-
-            from shutil import copyfile
-            import os
-            from Tokenizer import tokenize
-            from nltk import ngrams
-            channel = channel.replace('#', '').lower()
-            copyfile(f"/app/db/MarkovChain_{channel}.db",
-                     f"/app/db/MarkovChain_{channel}_modified.db")
-            logger.info(
-                f"Created a copy of the database called \"MarkovChain_{channel}_modified.db\". The update will modify this file.")
-
-            # Temporarily set self.db_name to the modified one
-            self.db_name = f"/app/db/MarkovChain_{channel.replace('#', '').lower()}_modified.db"
-
-            # Create database tables.
-            for first_char in list(string.ascii_uppercase) + ["_"]:
-                table = f"MarkovStart{first_char}"
-                self.add_execute_queue(f"""
-                CREATE TABLE IF NOT EXISTS {table}_modified (
-                    word1 TEXT COLLATE NOCASE, 
-                    word2 TEXT COLLATE NOCASE, 
-                    count INTEGER, 
-                    PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY)
-                );
-                """, auto_commit=False)
-                for second_char in list(string.ascii_uppercase) + ["_"]:
-                    table = f"MarkovGrammar{first_char}{second_char}"
-                    self.add_execute_queue(f"""
-                    CREATE TABLE IF NOT EXISTS {table}_modified (
-                        word1 TEXT COLLATE NOCASE,
-                        word2 TEXT COLLATE NOCASE,
-                        word3 TEXT COLLATE NOCASE,
-                        count INTEGER,
-                        PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
-                    );
-                    """, auto_commit=False)
-            self.execute_commit()
+    def shard_weights(self) -> Dict[str, float]:
+        """Get the total stored count of every table, for picking a table to sample from.
 
-            def modify_start(table: str) -> None:
-                """Read all data from `table`, re-tokenize it, distribute the new first 2 tokens to _modified tables, and drop `table`.
-
-                Args:
-                    table (str): The name of the table to work on.
-                """
-                data = self.execute(f"SELECT * FROM {table};", fetch=True)
-                for tup in data:
-                    # Remove "count" from tup for now
-                    count = tup[-1]
-                    tup = tup[:-1]
-
-                    raw_string = " ".join(tup)
-                    tokenized = tokenize(raw_string)
-                    two_gram = tokenized[:2]
-                    # In case there was some issue in the previous Database 
-                    if len(two_gram) < 2:
-                        continue
-                    self.add_execute_queue(f'''
-                        INSERT OR REPLACE INTO MarkovStart{self.get_suffix(two_gram[0][0])}_modified (word1, word2, count)
-                        VALUES (?, ?, coalesce (
-                                (
-                                    SELECT count + {count} FROM MarkovStart{self.get_suffix(two_gram[0][0])}_modified
-                                    WHERE word1 = ? COLLATE BINARY
-                                    AND word2 = ? COLLATE BINARY
-                                ),
-                                1
-                            )
-                        )''',
-                                           values=two_gram + two_gram,
-                                           auto_commit=False)
-
-                self.execute(f"DROP TABLE {table};")
-
-            def modify_grammar(table: str) -> None:
-                """Read all data from `table`, re-tokenize it, distribute the new 3-grams to _modified tables, and drop `table`.
-
-                Args:
-                    table (str): The name of the table to work on.
-                """
-                data = self.execute(f"SELECT * FROM {table};", fetch=True)
-                for tup in data:
-                    # Remove "count" from tup for now
-                    count = tup[-1]
-                    tup = tup[:-1]
-
-                    # If ends on "<END>", ignore that in in the tuple, as we don't want it to get
-                    # tokenized.
-                    end = False
-                    if tup[-1] == "<END>":
-                        end = True
-                        tup = tup[:-1]
-
-                    raw_string = " ".join(tup)
-                    tokenized = tokenize(raw_string)
-
-                    # Re-add "<END>"
-                    if end:
-                        tokenized.append("<END>")
-
-                    for ngram in ngrams(tokenized, 3):
-                        # Filter out recursive case.
-                        if self.check_equal(ngram):
-                            continue
-                        self.add_execute_queue(f'''
-                        INSERT OR REPLACE INTO MarkovGrammar{self.get_suffix(ngram[0][0])}{self.get_suffix(ngram[1][0])}_modified (word1, word2, word3, count)
-                        VALUES (?, ?, ?, coalesce (
-                                (
-                                    SELECT count + {count} FROM MarkovGrammar{self.get_suffix(ngram[0][0])}{self.get_suffix(ngram[1][0])}_modified
-                                    WHERE word1 = ? COLLATE BINARY
-                                    AND word2 = ? COLLATE BINARY
-                                    AND word3 = ? COLLATE BINARY
-                                ),
-                                1
-                            )
-                        )''',
-                                               values=ngram + ngram,
-                                               auto_commit=False)
-
-                self.execute(f"DROP TABLE {table};")
-
-            # Modify all tables
-            i = 0
-            total = 27 * 27 + 27  # The number of tables to convert
-            for first_char in list(string.ascii_uppercase) + ["_"]:
-                table = f"MarkovStart{first_char}"
-                modify_start(table)
-                i += 1
-                for second_char in list(string.ascii_uppercase) + ["_"]:
-                    table = f"MarkovGrammar{first_char}{second_char}"
-                    modify_grammar(table)
-                    i += 1
-                logger.debug(
-                    f"[{i / total * 100:.2f}%] Scheduled updates for the tables for words starting in {first_char}.")
-            logger.info("Starting executing table update...")
-            self.execute_commit()
-            logger.info("Finished executing table update.")
+        The totals are read from ModelStats at most every `SHARD_WEIGHTS_TTL` seconds.
 
-            # Rename the _modified tables to normal tables again
-            for first_char in list(string.ascii_uppercase) + ["_"]:
-                table = f"MarkovStart{first_char}"
-                self.add_execute_queue(
-                    f"ALTER TABLE {table}_modified RENAME TO {table};", auto_commit=False)
-                for second_char in list(string.ascii_uppercase) + ["_"]:
-                    table = f"MarkovGrammar{first_char}{second_char}"
-                    self.add_execute_queue(
-                        f"ALTER TABLE {table}_modified RENAME TO {table};", auto_commit=False)
-            self.execute_commit()
+        Returns:
+            Dict[str, float]: The total per table name, e.g. "MarkovStartA" or "MarkovGrammarAB".
+                Empty if there are no statistics.
+        """
+        if time.monotonic() - self._shard_weights_read > self.SHARD_WEIGHTS_TTL:
+            CACHE_REQUESTS.inc(labels=("shard_weights", "miss"))
+            with self.connect() as conn:
+                self._shard_weights = {name: total for name, (_, total) in ModelStats.read(conn).items()}
+            self._shard_weights_read = time.monotonic()
+        else:
+            CACHE_REQUESTS.inc(labels=("shard_weights", "hit"))
+        return self._shard_weights
 
-            # Turn the non-modified, old version of the Database into a "_backup.db" file,
-            # and turn the modified file into the new main file.
-            os.rename(f"/app/db/MarkovChain_{channel}.db",
-                      f"/app/db/MarkovChain_{channel}_backup.db")
-            os.rename(f"/app/db/MarkovChain_{channel}_modified.db",
-                      f"/app/db/MarkovChain_{channel}.db")
+    def set_wal(self, enabled: bool) -> None:
+        """Switch the database file to write-ahead logging, or back to the default rollback journal.
 
-            # Revert to using .db instead of _modified.db
-            self.db_name = f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.db"
+        With write-ahead logging, reading never blocks writing, so e.g. `Backup` can copy the database
+        while it is being learned to. The journal mode is stored in the file itself.
 
-            # Add a version entry
-            self.execute("""CREATE TABLE IF NOT EXISTS Version (
-                    version INTEGER
+        Args:
+            enabled (bool): Whether to use write-ahead logging.
+        """
+        with self.connect() as conn:
+            mode = conn.execute(f"PRAGMA journal_mode = {'WAL' if enabled else 'DELETE'};").fetchone()[0]
+        logger.debug(f"Journal mode of {self.db_name} is {mode}.")
+
+    def enable_archive(self) -> None:
+        """Create the archive for rarely used 3-grams, `MarkovChain_{channel}_archive.db`, if it does not exist yet.
+
+        The archive holds a single MarkovGrammar table, with an index for case insensitive lookups,
+        and is attached as "archive" to every connection that writes. A single table keeps attaching cheap,
+        as SQLite parses the schema of every attached database. `archive_cold` moves keys that were not used
+        recently and have a low total count into it, which keeps the main database and its page cache small.
+        Lookups only read the archive when the key is not in the main database, and move the key
+        back to the main database when it is found there.
+        """
+        archive_name = self.db_name[:-3] + "_archive.db"
+        if not os.path.isfile(archive_name):
+            logger.info(f"Creating archive {archive_name}...")
+            with sqlite3.connect(archive_name) as conn:
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS MarkovGrammar (
+                    word1 TEXT COLLATE NOCASE,
+                    word2 TEXT COLLATE NOCASE,
+                    word3 TEXT COLLATE NOCASE,
+                    count INTEGER,
+                    PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
                 );""")
-            self.execute("DELETE FROM Version;")
-            self.execute("INSERT INTO Version (version) VALUES (3);")
+                conn.execute("CREATE INDEX IF NOT EXISTS MarkovGrammarNocase ON MarkovGrammar (word1, word2);")
+        self.archive_name = archive_name
 
-            logger.info(
-                f"Renamed original database file \"MarkovChain_{channel}.db\" to \"MarkovChain_{channel}_backup.db\". This file is *not* used, and can safely be deleted.")
-            logger.info(
-                f"Renamed updated database file \"MarkovChain_{channel}_modified.db\" to \"MarkovChain_{channel}.db\".")
-            logger.info(
-                f"This updated \"MarkovChain_{channel}.db\" will be used to drive the Twitch bot.")
-
-    def add_execute_queue(self, sql: str, values: Tuple[Any] = None, auto_commit: bool = True) -> None:
-        """Add query and corresponding values to a queue, to be executed all at once.
-
-        This entire queue can be executed with `self.execute_commit`, 
-        and the queue is automatically executed if there are more than 25 waiting queries.
+    def archive_lookup(self, table: str, columns: str, where: str, values: Tuple[Any], promote: bool = False) -> List[Tuple[Any]]:
+        """Select `columns` from the archived copy of `table`, for a key that is not in the main database.
 
         Args:
-            sql (str): The SQL query to add, potentially with "?" for where 
-                a value ought to be filled in.
-            values ([Tuple[Any]], optional): Optional tuple of values to replace "?" in SQL queries.
-                Defaults to None.
-        """
-        if values is not None:
-            self._execute_queue.append([sql, values])
-        else:
-            self._execute_queue.append([sql])
-        # Commit these executes if there are more than 25 queries
-        if auto_commit and len(self._execute_queue) > 25:
-            self.execute_commit()
+            table (str): The name of the MarkovGrammar table in the main database to move the key back to.
+            columns (str): The columns to select.
+            where (str): The condition of the query, in which the first two values are word1 and word2.
+            values (Tuple[Any]): The values to replace "?" in `where`.
+            promote (bool, optional): Whether to move all rows of the key back to the main database
+                if it was found, as it is in use again. Defaults to False.
 
-    def execute_commit(self, fetch: bool = False) -> Any:
-        """Execute the SQL queries added to the queue with `self.add_execute_queue`.
+        Returns:
+            List[Tuple[Any]]: The selected rows.
+        """
+        with self.connect() as conn:
+            conn.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+            data = conn.execute(f"SELECT {columns} FROM archive.MarkovGrammar WHERE {where};", values).fetchall()
+            if data and promote:
+                key = tuple(values[:2])
+                stats = ModelStats()
+                stats.move(conn.cursor(), "archive.MarkovGrammar", table, "word1 = ? AND word2 = ?", key)
+                conn.execute(f"""
+                    INSERT INTO main.{table} (word1, word2, word3, count)
+                    SELECT word1, word2, word3, count FROM archive.MarkovGrammar WHERE word1 = ? AND word2 = ?
+                    ON CONFLICT (word1, word2, word3) DO UPDATE SET count = count + excluded.count;""", key)
+                conn.execute("DELETE FROM archive.MarkovGrammar WHERE word1 = ? AND word2 = ?;", key)
+                stats.write(conn.cursor())
+                self.hot_keys.add((key[0].lower(), key[1].lower()))
+        return data
+
+    def archive_cold(self, threshold: float, time_budget: float) -> int:
+        """Move cold keys from the main database to the archive, for at most `time_budget` seconds.
+
+        A key is cold if the sum of the effective counts of its 3-grams is below `threshold`, it was not used
+        since the previous call, and none of its 3-grams are among the most recently inserted tenth of its table.
+        Tables are processed one at a time, each in a single transaction, and the next call continues
+        with the table where this one stopped.
 
         Args:
-            fetch (bool, optional): Whether to return the fetchall() of the SQL queries.
-                Defaults to False.
+            threshold (float): The effective count below which keys are archived.
+            time_budget (float): The maximum number of seconds to spend.
 
         Returns:
-            Any: The returned values from the SQL queries if `fetch` is true, otherwise None.
+            int: The number of 3-grams that were moved.
         """
-        if self._execute_queue:
-            with sqlite3.connect(self.db_name) as conn:
-                cur = conn.cursor()
-                cur.execute("begin")
-                for sql in self._execute_queue:
-                    cur.execute(*sql)
-                self._execute_queue.clear()
-                cur.execute("commit")
-                if fetch:
-                    return cur.fetchall()
+        if not self.archive_name:
+            return 0
+        start = time.monotonic()
+        self.execute_commit()
+        tables = [f"MarkovGrammar{character1}{character2}"
+                  for character1 in list(string.ascii_uppercase) + ["_"]
+                  for character2 in list(string.ascii_uppercase) + ["_"]]
+        hot_keys, self.hot_keys = self.hot_keys, set()
+        moved = 0
+        visited = 0
+        # Autocommit mode, so every table is its own transaction
+        conn = self.connect(isolation_level=None)
+        try:
+            conn.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+            conn.execute("CREATE TEMP TABLE HotKeys (word1 TEXT COLLATE NOCASE, word2 TEXT COLLATE NOCASE);")
+            conn.execute("CREATE TEMP TABLE ColdKeys (word1 TEXT COLLATE NOCASE, word2 TEXT COLLATE NOCASE);")
+            conn.executemany("INSERT INTO temp.HotKeys VALUES (?, ?);", hot_keys)
+            cutoff = threshold * conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+            while visited < len(tables) and time.monotonic() - start < time_budget:
+                table = tables[self._archive_cursor]
+                conn.execute("BEGIN IMMEDIATE;")
+                max_rowid = conn.execute(f"SELECT max(rowid) FROM main.{table};").fetchone()[0] or 0
+                conn.execute("DELETE FROM temp.ColdKeys;")
+                conn.execute(f"""
+                    INSERT INTO temp.ColdKeys
+                    SELECT word1, word2 FROM main.{table} GROUP BY word1, word2
+                    HAVING sum(count) < ? AND max(rowid) <= ?;""", (cutoff, int(max_rowid * 0.9)))
+                conn.execute("DELETE FROM temp.ColdKeys WHERE (word1, word2) IN (SELECT word1, word2 FROM temp.HotKeys);")
+                where = "(word1, word2) IN (SELECT word1, word2 FROM temp.ColdKeys)"
+                stats = ModelStats()
+                stats.move(conn.cursor(), table, "archive.MarkovGrammar", where)
+                conn.execute(f"""
+                    INSERT INTO archive.MarkovGrammar (word1, word2, word3, count)
+                    SELECT word1, word2, word3, count FROM main.{table} WHERE {where}
+                    ON CONFLICT (word1, word2, word3) DO UPDATE SET count = count + excluded.count;""")
+                moved += conn.execute(f"DELETE FROM main.{table} WHERE {where};").rowcount
+                stats.write(conn.cursor())
+                conn.execute("COMMIT;")
+                self._archive_cursor = (self._archive_cursor + 1) % len(tables)
+                visited += 1
+        finally:
+            conn.close()
+        logger.info(f"Moved {moved} 3-grams from {visited} tables of {self.db_name} to the archive "
+                    f"in {time.monotonic() - start:.2f} seconds.")
+        return moved
 
+    @DB_SECONDS.time(("execute",))
+    @profiled("execute", lambda db, *args, **kwargs: db.channel)
     def execute(self, sql: str, values: Tuple[Any] = None, fetch: bool = False):
         """Execute the SQL query with the corresponding values, potentially returning a result.
 
@@ -521,7 +598,7 @@ class Database:
         Returns:
             Any: The returned values from the SQL queries if `fetch` is true, otherwise None.
         """
-        with sqlite3.connect(self.db_name) as conn:
+        with self.connect() as conn:
             cur = conn.cursor()
             if values is None:
                 cur.execute(sql)
@@ -603,7 +680,7 @@ class Database:
     def get_next(self, index: int, words: List[str]) -> Optional[str]:
         """Generate the next word in the sentence using learned data, given the previous `key_length` words.
 
-        `key_length` is set to 2 by default, and cannot easily be changed.
+        `key_length` is always 2 for this class. See `TrieDatabase` for other key lengths.
 
         Args:
             index (int): The index of this new word in the sentence.
@@ -612,19 +689,14 @@ class Database:
         Returns:
             Optional[str]: The next word in the sentence, generated given the learned data.
         """
-        # Get all items
-        data = self.execute(f"""
-            SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[0][0])}{self.get_suffix(words[1][0])}
-            WHERE word1 = ? AND word2 = ?;""",
-                            values=words,
-                            fetch=True)
+        data = self.successors(words)
         # Return a word picked from the data, using count as a weighting factor
         return None if len(data) == 0 else self.pick_word(data, index)
 
     def get_next_initial(self, index: int, words) -> Optional[str]:
         """Generate the next word in the sentence using learned data, given the previous `key_length` words.
 
-        `key_length` is set to 2 by default, and cannot easily be changed.
+        `key_length` is always 2 for this class. See `TrieDatabase` for other key lengths.
         Similar to `get_next`, with the exception that it cannot immediately generate "<END>"
 
         Args:
@@ -634,19 +706,65 @@ class Database:
         Returns:
             Optional[str]: The next word in the sentence, generated given the learned data.
         """
+        data = self.successors(words, allow_end=False)
+        # Return a word picked from the data, using count as a weighting factor
+        return None if len(data) == 0 else self.pick_word(data, index)
+
+    def successors(self, words: List[str], allow_end: bool = True) -> List[Tuple[str, float]]:
+        """Get every word that followed `words`, with its count, from the warm cache if it is enabled.
+
+        Args:
+            words (List[str]): The previous 2 words.
+            allow_end (bool, optional): Whether to include "<END>". Defaults to True.
+
+        Returns:
+            List[Tuple[str, float]]: The (word3, count) pairs, e.g. [("you", 3), ("<END>", 1)].
+        """
+        if self.archive_name:
+            self.hot_keys.add((words[0].lower(), words[1].lower()))
+        if self.warm_cache is None:
+            return self.select_successors(words, allow_end)
+        # The cache holds all successors, so that get_next and get_next_initial share its entries
+        key = WarmCache.next_key(words)
+        data, version = self.warm_cache.get(key)
+        if data is None:
+            data = self.select_successors(words)
+            self.warm_cache.put(key, data, version)
+        return data if allow_end else [row for row in data if row[0] != "<END>"]
+
+    def select_successors(self, words: List[str], allow_end: bool = True, conn: Optional[sqlite3.Connection] = None) -> List[Tuple[str, float]]:
+        """Query every word that followed `words`, with its count, see `successors`.
+
+        Keys that are only in the archive are moved back to the main database, unless `conn` is given.
+
+        Args:
+            words (List[str]): The previous 2 words.
+            allow_end (bool, optional): Whether to include "<END>". Defaults to True.
+            conn (Optional[sqlite3.Connection], optional): The connection to use, to avoid opening
+                one per query when querying many keys. Defaults to None, i.e. a new connection.
+
+        Returns:
+            List[Tuple[str, float]]: The (word3, count) pairs.
+        """
+        table = f"MarkovGrammar{self.get_suffix(words[0][0])}{self.get_suffix(words[1][0])}"
+        where = "word1 = ? AND word2 = ?" if allow_end else "word1 = ? AND word2 = ? AND word3 != '<END>'"
+        if conn is not None:
+            return conn.execute(f"SELECT word3, count FROM {table} WHERE {where};", words).fetchall()
         # Get all items
         data = self.execute(f"""
-            SELECT word3, count FROM MarkovGrammar{self.get_suffix(words[0][0])}{self.get_suffix(words[1][0])}
-            WHERE word1 = ? AND word2 = ? AND word3 != '<END>';""",
+            SELECT word3, count FROM {table}
+            WHERE {where};""",
                             values=words,
                             fetch=True)
-        # Return a word picked from the data, using count as a weighting factor
-        return None if len(data) == 0 else self.pick_word(data, index)
+        if len(data) == 0 and self.archive_name:
+            data = self.archive_lookup(table, "word3, count", where, words, promote=True)
+        return data
 
     def get_next_single_initial(self, index: int, word: str) -> Optional[List[str]]:
         """Generate the next word in the sentence using learned data, given the previous word.
 
-        Randomly picks a start character for the second word by weighing all uppercase letters and "_" with their word frequency.
+        Randomly picks a start character for the second word by weighing all uppercase letters and "_" with the total count
+        of their table in ModelStats, or with their word frequency if there are no statistics.
 
         Args:
             index (int): The index of this new word in the sentence.
@@ -656,15 +774,22 @@ class Database:
             Optional[List[str]]: The previous and newly generated word in the sentence as a list, generated given the learned data.
                 So, the previous word is taken directly the input of this method, and the second word is generated.
         """
-        # Randomly pick first character for the second word
-        char_two = random.choices(string.ascii_uppercase + '_',
-                                  weights=self.word_frequency)[0]
+        # Randomly pick first character for the second word, weighted by the total count of the tables
+        suffixes = string.ascii_uppercase + '_'
+        totals = self.shard_weights()
+        weights = [totals.get(f"MarkovGrammar{self.get_suffix(word[0])}{char_two}", 0) for char_two in suffixes]
+        char_two = self.random.choices(suffixes, weights=weights if any(weights) else self.word_frequency)[0]
+        table = f"MarkovGrammar{self.get_suffix(word[0])}{char_two}"
         # Get all items
         data = self.execute(f"""
-            SELECT word2, count FROM MarkovGrammar{self.get_suffix(word[0])}{char_two}
+            SELECT word2, count FROM {table}
             WHERE word1 = ? AND word2 != '<END>';""",
                             values=(word,),
                             fetch=True)
+        if len(data) == 0 and self.archive_name:
+            # The archive is not split up by first character, so filter on the picked character instead
+            character = "NOT BETWEEN 'A' AND 'Z'" if char_two == "_" else f"= '{char_two}'"
+            data = self.archive_lookup(table, "word2, count", f"word1 = ? AND word2 != '<END>' AND upper(substr(word2, 1, 1)) {character}", (word,))
         # Return a word picked from the data, using count as a weighting factor
         return None if len(data) == 0 else [word] + [self.pick_word(data, index)]
 
@@ -702,7 +827,7 @@ class Database:
         Returns:
             str: The pseudo-randomly picked word.
         """
-        return random.choices(data,
+        return self.random.choices(data,
                               weights=[
                                   tup[-1] * ((index+1)/15)
                                   if tup[0] == "<END>" else
@@ -719,27 +844,47 @@ class Database:
         Returns:
             List[str]: A list of two starting words, such as ["I", "am"].
         """
-        # Find one character start from
-        character = random.choices(list(string.ascii_lowercase) + ["_"],
-                                   weights=self.word_frequency,
+        # Find one character start from, weighted by the total count of the tables,
+        # so that every start is picked in proportion to its count
+        characters = list(string.ascii_uppercase) + ["_"]
+        totals = self.shard_weights()
+        weights = [totals.get(f"MarkovStart{character}", 0) for character in characters]
+        character = self.random.choices(characters,
+                                   weights=weights if any(weights) else self.word_frequency,
                                    k=1)[0]
 
         # Get all first word, second word, frequency triples,
         # e.g. [("I", "am", 3), ("You", "are", 2), ...]
-        data = self.execute(
-            f"SELECT * FROM MarkovStart{character};",
-            fetch=True)
+        if self.warm_cache is None:
+            data = self.select_starts(character)
+        else:
+            key = WarmCache.start_key(character)
+            data, version = self.warm_cache.get(key)
+            if data is None:
+                data = self.select_starts(character)
+                self.warm_cache.put(key, data, version)
 
         # If nothing has ever been said
         if len(data) == 0:
             return []
 
         # Return a (weighted) randomly chosen 2-gram
-        return list(random.choices(data,
+        return list(self.random.choices(data,
                                    weights=[tup[-1] for tup in data],
                                    k=1)[0][:-1])
 
-    def add_rule_queue(self, item: List[str]) -> None:
+    def select_starts(self, character: str, conn: Optional[sqlite3.Connection] = None) -> List[Tuple[str, str, float]]:
+        """Query every start in MarkovStart{character}, with its count, e.g. [("I", "am", 3), ("It", "is", 2)].
+
+        Args:
+            character (str): The suffix of the table, i.e. an uppercase letter or "_".
+            conn (Optional[sqlite3.Connection], optional): The connection to use. Defaults to None, i.e. a new connection.
+        """
+        if conn is not None:
+            return conn.execute(f"SELECT * FROM MarkovStart{character};").fetchall()
+        return self.execute(f"SELECT * FROM MarkovStart{character};", fetch=True)
+
+    def add_rule_queue(self, item: List[str], weight: int = 1) -> None:
         """Adds a rule to the queue, ready to be entered into the knowledge base, given a 3-gram `item`.
 
         The rules on the queue are added with `self.add_execute_queue`, 
@@ -754,6 +899,7 @@ class Database:
                 *Given ["How", "are"], then "you" is a potential output*
                 The frequency of this word as an output is then incremented, 
                 allowing for weighted picking of outputs.
+            weight (int, optional): The amount to increment the frequency by. Defaults to 1.
         """
         # Filter out recursive case.
         if self.check_equal(item):
@@ -762,18 +908,16 @@ class Database:
             logger.warning(
                 f"Failed to add item to rules. Item contains empty string: {item!r}")
             return
-        self.add_execute_queue(f'''
-            INSERT OR REPLACE INTO MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])} (word1, word2, word3, count)
-            VALUES (?, ?, ?, coalesce(
-                (
-                    SELECT count + 1 FROM MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])}
-                    WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY AND word3 = ? COLLATE BINARY
-                ),
-                1)
-            )''',
-                               values=item + item)
-
-    def add_start_queue(self, item: List[str]) -> None:
+        if self.archive_name:
+            # Moved back from the archive by `execute_commit` if it is there
+            self._learned_keys.add((f"MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])}", item[0], item[1]))
+            self.hot_keys.add((item[0].lower(), item[1].lower()))
+        if self.warm_cache is not None:
+            self.warm_cache.learned(WarmCache.next_key(item))
+        table = f"MarkovGrammar{self.get_suffix(item[0][0])}{self.get_suffix(item[1][0])}"
+        self.add_execute_queue(None, account=lambda cur, stats, item=tuple(item): self._learn(cur, stats, table, item, weight))
+
+    def add_start_queue(self, item: List[str], weight: int = 1) -> None:
         """Adds a rule to the queue, ready to be entered into the knowledge base, given a 2-gram `item`.
 
         The rules on the queue are added with `self.add_execute_queue`, 
@@ -783,17 +927,27 @@ class Database:
             item (List[str]): A 2-gram, e.g. ['How', 'are']. This is learned by placing this
                 in the MarkovStartH table, where it can be randomly (with frequency as weight)
                 picked as a start of a sentence.
+            weight (int, optional): The amount to increment the frequency by. Defaults to 1.
         """
-        self.add_execute_queue(f'''
-            INSERT OR REPLACE INTO MarkovStart{self.get_suffix(item[0][0])} (word1, word2, count)
-            VALUES (?, ?, coalesce(
-                (
-                    SELECT count + 1 FROM MarkovStart{self.get_suffix(item[0][0])}
-                    WHERE word1 = ? COLLATE BINARY AND word2 = ? COLLATE BINARY
-                ),
-                1)
-            )''',
-                               values=item + item)
+        table = f"MarkovStart{self.get_suffix(item[0][0])}"
+        self.add_execute_queue(None, account=lambda cur, stats, item=tuple(item): self._learn(cur, stats, table, item, weight))
+
+    def _learn(self, cur: sqlite3.Cursor, stats: ModelStats, table: str, item: Tuple[str, ...], weight: float, scaled: bool = False) -> None:
+        """Add `weight` times the decay scale to the count of the n-gram `item` in `table`, and account for it in `stats`.
+
+        Inserting is tried first, as most learned n-grams are new. Whether it inserted a row tells
+        ModelStats whether the n-gram is new, without an extra query. If `scaled`, `weight` was
+        already multiplied by the decay scale, and is added as is.
+        """
+        columns = ("word1", "word2", "word3")[:len(item)]
+        value = "?" if scaled else "? * (SELECT scale FROM Decay)"
+        cur.execute(f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}, count) VALUES ({'?, ' * len(item)}{value});",
+                    (*item, weight))
+        new = cur.rowcount == 1
+        if not new:
+            cur.execute(f"UPDATE {table} SET count = count + {value} WHERE "
+                        + " AND ".join(f"{column} = ? COLLATE BINARY" for column in columns) + ";", (weight, *item))
+        stats.learned(table, item, weight if scaled else weight * stats.scale(cur), new)
 
     def unlearn(self, message: str) -> None:
         """Remove frequency of 3-grams from `message` from the knowledge base.
@@ -815,55 +969,77 @@ class Database:
 
         # Unlearn start of sentence from MarkovStart
         if len(words) > 1:
+            table = f"MarkovStart{self.get_suffix(words[0][0])}"
+            values = (words[0], words[1])
             # Reduce "count" by 5
             self.add_execute_queue(f'''
-                UPDATE MarkovStart{self.get_suffix(words[0][0])}
-                SET count = count - 5
+                UPDATE {table}
+                SET count = count - 5 * (SELECT scale FROM Decay)
                 WHERE word1 = ? AND word2 = ?;''',
-                                   values=(words[0], words[1],))
+                                   values=values,
+                                   account=lambda cur, stats, table=table, values=values:
+                                       stats.change(cur, table, "word1 = ? AND word2 = ?", values, -5 * stats.scale(cur)))
             # Delete if count is now less than 0.
             self.add_execute_queue(f'''
-                DELETE FROM MarkovStart{self.get_suffix(words[0][0])}
+                DELETE FROM {table}
                 WHERE word1 = ? AND word2 = ? AND count <= 0;''',
-                                   values=(words[0], words[1],))
+                                   values=values,
+                                   account=lambda cur, stats, table=table, values=values:
+                                       stats.delete(cur, table, "word1 = ? AND word2 = ? AND count <= 0", values))
 
-        # Unlearn all 3 word sections from Grammar
+        # Unlearn all 3 word sections from Grammar, and from the archive if there is one
         for (word1, word2, word3) in tuples:
-            # Reduce "count" by 5
-            self.add_execute_queue(f'''
-                UPDATE MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}
-                SET count = count - 5
-                WHERE word1 = ? AND word2 = ? AND word3 = ?;''',
-                                   values=(word1, word2, word3,))
-            # Delete if count is now less than 0.
-            self.add_execute_queue(f'''
-                DELETE FROM MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}
-                WHERE word1 = ? AND word2 = ? AND word3 = ? AND count <= 0;''',
-                                   values=(word1, word2, word3, ))
+            tables = [f"MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}"]
+            if self.archive_name:
+                tables.append("archive.MarkovGrammar")
+            for table in tables:
+                values = (word1, word2, word3)
+                # Reduce "count" by 5
+                self.add_execute_queue(f'''
+                    UPDATE {table}
+                    SET count = count - 5 * (SELECT scale FROM Decay)
+                    WHERE word1 = ? AND word2 = ? AND word3 = ?;''',
+                                       values=values,
+                                       account=lambda cur, stats, table=table, values=values:
+                                           stats.change(cur, table, "word1 = ? AND word2 = ? AND word3 = ?", values, -5 * stats.scale(cur)))
+                # Delete if count is now less than 0.
+                self.add_execute_queue(f'''
+                    DELETE FROM {table}
+                    WHERE word1 = ? AND word2 = ? AND word3 = ? AND count <= 0;''',
+                                       values=values,
+                                       account=lambda cur, stats, table=table, values=values:
+                                           stats.delete(cur, table, "word1 = ? AND word2 = ? AND word3 = ? AND count <= 0", values))
 
         self.execute_commit()
+        if self.warm_cache is not None:
+            self.warm_cache.clear()
 
     def purge_word(self, target_word: str) -> None:
         target_word = target_word.strip()
         suffixes = [chr(c) for c in range(ord('A'), ord('Z') + 1)] + ["_"]
     
-        for s1 in suffixes:
-            for s2 in suffixes:
-                table = f"MarkovGrammar{s1}{s2}"
-                try:
-                    self.add_execute_queue(
-                        f"DELETE FROM {table} WHERE word1=? OR word2=? OR word3=?;",
-                        (target_word, target_word, target_word)
-                    )
-                except Exception:
-                    continue
+        tables = [f"MarkovGrammar{s1}{s2}" for s1 in suffixes for s2 in suffixes]
+        if self.archive_name:
+            tables.append("archive.MarkovGrammar")
+        for table in tables:
+            try:
+                self.add_execute_queue(
+                    f"DELETE FROM {table} WHERE word1=? OR word2=? OR word3=?;",
+                    (target_word, target_word, target_word),
+                    account=lambda cur, stats, table=table:
+                        stats.delete(cur, table, "word1=? OR word2=? OR word3=?", (target_word,) * 3)
+                )
+            except Exception:
+                continue
     
         for s in suffixes:
             table = f"MarkovStart{s}"
             try:
                 self.add_execute_queue(
                     f"DELETE FROM {table} WHERE word1=? OR word2=?;",
-                    (target_word, target_word)
+                    (target_word, target_word),
+                    account=lambda cur, stats, table=table:
+                        stats.delete(cur, table, "word1=? OR word2=?", (target_word,) * 2)
                 )
             except Exception:
                 continue
@@ -871,5 +1047,7 @@ class Database:
         try:
             result = self.execute_commit()
             logger.info(f"purge_word('{target_word}') result: {result}")
+            if self.warm_cache is not None:
+                self.warm_cache.clear()
         except Exception as e:
             logger.error(f"Error executing purge_word('{target_word}'): {e}")
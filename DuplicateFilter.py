@@ -0,0 +1,152 @@
+import hashlib, random, re, time
+from array import array
+from typing import Optional
+
+class DuplicateFilter:
+    """
+    Suppresses learning from the same message being repeated many times, e.g. during raids,
+    emote walls or copypasta.
+
+    Normalized messages are counted in a count-min sketch. Two sketches are kept: the current one,
+    and the previous one. Every `window` seconds the previous sketch is dropped, and the current
+    one becomes the previous one. The estimated number of repeats of a message is the sum of both
+    sketches, i.e. the number of repeats within the last `window` to `2 * window` seconds.
+
+    A sketch that is too narrow for the number of messages in a window overestimates the repeats
+    of unique messages, and would drop them. So the current sketch is sized from the number of
+    messages in the previous window, and is rebuilt twice as wide from the digests of its messages
+    whenever it gets more than `width / CELLS_PER_MESSAGE` messages. Memory grows with the
+    message rate, at roughly 80 bytes per message in a window.
+
+    The first `threshold` repeats of a message are always learned. After that, the message is
+    either dropped entirely ("drop" mode), or learned with a probability of 1 / (n - threshold + 1)
+    for the n-th repeat ("reduce" mode), so its expected weight decreases the more it is repeated.
+    """
+    # Remove everything except letters, digits and whitespace
+    NORMALIZE_REGEX = re.compile(r"[^\w\s]+")
+    # Collapse immediately repeated words, e.g. "Kappa Kappa Kappa" to "Kappa"
+    REPEAT_REGEX = re.compile(r"\b(\w+)(?:\s+\1\b)+")
+    # The number of counters per row of a sketch for every message counted in it. Each counter
+    # then holds at most 0.25 messages on average, so unique messages are practically never dropped
+    CELLS_PER_MESSAGE = 4
+
+    def __init__(self, threshold: int, window: float, mode: str = "drop", width: int = 2048, depth: int = 4) -> None:
+        """Create a DuplicateFilter.
+
+        Args:
+            threshold (int): The number of repeats that are learned normally. 0 disables the filter.
+            window (float): The number of seconds after which the sketches rotate.
+            mode (str, optional): Either "drop" or "reduce". Defaults to "drop".
+            width (int, optional): The minimum number of counters per row of a sketch. Defaults to 2048.
+            depth (int, optional): The number of rows of the sketches, at most 8. Defaults to 4.
+        """
+        self.threshold = threshold
+        self.window = window
+        self.mode = mode
+        self.width = width
+        self.depth = depth
+        self.current = self.sketch(width)
+        self.current_width = width
+        self.previous = self.sketch(width)
+        self.previous_width = width
+        # The digests of the messages counted in the current sketch, to rebuild it when it grows
+        self.digests = bytearray()
+        self.rotated_at = time.monotonic()
+
+        # Statistics, reset by the maintenance task
+        self.suppressed = 0
+        self.writes_avoided = 0
+
+    def sketch(self, width: int) -> array:
+        """Create an empty sketch with `width` counters per row."""
+        return array("I", bytes(4 * width * self.depth))
+
+    def fit(self, messages: int) -> int:
+        """Get the width of a sketch for `messages` messages, a power of two times the minimum width."""
+        width = self.width
+        while width < self.CELLS_PER_MESSAGE * messages:
+            width *= 2
+        return width
+
+    def index(self, digest: bytes, row: int, width: int) -> int:
+        """Get the index of the counter of `digest` in `row` of a sketch with `width` counters per row."""
+        return row * width + int.from_bytes(digest[4 * row: 4 * row + 4], "little") % width
+
+    def count(self, digest: bytes) -> None:
+        """Count `digest` in the current sketch."""
+        for row in range(self.depth):
+            index = self.index(digest, row, self.current_width)
+            if self.current[index] < 0xFFFFFFFF:
+                self.current[index] += 1
+
+    def grow(self) -> None:
+        """Rebuild the current sketch twice as wide, from the digests of the messages counted in it."""
+        self.current_width *= 2
+        self.current = self.sketch(self.current_width)
+        size = 4 * self.depth
+        for start in range(0, len(self.digests), size):
+            self.count(self.digests[start: start + size])
+
+    def rotate(self, now: float) -> None:
+        """Drop the previous sketch, and start a new current sketch sized for the messages of the last window."""
+        messages = len(self.digests) // (4 * self.depth)
+        if now - self.rotated_at < 2 * self.window:
+            self.previous, self.previous_width = self.current, self.current_width
+        else:
+            # Drop the previous sketch entirely if more than two windows have passed
+            self.previous_width = self.width
+            self.previous = self.sketch(self.previous_width)
+            messages = 0
+        self.current_width = self.fit(messages)
+        self.current = self.sketch(self.current_width)
+        self.digests = bytearray()
+        self.rotated_at = now
+
+    def normalize(self, message: str) -> str:
+        """Normalize `message` so that trivial variations of a copypasta are counted together.
+
+        Args:
+            message (str): The message to normalize.
+
+        Returns:
+            str: The lowercased message without punctuation and without repeated words.
+        """
+        message = self.NORMALIZE_REGEX.sub(" ", message.lower())
+        message = self.REPEAT_REGEX.sub(r"\1", message)
+        return " ".join(message.split())
+
+    def admit(self, message: str, now: Optional[float] = None) -> bool:
+        """Count `message`, and return whether it should be learned.
+
+        Args:
+            message (str): The message that is about to be learned.
+            now (Optional[float], optional): The current time.monotonic(). Defaults to None.
+
+        Returns:
+            bool: True if the message should be learned.
+        """
+        if self.threshold <= 0:
+            return True
+
+        if now is None:
+            now = time.monotonic()
+        if now - self.rotated_at >= self.window:
+            self.rotate(now)
+
+        digest = hashlib.blake2b(self.normalize(message).encode("utf-8"), digest_size=4 * self.depth).digest()
+        if (len(self.digests) // (4 * self.depth) + 1) * self.CELLS_PER_MESSAGE > self.current_width:
+            self.grow()
+        self.digests += digest
+        self.count(digest)
+        count = min(self.current[self.index(digest, row, self.current_width)] +
+                    self.previous[self.index(digest, row, self.previous_width)] for row in range(self.depth))
+
+        if count <= self.threshold:
+            return True
+        if self.mode == "reduce" and random.random() < 1 / (count - self.threshold + 1):
+            return True
+
+        self.suppressed += 1
+        # A message of n words results in roughly n queued writes: one start and n - 1 rules
+        self.writes_avoided += len(message.split())
+        return False
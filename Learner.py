@@ -0,0 +1,79 @@
+import logging
+from typing import List
+
+from nltk.tokenize import sent_tokenize
+
+from Database import Database
+from Tokenizer import tokenize
+
+logger = logging.getLogger(__name__)
+
+def learn(db: Database, message: str, key_length: int, weight: int = 1) -> int:
+    """Tokenize `message` and queue its start and grammar rules into `db`.
+
+    The queued rules are automatically executed by `db` when enough queries are waiting,
+    and can be forced with `db.execute_commit()`.
+
+    Args:
+        db (Database): The Database to learn into.
+        message (str): The (already admitted and emote-stripped) message to learn.
+        key_length (int): The number of words used as a key in the grammar.
+        weight (int, optional): The amount to increment the frequencies by. Defaults to 1.
+
+    Returns:
+        int: The number of sentences that were learned.
+    """
+    # Try to split up sentences. Requires nltk's 'punkt' resource
+    try:
+        sentences = sent_tokenize(message.strip())
+    except:
+        logger.warning(f"Failed to tokenize {message}")
+        return 0
+
+    learned = 0
+    for sentence in sentences:
+        # Get all seperate words
+        words = tokenize(sentence)
+        # Double spaces will lead to invalid rules. We remove empty words here
+        if "" in words:
+            words = [word for word in words if word]
+        if learn_words(db, words, key_length, weight):
+            learned += 1
+    return learned
+
+def learn_words(db: Database, words: List[str], key_length: int, weight: int = 1) -> bool:
+    """Queue the start and grammar rules of a single tokenized sentence into `db`.
+
+    Args:
+        db (Database): The Database to learn into.
+        words (List[str]): The words of the sentence, as returned by `tokenize`.
+        key_length (int): The number of words used as a key in the grammar.
+        weight (int, optional): The amount to increment the frequencies by. Defaults to 1.
+
+    Returns:
+        bool: Whether the sentence was learned, i.e. was longer than `key_length` words.
+    """
+    # If the sentence is too short, ignore it
+    if len(words) <= key_length:
+        return False
+
+    # Add a new starting point for a sentence to the <START>
+    db.add_start_queue([words[x] for x in range(key_length)], weight)
+
+    # Create Key variable which will be used as a key in the Dictionary for the grammar
+    key: List[str] = list()
+    for word in words:
+        # Set up key for first use
+        if len(key) < key_length:
+            key.append(word)
+            continue
+
+        db.add_rule_queue(key + [word], weight)
+
+        # Remove the first word, and add the current word,
+        # so that the key is correct for the next word.
+        key.pop(0)
+        key.append(word)
+    # Add <END> at the end of the sentence
+    db.add_rule_queue(key + ["<END>"], weight)
+    return True
@@ -0,0 +1,201 @@
+import logging, multiprocessing, queue, threading, time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+def _worker_main(task_queue: multiprocessing.Queue, ack_queue: multiprocessing.Queue, key_lengths: Dict[str, int]) -> None:
+    """Entry point of the learning worker process.
+
+    Reads `(seq, command, channel, payload)` tasks from `task_queue`, and performs them on the
+    Database of `channel`. After every batch, all Databases are committed, and the sequence number
+    of the last task in the batch is put on `ack_queue`, alongside the number of seconds spent on
+    the batch and the number of tasks in it. A `None` task stops the worker.
+
+    Args:
+        task_queue (multiprocessing.Queue): Queue of tasks sent by the LearningWorker.
+        ack_queue (multiprocessing.Queue): Queue of acknowledged sequence numbers.
+        key_lengths (Dict[str, int]): The number of words used as a key in the grammar, per channel.
+    """
+    from Log import Log
+    Log(__file__)
+
+    from Database import Database
+    from Learner import learn
+    from TrieDatabase import TrieDatabase
+
+    dbs: Dict[str, Database] = {}
+    stop = False
+    while not stop:
+        last_seq = None
+        busy = 0.0
+        tasks = 0
+        # Collect tasks for at most one second before committing and acknowledging them
+        batch_end = time.monotonic() + 1
+        while time.monotonic() < batch_end:
+            try:
+                task = task_queue.get(timeout=max(batch_end - time.monotonic(), 0.01))
+            except queue.Empty:
+                break
+            if task is None:
+                stop = True
+                break
+
+            seq, command, channel, payload = task
+            start = time.perf_counter()
+            key_length = key_lengths.get(channel, 2)
+            if channel not in dbs:
+                dbs[channel] = Database(channel) if key_length == 2 else TrieDatabase(channel, key_length)
+            db = dbs[channel]
+            try:
+                if command == "learn":
+                    message, weight = payload
+                    learn(db, message, key_length, weight)
+                elif command == "unlearn":
+                    db.unlearn(payload)
+                elif command == "purge":
+                    db.purge_word(payload)
+                else:
+                    logger.error(f"Unknown learning worker command {command!r}.")
+            except Exception:
+                logger.exception(f"Failed to {command} {payload!r} in #{channel}")
+            last_seq = seq
+            busy += time.perf_counter() - start
+            tasks += 1
+
+        if last_seq is not None:
+            start = time.perf_counter()
+            for db in dbs.values():
+                db.execute_commit()
+            busy += time.perf_counter() - start
+            ack_queue.put((last_seq, busy, tasks))
+
+class LearningWorker:
+    """
+    Runs tokenization and Database writes in a separate process, so that CPU-bound learning does
+    not compete with reading from IRC under the GIL.
+
+    Every submitted task gets a sequence number and is kept until the worker acknowledges that it
+    has been committed. If the worker process dies, it is restarted and all unacknowledged tasks
+    are sent again, so no buffered messages are lost. A task may be performed twice if the worker
+    dies between committing and acknowledging it.
+    """
+    def __init__(self, key_lengths: Dict[str, int], acknowledged: Optional[Callable[[str, str], None]] = None) -> None:
+        """Start the worker process.
+
+        Args:
+            key_lengths (Dict[str, int]): The number of words used as a key in the grammar, per channel.
+            acknowledged (Optional[Callable[[str, str], None]], optional): Called with the command and
+                channel of every task once the worker committed it. Defaults to None.
+        """
+        self.key_lengths = key_lengths
+        self.acknowledged = acknowledged
+        self.restarts = 0
+        # Total number of seconds the worker spent on, and number of, committed tasks
+        self.busy_seconds = 0.0
+        self.completed = 0
+        self._context = multiprocessing.get_context("spawn")
+        self._pending: "OrderedDict[int, Tuple[str, str, Any]]" = OrderedDict()
+        self._seq = 0
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._start_process()
+
+        self._supervisor = threading.Thread(target=self._supervise, name="LearningWorkerSupervisor", daemon=True)
+        self._supervisor.start()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of submitted tasks that have not been committed by the worker yet."""
+        return len(self._pending)
+
+    def memory_components(self) -> Dict[str, Any]:
+        """Get the submitted tasks that are kept until the worker commits them, whose size is estimated in memory reports."""
+        return {"pending": self._pending}
+
+    def submit(self, command: str, channel: str, payload: Any) -> None:
+        """Submit a task to the worker.
+
+        Args:
+            command (str): One of "learn", "unlearn" or "purge".
+            channel (str): The name of the channel whose Database to modify.
+            payload (Any): A (message, weight) tuple to learn, the message to unlearn, or the word to purge.
+        """
+        with self._lock:
+            self._seq += 1
+            self._pending[self._seq] = (command, channel, payload)
+            self._task_queue.put((self._seq, command, channel, payload))
+
+    def stop(self, timeout: float = 60) -> None:
+        """Let the worker finish all submitted tasks, and stop it.
+
+        Args:
+            timeout (float, optional): The number of seconds to wait for the worker. Defaults to 60.
+        """
+        self._stopping.set()
+        with self._lock:
+            self._task_queue.put(None)
+        logger.info(f"Waiting for the learning worker to finish {self.queue_depth} tasks...")
+        self._process.join(timeout)
+        if self._process.is_alive():
+            self._process.terminate()
+        self._drain_acks(1)
+        if self._pending:
+            logger.warning(f"Learning worker stopped with {len(self._pending)} unfinished tasks.")
+        else:
+            logger.info("Learning worker stopped.")
+
+    def _start_process(self) -> None:
+        """Start a worker process with fresh queues, and resend all unacknowledged tasks."""
+        with self._lock:
+            self._task_queue = self._context.Queue()
+            self._ack_queue = self._context.Queue()
+            self._process = self._context.Process(target=_worker_main,
+                                                  args=(self._task_queue, self._ack_queue, self.key_lengths),
+                                                  name="LearningWorker",
+                                                  daemon=True)
+            self._process.start()
+            self._started_at = time.monotonic()
+            for seq, task in self._pending.items():
+                self._task_queue.put((seq, *task))
+
+    def _drain_acks(self, timeout: float) -> None:
+        """Remove all tasks acknowledged by the worker from the pending tasks.
+
+        Args:
+            timeout (float): The number of seconds to wait for the first acknowledgement.
+        """
+        try:
+            while True:
+                seq, busy, tasks = self._ack_queue.get(timeout=timeout)
+                timeout = 0
+                self.busy_seconds += busy
+                self.completed += tasks
+                committed = []
+                with self._lock:
+                    while self._pending and next(iter(self._pending)) <= seq:
+                        committed.append(self._pending.popitem(last=False)[1])
+                if self.acknowledged is not None:
+                    for command, channel, _ in committed:
+                        self.acknowledged(command, channel)
+        except (queue.Empty, OSError, ValueError):
+            pass
+
+    def _supervise(self) -> None:
+        """Process acknowledgements, and restart the worker process if it died."""
+        failures = 0
+        while not self._stopping.is_set():
+            self._drain_acks(1)
+            if self._process.is_alive() or self._stopping.is_set():
+                # Only consider the worker healthy again once it has stayed up for a while
+                if time.monotonic() - self._started_at > 60:
+                    failures = 0
+                continue
+
+            delay = min(2 ** failures, 60)
+            logger.error(f"Learning worker exited with code {self._process.exitcode}. "
+                         f"Restarting in {delay} seconds with {len(self._pending)} unfinished tasks.")
+            time.sleep(delay)
+            failures += 1
+            self.restarts += 1
+            self._start_process()
@@ -1,16 +1,96 @@
 import logging
 import os
 import json
+import time
+import atexit
+import queue
+import threading
+import configparser
 import logging.config
+import logging.handlers
+from typing import Dict, List, Optional, Tuple
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most `burst` records per `interval` seconds from every logging call site,
+    i.e. per logger, file and line, so that a line that logs for every chat message cannot flood
+    the log. Records above `max_level`, such as errors, are never limited.
+
+    Once the interval of a call site with suppressed records has passed, a summary record with
+    the number of suppressed records and the last of them is logged from the same call site.
+    """
+    def __init__(self, burst: int = 10, interval: float = 60, max_level: int = logging.WARNING) -> None:
+        super().__init__()
+        self.burst = burst
+        self.interval = interval
+        self.max_level = max_level
+        # Per call site, the start of its interval, the number of records in it, and the last suppressed record
+        self._windows: Dict[Tuple[str, str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > self.max_level or getattr(record, "rate_limit_summary", False):
+            return True
+        key = (record.name, record.pathname, record.lineno)
+        now = time.monotonic()
+        summary = None
+        with self._lock:
+            window = self._windows.get(key)
+            if window is None or now - window[0] >= self.interval:
+                summary = self._summary(window)
+                self._windows[key] = [now, 1, 0, None]
+            elif window[1] < self.burst:
+                window[1] += 1
+            else:
+                window[2] += 1
+                window[3] = record
+                return False
+        if summary is not None:
+            self._emit(summary)
+        return True
+
+    def flush(self, everything: bool = False) -> None:
+        """Log the summaries of the call sites whose interval has passed, or of all call sites, and forget those call sites."""
+        now = time.monotonic()
+        with self._lock:
+            expired = [key for key, window in self._windows.items() if everything or now - window[0] >= self.interval]
+            summaries = [self._summary(self._windows.pop(key)) for key in expired]
+        for summary in summaries:
+            if summary is not None:
+                self._emit(summary)
+
+    def _summary(self, window: Optional[list]) -> Optional[logging.LogRecord]:
+        """Create the summary record of an interval, or None if no records were suppressed in it."""
+        if window is None or not window[2]:
+            return None
+        last: logging.LogRecord = window[3]
+        message = f"Suppressed {window[2]} similar messages within {self.interval:g} seconds. The last one was: {last.getMessage()}"
+        return logging.makeLogRecord({**last.__dict__, "msg": message, "args": None, "exc_info": None,
+                                      "exc_text": None, "created": time.time(), "rate_limit_summary": True})
+
+    @staticmethod
+    def _emit(record: logging.LogRecord) -> None:
+        # Passes this filter, and goes to the same handlers as the records it summarizes
+        logging.getLogger(record.name).handle(record)
 
 
 class Log():
+    # Every logger with handlers, with the QueueHandler that replaced its handlers and the listener
+    # that writes the queued records to them, see `use_queue`
+    queues: List[Tuple[logging.Logger, logging.handlers.QueueHandler, logging.handlers.QueueListener]] = []
+    rate_limit: Optional[RateLimitFilter] = None
+    flush_timer = None
+
     def __init__(self, main_file: str):
         # Dynamically change size set up for name in the logger
         this_file = os.path.basename(main_file)
 
         from Settings import Settings
 
+        # Write the records of an earlier configuration before it is replaced
+        Log.stop()
+
         # If you have a logging config like me, use it
         if "PYTHON_LOGGING_CONFIG" in os.environ:
             logging.config.fileConfig(os.environ.get("PYTHON_LOGGING_CONFIG"),
@@ -20,3 +100,89 @@ class Log():
             # If you don't, use a standard config that outputs some INFO in the console
             logging.basicConfig(level=logging.INFO,
                                 format=f'[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s')
+
+        burst, interval = Log.read_rate_limit(os.environ.get("PYTHON_LOGGING_CONFIG"))
+        Log.use_queue(RateLimitFilter(burst, interval) if burst > 0 else None)
+
+    @staticmethod
+    def read_rate_limit(config_file: Optional[str]) -> Tuple[int, float]:
+        """Read the rate limit from the optional `[log_rate_limit]` section of the logging config file, e.g.
+
+        ```ini
+        [log_rate_limit]
+        burst = 10
+        interval = 60
+        ```
+
+        Args:
+            config_file (Optional[str]): The path of the logging config file, if any.
+
+        Returns:
+            Tuple[int, float]: The number of records let through per call site per interval, 0 to
+                disable rate limiting, and the interval in seconds. 10 and 60 by default.
+        """
+        burst, interval = 10, 60.0
+        if config_file:
+            # fileConfig interpolates the other sections with its defaults, which are not known here
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read(config_file)
+            if parser.has_section("log_rate_limit"):
+                burst = parser.getint("log_rate_limit", "burst", fallback=burst)
+                interval = parser.getfloat("log_rate_limit", "interval", fallback=interval)
+        return burst, interval
+
+    @staticmethod
+    def use_queue(rate_limit: Optional[RateLimitFilter]) -> None:
+        """Move the handlers of every logger behind a queue, which a background thread writes to the handlers.
+
+        Logging then only costs formatting the record and putting it in the queue, instead of waiting
+        for the console or file on the thread that logs, such as the thread that reads the chat.
+
+        Args:
+            rate_limit (Optional[RateLimitFilter]): Limits the records per call site before they are queued, if any.
+        """
+        loggers = [logging.getLogger()] + [logger for logger in logging.Logger.manager.loggerDict.values()
+                                           if isinstance(logger, logging.Logger)]
+        for logger in loggers:
+            handlers = [handler for handler in logger.handlers if not isinstance(handler, logging.handlers.QueueHandler)]
+            if not handlers:
+                continue
+            records = queue.SimpleQueue()
+            queue_handler = logging.handlers.QueueHandler(records)
+            if rate_limit is not None:
+                queue_handler.addFilter(rate_limit)
+            for handler in handlers:
+                logger.removeHandler(handler)
+            logger.addHandler(queue_handler)
+            listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+            listener.start()
+            Log.queues.append((logger, queue_handler, listener))
+
+        if rate_limit is not None:
+            # Log the summaries of call sites that stopped logging, at least once per interval
+            from Timer import LoopingTimer
+            Log.flush_timer = LoopingTimer(rate_limit.interval, rate_limit.flush)
+            Log.flush_timer.start()
+        Log.rate_limit = rate_limit
+
+    @staticmethod
+    def stop() -> None:
+        """Log the pending summaries, wait until all queued records are written, and give the handlers back to their loggers.
+
+        Called on exit, after which records are written right away again.
+        """
+        if Log.flush_timer is not None:
+            Log.flush_timer.stopped.set()
+            Log.flush_timer = None
+        if Log.rate_limit is not None:
+            Log.rate_limit.flush(everything=True)
+            Log.rate_limit = None
+        while Log.queues:
+            logger, queue_handler, listener = Log.queues.pop()
+            listener.stop()
+            logger.removeHandler(queue_handler)
+            for handler in listener.handlers:
+                logger.addHandler(handler)
+
+
+atexit.register(Log.stop)
@@ -1,14 +1,22 @@
 
-from typing import List, Tuple
+from typing import Dict, List, Optional, Tuple
 
 from TwitchWebsocket import Message, TwitchWebsocket
-from nltk.tokenize import sent_tokenize
-import socket, time, logging, re, string
+import threading, time, logging, os, re, sqlite3, string, signal, sys
 
 from Settings import Settings, SettingsData
-from Database import Database
+from ChannelState import ChannelState
+from Learner import learn
+import Admission
+from Admission import AdmissionPipeline, Stage
+from LearningWorker import LearningWorker
+from AdaptiveSampler import AdaptiveSampler
 from Timer import LoopingTimer
-from Tokenizer import detokenize, tokenize
+from Metrics import (Gauge, MetricsServer, MESSAGES_RECEIVED, MESSAGES_LEARNED,
+                     MESSAGE_HANDLER_SECONDS, GENERATE_SECONDS)
+from Profiler import PROFILER, profiled
+from MemoryReport import MEMORY_REPORTER
+from Tokenizer import detokenize
 
 from Log import Log
 Log(__file__)
@@ -17,31 +25,56 @@ logger = logging.getLogger(__name__)
 
 class MarkovChain:
     def __init__(self):
+        start = time.perf_counter()
         self.prev_message_t = 0
         self._enabled = True
-        # This regex should detect similar phrases as links as Twitch does
-        self.link_regex = re.compile("\w+\.[a-z]{2,}")
-        # List of moderators used in blacklist modification, includes broadcaster
-        self.mod_list = []
-        self.set_blacklist()
-        self.learning_counter = 0
-        self.generator_counter = 0
-        self.awake = False
-        self.learning = False
-        self.learning_individuals = []
-        self.learning_average = 0
-        self.learning_average_peak = 0
         self.maintenance_timer = None
-        self.allowed_badges = ["bits", "sub-gifter", "subscriber", "broadcaster", "moderator", "vip", "founder", "clips-leader"]
+        self.allowed_badges = {"bits", "bits-charity", "bits-leader", "sub-gifter", "subscriber", "broadcaster", "moderator", "vip", "founder", "clips-leader"}
 
         # Fill previously initialised variables with data from the settings.txt file
         Settings(self)
-        self.db = Database(self.chan)
+        # The checks a chat message has to pass to be learned
+        self.admission = self.build_admission_pipeline()
+        # Per-channel state, keyed by the lowercase channel name without "#".
+        # The connection, tokenizer and settings are shared between all channels.
+        self.channels: Dict[str, ChannelState] = {}
+        for channel in self.channel_names:
+            self.channels[channel] = ChannelState(channel, self.settings)
+
+        # Optionally move tokenization and Database writes to a separate process
+        self.learning_worker = None
+        if self.use_learning_worker:
+            self.learning_worker = LearningWorker({name: state.key_length for name, state in self.channels.items()},
+                                                  self.worker_acknowledged)
+
+        # Sample messages to learn when chat is faster than learning can keep up with
+        self.learn_seconds = 0.0
+        self.learned_messages = 0
+        self.sampler = None
+        if self.adaptive_sampling:
+            self.sampler = AdaptiveSampler(self.get_learning_stats, rate_limit=self.learning_rate_limit)
         
         # Set up daemon Timer to perform maintenance tasks
         self.maintenance_timer = LoopingTimer(600, self.perform_maintenance_tasks)
         self.maintenance_timer.start()
 
+        # Optionally profile from the start, e.g. with MARKOV_PROFILE=600:100
+        if os.environ.get("MARKOV_PROFILE"):
+            PROFILER.start_from_spec(os.environ["MARKOV_PROFILE"])
+
+        # Memory reports estimate the size of the components of the bot, see `memory_components`
+        MEMORY_REPORTER.components = self.memory_components
+        MEMORY_REPORTER.databases = lambda: {name: state.db for name, state in self.channels.items()}
+        if self.memory_tracing:
+            MEMORY_REPORTER.start_tracing()
+
+        # Optionally serve metrics in the Prometheus text format
+        self.metrics_server = None
+        if self.metrics_port:
+            self.start_metrics_server()
+
+        logger.info(f"Ready to connect after {time.perf_counter() - start:.2f} seconds, with {len(self.channels)} channel(s).")
+
         self.ws = TwitchWebsocket(host=self.host, 
                                   port=self.port,
                                   chan=self.chan,
@@ -51,6 +84,7 @@ class MarkovChain:
                                   capability=["commands", "tags"],
                                   live=True)
         self.ws.start_blocking()
+        self.shutdown()
 
     def set_settings(self, settings: SettingsData):
         """Fill class instance attributes based on the settings file.
@@ -58,210 +92,144 @@ class MarkovChain:
         Args:
             settings (SettingsData): The settings dict with information from the settings file.
         """
+        self.settings = settings
         self.host = settings["Host"]
         self.port = settings["Port"]
-        self.chan = settings["Channel"]
+        channels = settings["Channel"]
+        if isinstance(channels, str):
+            channels = channels.split(",")
+        self.channel_names = [channel.strip().replace("#", "").lower() for channel in channels if channel.strip()]
+        # TwitchWebsocket joins this channel itself, the others are joined after logging in
+        self.chan = "#" + self.channel_names[0]
         self.nick = settings["Nickname"]
         self.auth = settings["Authentication"]
-        self.denied_users = [user.lower() for user in settings["DeniedUsers"]] + [self.nick.lower()]
+        self.denied_users = {user.lower() for user in settings["DeniedUsers"]} | {self.nick.lower()}
         self.allowed_users = [user.lower() for user in settings["AllowedUsers"]]
-        self.key_length = 2
         self.max_sentence_length = settings["MaxSentenceWordAmount"]
         self.min_sentence_length = settings["MinSentenceWordAmount"]
         self.sent_separator = settings["SentenceSeparator"]
         self.emote_prefix = settings["EmotePrefix"]
         self.automatic_generation_message_count = settings["AutomaticGenerationMessageCount"]
         self.autowake = settings["AutoWake"]
-
+        self.use_learning_worker = settings["LearningWorker"]
+        self.adaptive_sampling = settings["AdaptiveSampling"]
+        self.learning_rate_limit = settings["LearningRateLimit"]
+        self.engine = settings["Engine"]
+        self.metrics_port = settings["MetricsPort"]
+        self.metrics_host = settings["MetricsHost"]
+        self.memory_report_interval = settings["MemoryReportInterval"]
+        self.memory_tracing = settings["MemoryTracing"]
+        if self.engine == "memory" and self.use_learning_worker:
+            # The worker process would write to the database file behind the in-memory chain's back
+            logger.warning("The \"LearningWorker\" setting is ignored when \"Engine\" is \"memory\".")
+            self.use_learning_worker = False
+
+    @MESSAGE_HANDLER_SECONDS.time()
+    @profiled("message_handler", lambda bot, m: m.channel)
     def message_handler(self, m: Message):
         try:
-            if m.type == "366":
+            if m.type == "001":
+                # Logged in. TwitchWebsocket only joins the first channel, so join the rest.
+                # This also happens after every reconnect.
+                self.join_channels()
+
+            elif m.type == "366":
                 logger.info(f"Successfully joined channel: #{m.channel}")
                 # Get the list of mods used for modifying the blacklist
                 #logger.info("Fetching mod list...")
                 #self.ws.send_message("/mods")
 
             elif m.type == "NOTICE":
+                state = self.get_state(m.channel)
                 # Check whether the NOTICE is a response to our /mods request
                 if m.message.startswith("The moderators of this channel are:"):
                     string_list = m.message.replace("The moderators of this channel are:", "").strip()
-                    self.mod_list = [m.channel] + string_list.split(", ")
-                    logger.info(f"Fetched mod list. Found {len(self.mod_list) - 1} mods.")
+                    state.mod_list = [m.channel] + string_list.split(", ")
+                    logger.info(f"Fetched mod list. Found {len(state.mod_list) - 1} mods.")
                 elif m.message == "There are no moderators of this channel.":
-                    self.mod_list = [m.channel]
+                    state.mod_list = [m.channel]
                     logger.info(f"Fetched mod list. Found no mods.")
                 # If it is not, log this NOTICE
                 else:
                     logger.info(m.message)
 
             elif m.type in ("PRIVMSG", "WHISPER"):
+                # Whispers are not tied to a channel, and apply to the first channel
+                state = self.get_state(m.channel)
                 if m.message.startswith("!wakeup") and self.check_if_permissions(m):
-                    self.awake = True
-                    logger.info("Waking up for auto-generating messages.")
-                    try:
-                        self.ws.send_message("PowerUpR")
-                    except socket.OSError as error:
-                        logger.warning(f"[OSError: {error}] upon sending message. Ignoring.")
+                    state.awake = True
+                    logger.info(f"Waking up for auto-generating messages in #{state.name}.")
+                    self.send_message(state.name, "PowerUpR")
                 
                 elif m.message.startswith("!sleep") and self.check_if_permissions(m):
-                    self.awake = False
-                    logger.info("Going to sleep for auto-generating messages.")
-                    try:
-                        self.ws.send_message("ThankEgg")
-                    except socket.OSError as error:
-                        logger.warning(f"[OSError: {error}] upon sending message. Ignoring.")
+                    state.awake = False
+                    logger.info(f"Going to sleep for auto-generating messages in #{state.name}.")
+                    self.send_message(state.name, "ThankEgg")
 
                 elif m.message.startswith("!forget") and self.check_if_permissions(m):
                     forgettable = m.message[len("!forget"):].strip()
                     logger.info(f"Attempting to forget: {forgettable}")
                     try:
-                        self.db.unlearn(forgettable)
+                        self.unlearn_message(state, forgettable)
                     except Exception as e:
                         logger.exception(f"Failed to forget '{forgettable}'")
 
+                elif m.message.startswith("!backup") and self.check_if_permissions(m):
+                    if state.backup.start():
+                        logger.info(f"Creating a backup of #{state.name}.")
+                    else:
+                        logger.info(f"A backup of #{state.name} is already being created.")
+
+                elif m.message.startswith("!trace") and self.check_if_permissions(m):
+                    self.toggle_tracing(state, m.message[len("!trace"):].strip())
+
+                elif m.message.startswith("!profile") and self.check_if_permissions(m):
+                    argument = m.message[len("!profile"):].strip()
+                    if argument == "off":
+                        threading.Thread(target=PROFILER.stop, daemon=True).start()
+                    elif PROFILER.active:
+                        logger.info("Profiling is already running. Stop it with \"!profile off\".")
+                    else:
+                        PROFILER.start_from_spec(argument.replace(" ", ":"))
+
+                elif m.message.startswith("!memory") and self.check_if_permissions(m):
+                    self.memory_command(m.message[len("!memory"):].split())
+
                 elif m.message.startswith("!purge") and self.check_if_permissions(m):
                     purged = m.message[len("!purge"):].strip()
                     logger.info(f"Attempting to purge: {purged}")
                     try:
-                        self.db.purge_word(purged)
+                        self.purge_word(state, purged)
                     except Exception as e:
                         logger.exception(f"Failed to purge '{purged}'")
 
             
             if m.type == "USERNOTICE" and "msg-id" in m.tags and m.tags["msg-id"] == "submysterygift":
                 if "msg-param-mass-gift-count" in m.tags:
+                    state = self.get_state(m.channel)
                     count = int(m.tags["msg-param-mass-gift-count"])
                     increment = round((self.automatic_generation_message_count / 2) * count)
-                    self.generator_counter = self.generator_counter + increment
-                    logger.info(f"Subgifts: {count}. Increased by {increment}, counter is now {self.generator_counter}.")
+                    state.generator_counter = state.generator_counter + increment
+                    logger.info(f"Subgifts in #{state.name}: {count}. Increased by {increment}, counter is now {state.generator_counter}.")
 
             if m.type == "PRIVMSG":
-                # Ignore bot messages
-                if m.user.lower() in self.denied_users:
-                    #logger.info(f"Ignoring message. User is denied.")
-                    return
-
-                # Ignore the message if it is deemed a command
-                if self.check_if_other_command(m.message):
-                    #logger.info(f"Ignoring message. Message is a command.")
-                    return
-                
-                # Ignore the message if it contains a link.
-                if self.check_link(m.message):
-                    #logger.info(f"Ignoring message. Message contained a link.")
-                    return
-
-                # Ignore if learning is paused
-                if not self.learning:
-                    logger.info("Ignoring message. Learning is paused.")
-                    user_hash = str(hash(m.user.lower()))
-                    if self.learning_individuals.count(user_hash) < 1:
-                        self.learning_individuals.append(user_hash)
-                    
-                    if len(self.learning_individuals) >= 3:
-                        self.learning = True
-                        self.learning_individuals.clear()
-                        logger.info("Learning started.")
-                        if self.autowake:
-                            self.awake = True
-                            logger.info("(Autowake) Waking up for auto-generating messages.")
-                            try:
-                                self.ws.send_message("PowerUpR")
-                            except socket.OSError as error:
-                                logger.warning(f"[OSError: {error}] upon sending message. Ignoring.")
-                    return
-
-                # Count activity 
-                self.generator_counter = self.generator_counter + 1
-                
-                # Check if we should generate a message and send it to chat
-                if self.generator_counter >= self.automatic_generation_message_count:
-                    self.send_activity_generation_message()
-
-                # Limit learning to only chatters with set badges
-                if "badges" in m.tags and any(elem in m.tags["badges"] for elem in self.allowed_badges):
-                    # For safety we only learn from users that are likely to post good
-                    # This will also filter out most raid messages
-                    b = m.tags["badges"]
-                    # logger.info(f"User {m.user.lower()} has badges: {b}")
-                else:
-                    return
-
-                if "emotes" in m.tags:
-
-                    # Find emotes and remove any that do not contain the supplied emote prefix
-                    # Also remove any emote that has been modified
-                    emotes = m.tags["emotes"].split("/")
-                    names = []
-                    mods = ["_BW","_HF","_SG","_SQ","_TK"]
-                    if not emotes[0] == "":
-                        for e in emotes:
-                            keys = e.split(":")[1].split(",")[0].split("-")
-                            name = m.message[int(keys[0]):int(keys[1])+1]
-                            names.append(name)
-
-                        for n in names:
-                            if self.emote_prefix == "NA":
-                                m.message = m.message.replace(n, "")
-                            else:
-                                if not n.startswith(self.emote_prefix) or name[-3:] in mods:
-                                    m.message = m.message.replace(n, "")
-                                    # logger.info("Stripped emote: " + n)
-                    
-                # Ignore the message if any word in the sentence is on the ban filter
-                if self.check_filter(m.message):
-                    logger.warning(f"Sentence contained blacklisted word or phrase:\"{m.message}\"")
-                    return
-                
-                else:
+                state = self.get_state(m.channel)
+                MESSAGES_RECEIVED.inc(labels=(state.name,))
+                if self.admission.admit(m, state) is None:
                     # Average activity is left here so that raids don't spike the averages
-                    self.learning_counter = self.learning_counter + 1
-                    
-                    # Try to split up sentences. Requires nltk's 'punkt' resource
-                    try:
-                        sentences = sent_tokenize(m.message.strip())
-                    # If 'punkt' is not downloaded, then download it, and retry
-                    except:
-                        logger.warning(f"Failed to tokenize {m.message}")
-
-                    for sentence in sentences:
-                        # Get all seperate words
-                        words = tokenize(sentence)
-                        # Double spaces will lead to invalid rules. We remove empty words here
-                        if "" in words:
-                            words = [word for word in words if word]
-                            
-                        # If the sentence is too short, ignore it and move on to the next.
-                        if len(words) <= self.key_length:
-                            continue
-                        
-                        # Add a new starting point for a sentence to the <START>
-                        #self.db.add_rule(["<START>"] + [words[x] for x in range(self.key_length)])
-                        self.db.add_start_queue([words[x] for x in range(self.key_length)])
-                        
-                        # Create Key variable which will be used as a key in the Dictionary for the grammar
-                        key = list()
-                        for word in words:
-                            # Set up key for first use
-                            if len(key) < self.key_length:
-                                key.append(word)
-                                continue
-                            
-                            self.db.add_rule_queue(key + [word])
-                            
-                            # Remove the first word, and add the current word,
-                            # so that the key is correct for the next word.
-                            key.pop(0)
-                            key.append(word)
-                        # Add <END> at the end of the sentence
-                        self.db.add_rule_queue(key + ["<END>"])
-                        # We used to increase the learning counter here, but it has been moved for now to make everything else work
+                    state.learning_counter = state.learning_counter + 1
+
+                    # Under overload only a weighted sample of messages is learned
+                    weight = self.sampler.admit() if self.sampler else 1
+                    if weight:
+                        self.learn_message(state, m.message, weight)
+                        MESSAGES_LEARNED.inc(labels=(state.name,))
 
             elif m.type == "CLEARMSG":
                 # If a message is deleted, its contents will be unlearned
                 # or rather, the "occurances" attribute of each combinations of words in the sentence
                 # is reduced by 5, and deleted if the occurances is now less than 1. 
-                self.db.unlearn(m.message)
+                self.unlearn_message(self.get_state(m.channel), m.message)
                 
                 # TODO: Think of some efficient way to check whether it was our message that got deleted.
                 # If the bot's message was deleted, log this as an error
@@ -275,16 +243,277 @@ class MarkovChain:
         except Exception as e:
             logger.exception(e)
 
-    def generate(self, params: List[str] = None) -> "Tuple[str, bool]":
+    def build_admission_pipeline(self) -> AdmissionPipeline:
+        """Build the stages that decide whether a chat message is learned.
+
+        Stages with side effects keep their position, so that e.g. activity is still counted
+        for messages from users without badges, and only messages that passed every other stage
+        are counted by the duplicate filter. New filters can be added with `AdmissionPipeline.add`.
+        """
+        return AdmissionPipeline([
+            Admission.denied_users(self.denied_users),
+            Admission.commands_and_links(),
+            Stage("paused", self.check_learning_paused, barrier=True),
+            Stage("activity", self.count_activity, barrier=True),
+            # For safety we only learn from users that are likely to post good
+            # This will also filter out most raid messages
+            Admission.badges(self.allowed_badges),
+            Admission.strip_emotes(self.emote_prefix),
+            Admission.blacklist(),
+            Admission.duplicates(),
+        ])
+
+    def check_learning_paused(self, m: Message, state: ChannelState) -> Optional[str]:
+        """Admission stage that rejects messages while learning is paused, and starts learning once 3 different users chatted."""
+        if state.learning:
+            return None
+        logger.info("Ignoring message. Learning is paused.")
+        user_hash = str(hash(m.user.lower()))
+        if state.learning_individuals.count(user_hash) < 1:
+            state.learning_individuals.append(user_hash)
+
+        if len(state.learning_individuals) >= 3:
+            state.learning = True
+            state.learning_individuals.clear()
+            logger.info(f"Learning started in #{state.name}.")
+            if self.autowake:
+                state.awake = True
+                logger.info(f"(Autowake) Waking up for auto-generating messages in #{state.name}.")
+                self.send_message(state.name, "PowerUpR")
+        return "paused"
+
+    def count_activity(self, m: Message, state: ChannelState) -> Optional[str]:
+        """Admission stage that counts activity, and sends a generated message every `automatic_generation_message_count` messages."""
+        state.generator_counter = state.generator_counter + 1
+
+        # Check if we should generate a message and send it to chat
+        if state.generator_counter >= self.automatic_generation_message_count:
+            self.send_activity_generation_message(state)
+        return None
+
+    def learn_message(self, state: ChannelState, message: str, weight: int = 1) -> None:
+        """Learn `message` in the Database of `state`, using the learning worker if it is enabled.
+
+        Args:
+            state (ChannelState): The state of the channel the message was sent in.
+            message (str): The admitted message to learn.
+            weight (int, optional): The amount to increment the frequencies by. Defaults to 1.
+        """
+        if self.learning_worker:
+            self.learning_worker.submit("learn", state.name, (message, weight))
+        else:
+            start = time.perf_counter()
+            learn(state.db, message, state.key_length, weight)
+            self.learn_seconds += time.perf_counter() - start
+            self.learned_messages += 1
+
+    def get_learning_stats(self) -> Tuple[float, int, int]:
+        """Get the measured cost of learning, used by the AdaptiveSampler.
+
+        Returns:
+            Tuple[float, int, int]: The total number of seconds spent learning, the total number
+                of learned messages, and the number of messages waiting to be written.
+        """
+        if self.learning_worker:
+            return self.learning_worker.busy_seconds, self.learning_worker.completed, self.learning_worker.queue_depth
+        return self.learn_seconds, self.learned_messages, 0
+
+    def unlearn_message(self, state: ChannelState, message: str) -> None:
+        """Unlearn `message` from the Database of `state`, using the learning worker if it is enabled.
+
+        Args:
+            state (ChannelState): The state of the channel the message was deleted in.
+            message (str): The message to unlearn.
+        """
+        if self.learning_worker:
+            self.learning_worker.submit("unlearn", state.name, message)
+            if state.db.warm_cache is not None:
+                state.db.warm_cache.clear()
+        else:
+            state.db.unlearn(message)
+
+    def purge_word(self, state: ChannelState, word: str) -> None:
+        """Purge `word` from the Database of `state`, using the learning worker if it is enabled.
+
+        Args:
+            state (ChannelState): The state of the channel to purge the word from.
+            word (str): The word to purge.
+        """
+        if self.learning_worker:
+            self.learning_worker.submit("purge", state.name, word)
+            if state.db.warm_cache is not None:
+                state.db.warm_cache.clear()
+        else:
+            state.db.purge_word(word)
+
+    def worker_acknowledged(self, command: str, channel: str) -> None:
+        """Called by the learning worker once it committed a task, from its supervisor thread.
+
+        Unlearning and purging may change any cached lookup, so the warm cache of the channel is cleared
+        once more after the worker committed them, as lookups in between may have cached the old counts.
+
+        Args:
+            command (str): One of "learn", "unlearn" or "purge".
+            channel (str): The name of the channel whose Database was modified.
+        """
+        if command in ("unlearn", "purge") and self.channels[channel].db.warm_cache is not None:
+            self.channels[channel].db.warm_cache.clear()
+
+    def toggle_tracing(self, state: ChannelState, argument: str) -> None:
+        """Enable or disable timing the statements of the Database of `state`, and log the slowest statement shapes.
+
+        Args:
+            state (ChannelState): The state of the channel whose Database to trace.
+            argument (str): "on" to enable tracing, "off" to disable it, and anything else to only log the report.
+        """
+        tracer = state.db.tracer
+        if argument == "on":
+            tracer.reset()
+            tracer.enabled = True
+            logger.info(f"[#{state.name}] Tracing database statements. Statements over {tracer.threshold * 1000:.0f}ms are written to {tracer.slow_log}.")
+            return
+        if argument == "off":
+            tracer.enabled = False
+        self.log_tracing_report(state)
+
+    def log_tracing_report(self, state: ChannelState) -> None:
+        """Log the statement shapes of the Database of `state` that took the most time in total."""
+        tracer = state.db.tracer
+        logger.info(f"[#{state.name}] Statements by total time, with {tracer.slow} slow statements in {tracer.slow_log}:")
+        for line in tracer.report():
+            logger.info(f"[#{state.name}] {line}")
+
+    def memory_command(self, arguments: List[str]) -> None:
+        """Handle `!memory`, which writes a memory report, and `!memory trace [frames]` and `!memory trace off`.
+
+        Args:
+            arguments (List[str]): The words after "!memory".
+        """
+        if arguments[:1] == ["trace"]:
+            if arguments[1:2] == ["off"]:
+                MEMORY_REPORTER.stop_tracing()
+            elif len(arguments) > 1 and not arguments[1].isdigit():
+                logger.info(f"Invalid number of frames \"{arguments[1]}\". Use \"!memory trace [frames]\" or \"!memory trace off\".")
+            else:
+                MEMORY_REPORTER.start_tracing(int(arguments[1]) if len(arguments) > 1 else 1)
+        elif not MEMORY_REPORTER.start():
+            logger.info("A memory report is already being written.")
+
+    def memory_components(self) -> Dict[str, object]:
+        """Get the in-memory structures of the bot by name, whose size is estimated in memory reports."""
+        components = {}
+        for state in self.channels.values():
+            for name, component in state.db.memory_components().items():
+                components[f"{state.name}.db.{name}"] = component
+            components[f"{state.name}.duplicate_filter"] = state.duplicate_filter
+            components[f"{state.name}.blacklist"] = state.blacklist
+            components[f"{state.name}.mod_list"] = state.mod_list
+            components[f"{state.name}.learning_individuals"] = state.learning_individuals
+        if self.learning_worker:
+            for name, component in self.learning_worker.memory_components().items():
+                components[f"learning_worker.{name}"] = component
+        try:
+            import nltk.data
+            # The loaded punkt models, which are never unloaded
+            components["nltk"] = getattr(nltk.data, "_resource_cache", {})
+        except ImportError:
+            pass
+        return components
+
+    def start_metrics_server(self) -> None:
+        """Serve the metrics at `metrics_host`:`metrics_port`, including gauges for the queues and database files."""
+        def queue_depths() -> Dict[Tuple[str, ...], int]:
+            depths = {("execute",): sum(state.db.queue_depth for state in self.channels.values())}
+            if self.learning_worker:
+                depths[("learning_worker",)] = self.learning_worker.queue_depth
+            return depths
+
+        def database_sizes() -> Dict[Tuple[str, ...], int]:
+            sizes = {}
+            for state in self.channels.values():
+                for file, path in (("main", state.db.db_name), ("wal", state.db.db_name + "-wal"), ("archive", state.db.archive_name)):
+                    if path and os.path.isfile(path):
+                        sizes[(state.name, file)] = os.path.getsize(path)
+            return sizes
+
+        Gauge("markov_queue_depth", "Number of writes waiting to be executed, per queue.", queue_depths, ["queue"])
+        Gauge("markov_db_size_bytes", "Size of the database files, per channel and file.", database_sizes, ["channel", "file"])
+        try:
+            self.metrics_server = MetricsServer(self.metrics_port, self.metrics_host)
+        except OSError:
+            logger.exception(f"Failed to serve metrics on {self.metrics_host}:{self.metrics_port}.")
+
+    def shutdown(self) -> None:
+        """Write everything that was learned but not yet committed to the Databases."""
+        if self.learning_worker:
+            self.learning_worker.stop()
+        for state in self.channels.values():
+            state.db.flush()
+            if state.db.warm_cache is not None:
+                state.db.warm_cache.stopped.set()
+                state.db.warm_cache.save()
+
+    def get_state(self, channel: Optional[str] = None) -> ChannelState:
+        """Get the ChannelState for `channel`, or for the first channel if `channel` is not joined.
+
+        Args:
+            channel (Optional[str]): The name of the channel, without "#". 
+                None for messages that are not tied to a channel, such as whispers.
+
+        Returns:
+            ChannelState: The state of the channel.
+        """
+        state = self.channels.get(channel)
+        if state is None:
+            state = self.channels[self.channel_names[0]]
+        return state
+
+    def join_channels(self) -> None:
+        """Join all channels other than the first one, in a daemon thread.
+
+        Twitch limits the number of JOINs to 20 per 10 seconds, so the joins are spaced out.
+        """
+        def join():
+            for channel in self.channel_names[1:]:
+                try:
+                    self.ws.join_channel("#" + channel)
+                except OSError as error:
+                    logger.warning(f"[OSError: {error}] upon joining #{channel}. Ignoring.")
+                time.sleep(0.5)
+        
+        if len(self.channel_names) > 1:
+            threading.Thread(target=join, daemon=True).start()
+
+    def send_message(self, channel: str, message: str) -> None:
+        """Send `message` to the chat of `channel`. Just log a warning on fail.
+
+        TwitchWebsocket.send_message only sends to the channel it was constructed with,
+        so the PRIVMSG is constructed here to support multiple channels on one connection.
+
+        Args:
+            channel (str): The name of the channel, without "#".
+            message (str): The message to send.
+        """
+        try:
+            self.ws._send(f"PRIVMSG #{channel} :", message)
+        except OSError as error:
+            logger.warning(f"[OSError: {error}] upon sending message. Ignoring.")
+
+    @GENERATE_SECONDS.time()
+    @profiled("generate", lambda bot, params=None, channel=None: bot.get_state(channel).name)
+    def generate(self, params: List[str] = None, channel: Optional[str] = None) -> "Tuple[str, bool]":
         """Given an input sentence, generate the remainder of the sentence using the learned data.
 
         Args:
             params (List[str]): A list of words to use as an input to use as the start of generating.
+            channel (Optional[str]): The channel whose learned data to use. Defaults to the first channel.
         
         Returns:
             Tuple[str, bool]: A tuple of a sentence as the first value, and a boolean indicating
                 whether the generation succeeded as the second value.
         """
+        state = self.get_state(channel)
+        db = state.model
         if params is None:
             params = []
 
@@ -298,19 +527,18 @@ class MarkovChain:
                 return "You can't make me do commands, you madman!", False
 
         # Get the starting key and starting sentence.
-        # If there is more than 1 param, get the last 2 as the key.
-        # Note that self.key_length is fixed to 2 in this implementation
+        # If there is more than 1 param, get the last `key_length` as the key.
         if len(params) > 1:
-            key = params[-self.key_length:]
+            key = params[-state.key_length:]
             # Copy the entire params for the sentence
             sentences[0] = params.copy()
 
         elif len(params) == 1:
             # First we try to find if this word was once used as the first word in a sentence:
-            key = self.db.get_next_single_start(params[0])
+            key = db.get_next_single_start(params[0])
             if key == None:
                 # If this failed, we try to find the next word in the grammar as a whole
-                key = self.db.get_next_single_initial(0, params[0])
+                key = db.get_next_single_initial(0, params[0])
                 if key == None:
                     # Return a message that this word hasn't been learned yet
                     return f"I haven't extracted \"{params[0]}\" from chat yet.", False
@@ -319,7 +547,7 @@ class MarkovChain:
 
         else: # if there are no params
             # Get starting key
-            key = self.db.get_start()
+            key = db.get_start()
             if key:
                 # Copy this for the sentence
                 sentences[0] = key.copy()
@@ -334,16 +562,16 @@ class MarkovChain:
             # Use key to get next word
             if i == 0:
                 # Prevent fetching <END> on the first word
-                word = self.db.get_next_initial(i, key)
+                word = db.get_next_initial(i, key)
             else:
-                word = self.db.get_next(i, key)
+                word = db.get_next(i, key)
 
             i += 1
 
             if word == "<END>" or word == None:
                 # Break, unless we are before the min_sentence_length
                 if i < self.min_sentence_length:
-                    key = self.db.get_start()
+                    key = db.get_start()
                     # Ensure that the key can be generated. Otherwise we still stop.
                     if key:
                         # Start a new sentence
@@ -356,15 +584,15 @@ class MarkovChain:
             # Otherwise add the word
             sentences[-1].append(word)
             
-            # Shift the key so on the next iteration it gets the next item
-            key.pop(0)
-            key.append(word)
+            # Shift the key so on the next iteration it gets the next item.
+            # Keys shorter than `key_length`, e.g. from two params, grow until they are long enough.
+            key = (key + [word])[-state.key_length:]
         
         # If there were params, but the sentence resulting is identical to the params
         # Then the params did not result in an actual sentence
         # If so, restart without params
         if len(params) > 0 and params == sentences[0]:
-            return "I haven't learned what to do with \"" + detokenize(params[-self.key_length:]) + "\" yet.", False
+            return "I haven't learned what to do with \"" + detokenize(params[-state.key_length:]) + "\" yet.", False
 
         return self.sent_separator.join(detokenize(sentence) for sentence in sentences), True
 
@@ -387,87 +615,115 @@ class MarkovChain:
                     count += 1
         return count
 
-    def write_blacklist(self, blacklist: List[str]) -> None:
-        """Write blacklist.txt given a list of banned words.
-
-        Args:
-            blacklist (List[str]): The list of banned words to write.
-        """
-        logger.debug("Writing Blacklist...")
-        with open("blacklist.txt", "w") as f:
-            f.write("\n".join(sorted(blacklist, key=lambda x: len(x), reverse=True)))
-        logger.debug("Written Blacklist.")
-
-    def set_blacklist(self) -> None:
-        """Read blacklist.txt and set `self.blacklist` to the list of banned words."""
-        logger.debug("Loading Blacklist...")
-        try:
-            with open("blacklist.txt", "r") as f:
-                self.blacklist = [l.replace("\n", "") for l in f.readlines()]
-                logger.debug("Loaded Blacklist.")
-        
-        except FileNotFoundError:
-            logger.warning("Loading Blacklist Failed!")
-            self.blacklist = ["<start>", "<end>"]
-            self.write_blacklist(self.blacklist)
-
     def perform_maintenance_tasks(self) -> None:
+        if self.sampler and self.sampler.ratio < 1:
+            logger.info(f"Learning is overloaded at {self.sampler.rate:.1f} messages per second, "
+                        f"{self.sampler.latency * 1000:.2f}ms per message and {self.sampler.backlog} waiting. "
+                        f"Sampling ratio is {self.sampler.ratio:.2f}")
+        for state in self.channels.values():
+            self.perform_channel_maintenance(state)
+        if self.memory_report_interval > 0 and time.time() - MEMORY_REPORTER.last_run >= self.memory_report_interval * 3600:
+            MEMORY_REPORTER.start()
+
+    def perform_channel_maintenance(self, state: ChannelState) -> None:
         # Handle automatically enabling/disabling learning, as well as statistics
         # If there are no messages in the last 10 minutes we disable learning
-        if self.learning_counter > 0:
-            if self.learning_average == 0:
-                self.learning_average = self.learning_counter
-                self.learning_average_peak = self.learning_counter
+        if state.learning_counter > 0:
+            if state.learning_average == 0:
+                state.learning_average = state.learning_counter
+                state.learning_average_peak = state.learning_counter
             else:
-                self.learning_average = round((self.learning_average + self.learning_counter) / 2)
-                if self.learning_average > self.learning_average_peak:
-                    self.learning_average_peak = round((self.learning_average_peak+self.learning_average)/2)
-            logger.info(f"Learned from {self.learning_counter} new messages")
-            logger.info(f"Learning average is {self.learning_average} and peak is {self.learning_average_peak}")
-            self.learning_counter = 0
+                state.learning_average = round((state.learning_average + state.learning_counter) / 2)
+                if state.learning_average > state.learning_average_peak:
+                    state.learning_average_peak = round((state.learning_average_peak+state.learning_average)/2)
+            logger.info(f"[#{state.name}] Learned from {state.learning_counter} new messages")
+            logger.info(f"[#{state.name}] Learning average is {state.learning_average} and peak is {state.learning_average_peak}")
+            state.learning_counter = 0
         else:
-            if self.awake:
-                logger.info(f"Automatically disabling message generation due to inactivity.")
-            if self.learning:
-                logger.info(f"Automatically disabling learning because learning counter is {self.learning_counter}")
-            self.awake = False
-            self.generator_counter = 0
-            self.learning = False
-            self.learning_average_peak = 0
-            self.learning_average = 0
-            self.learning_individuals.clear()
+            if state.awake:
+                logger.info(f"[#{state.name}] Automatically disabling message generation due to inactivity.")
+            if state.learning:
+                logger.info(f"[#{state.name}] Automatically disabling learning because learning counter is {state.learning_counter}")
+            state.reset_activity()
+        
+        rejections = self.admission.pop_rejections(state.name)
+        if rejections:
+            logger.info(f"[#{state.name}] Rejected messages per admission stage: " +
+                        ", ".join(f"{reason}: {count}" for reason, count in sorted(rejections.items(), key=lambda item: -item[1])))
+
+        if state.duplicate_filter.suppressed > 0:
+            logger.info(f"[#{state.name}] Suppressed {state.duplicate_filter.suppressed} repeated messages, avoiding roughly {state.duplicate_filter.writes_avoided} writes")
+            state.duplicate_filter.suppressed = 0
+            state.duplicate_filter.writes_avoided = 0
+
+        if state.db.tracer.enabled:
+            self.log_tracing_report(state)
+
+        if state.db.warm_cache is not None:
+            try:
+                state.db.warm_cache.save()
+            except OSError:
+                logger.exception(f"[#{state.name}] Saving the hot keys failed.")
+
+        try:
+            state.compactor.run()
+        except sqlite3.Error:
+            logger.exception(f"[#{state.name}] Compaction failed.")
+
+        if state.use_archive:
+            try:
+                state.db.archive_cold(state.archive_threshold, state.archive_time_budget)
+            except sqlite3.Error:
+                logger.exception(f"[#{state.name}] Archiving failed.")
+
+        try:
+            stats = state.db.model_stats()
+            logger.info(f"[#{state.name}] The model has {stats['ngrams']} 3-grams ({stats['archived']} archived) "
+                        f"and {stats['starts']} starts, with {stats['vocabulary']} distinct words"
+                        + (f", and a trie with {stats['trie_nodes']} nodes." if stats["trie_nodes"] else "."))
+        except sqlite3.Error:
+            logger.exception(f"[#{state.name}] Reading the model statistics failed.")
+
+        if state.backup_interval > 0 and time.time() - state.backup.last_run >= state.backup_interval * 3600:
+            state.backup.start()
+
+        if state.use_compiled_model:
+            state.start_compile()
         
         # Calculate passive boosts for greater stability
-        if self.learning_average > 0:
+        if state.learning_average > 0:
             peak_boost = 0
             time_boost = 0
             # Boost up 80% towards peak message rate
-            if self.learning_average < self.learning_average_peak:
-                peak_boost = round((self.learning_average_peak - self.learning_average)*0.8)
+            if state.learning_average < state.learning_average_peak:
+                peak_boost = round((state.learning_average_peak - state.learning_average)*0.8)
 
             # Boost up 80% towards one message per 30 minutes
-            if self.learning_average < round((self.automatic_generation_message_count/30)*10*0.8):
-                time_boost = round((((self.automatic_generation_message_count/30)*10) - self.learning_average))
+            if state.learning_average < round((self.automatic_generation_message_count/30)*10*0.8):
+                time_boost = round((((self.automatic_generation_message_count/30)*10) - state.learning_average))
 
             if peak_boost > time_boost:
-                self.generator_counter = round(self.generator_counter + peak_boost)
+                state.generator_counter = round(state.generator_counter + peak_boost)
             else:
-                self.generator_counter = round(self.generator_counter + time_boost)
+                state.generator_counter = round(state.generator_counter + time_boost)
 
-            logger.info(f"Calculated {time_boost} time boost and {peak_boost} peak boost, choosing largest.")
-            logger.info(f"Chat activity counter at {self.generator_counter} out of {self.automatic_generation_message_count}")
+            logger.info(f"[#{state.name}] Calculated {time_boost} time boost and {peak_boost} peak boost, choosing largest.")
+            logger.info(f"[#{state.name}] Chat activity counter at {state.generator_counter} out of {self.automatic_generation_message_count}")
 
             # Check if we should generate a message and send it to chat
-            if self.generator_counter >= self.automatic_generation_message_count:
-                self.send_activity_generation_message()
+            if state.generator_counter >= self.automatic_generation_message_count:
+                self.send_activity_generation_message(state)
 
 
-    def send_activity_generation_message(self) -> None:
-        """Based on chat activity, send a generation message to the connected chat.
+    def send_activity_generation_message(self, state: ChannelState) -> None:
+        """Based on chat activity, send a generation message to the chat of `state`.
+
+        Args:
+            state (ChannelState): The state of the channel to generate for.
         """
-        self.generator_counter = 0
-        if self.awake:
-            sentence, success = self.generate()
+        state.generator_counter = 0
+        if state.awake:
+            sentence, success = self.generate(channel=state.name)
             if success:
                 # Fixing trailing periods so they arent spaced
                 sentence = re.sub(r'\s+(\.+)', r'\1', sentence)
@@ -478,26 +734,10 @@ class MarkovChain:
                 # Remove any " or '
                 sentence = re.sub(r'"', '', sentence)
                 sentence = re.sub(r'(?<!\w)\'|\'(?!\w)', '', sentence)
-                logger.info(f"Generated: {sentence}")
-                # Try to send a message. Just log a warning on fail
-                try:
-                    self.ws.send_message(sentence)
-                except socket.OSError as error:
-                    logger.warning(f"[OSError: {error}] upon sending automatic generation message. Ignoring.")
+                logger.info(f"[#{state.name}] Generated: {sentence}")
+                self.send_message(state.name, sentence)
             else:
-                logger.info("Attempted to output automatic generation message, but there is not enough learned information yet.")
-
-
-    def check_filter(self, message: str) -> bool:
-        """Returns True if message contains a banned word.
-        
-        Args:
-            message (str): The message to check.
-        """
-        for word in tokenize(message):
-            if word.lower() in self.blacklist:
-                return True
-        return False
+                logger.info(f"[#{state.name}] Attempted to output automatic generation message, but there is not enough learned information yet.")
 
     def check_if_our_command(self, message: str, *commands: "Tuple[str]") -> bool:
         """True if the first "word" of the message is in the tuple of commands
@@ -548,16 +788,13 @@ class MarkovChain:
         """
         return m.user == m.channel or m.user in self.allowed_users
 
-    def check_link(self, message: str) -> bool:
-        """True if `message` contains a link.
-
-        Args:
-            message (str): The message to check for a link.
-
-        Returns:
-            bool: True if the message contains a link.
-        """
-        return self.link_regex.search(message)
-
 if __name__ == "__main__":
+    # Turn SIGTERM (e.g. from `docker stop`) into a graceful shutdown
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    # Start or stop profiling with `kill -USR1`, e.g. `docker kill --signal=USR1 <container>`
+    if hasattr(signal, "SIGUSR1"):
+        signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.toggle())
+    # Write a memory report with `kill -USR2`
+    if hasattr(signal, "SIGUSR2"):
+        signal.signal(signal.SIGUSR2, lambda signum, frame: MEMORY_REPORTER.start())
     MarkovChain()
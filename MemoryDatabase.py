@@ -0,0 +1,459 @@
+import bisect, itertools, logging, sqlite3, string, sys, threading, time
+from array import array
+from typing import Any, Dict, List, Optional, Tuple
+
+from Database import Database
+from ModelStats import ModelStats
+from Timer import LoopingTimer
+
+logger = logging.getLogger(__name__)
+
+# SQLite's NOCASE collation only folds ASCII characters, so we do the same
+FOLD_TABLE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class MemoryDatabase(Database):
+    """
+    Database engine that keeps the entire Markov Chain in memory, and periodically writes the
+    changes to the regular `MarkovChain_{channel}.db` file.
+
+    Every word is interned once in `self.words`, and referred to by its integer id.
+    Lookups are case insensitive, just like the COLLATE NOCASE columns in the database,
+    so keys are built from the ids of the case folded words:
+
+    - `self.grammar` maps `fold(word1) << 32 | fold(word2)` to a tuple of an array of
+      successor word ids, an array of their counts, and the id of the original word2.
+    - `self.first_index` maps `fold(word1)` to the keys in `self.grammar` starting with that word.
+    - `self.starts` maps the suffix character of the first word to arrays of word1 ids,
+      word2 ids and counts, with `self.start_index` and `self.start_first` for lookups.
+
+    Learning only modifies these structures, and records the change in stored counts per n-gram,
+    i.e. already multiplied by the decay scale, exactly as it was applied in memory. These deltas are written to the database file every `snapshot_interval` seconds,
+    and on shutdown. Unlearning and purging are applied to both the memory and the file.
+    """
+    TRACK_PRUNED = True
+
+    def __init__(self, channel: str, snapshot_interval: int = 300):
+        super().__init__(channel)
+
+        self._lock = threading.RLock()
+        # Held while the deltas are written, so that unlearning and purging never reload n-grams
+        # from the database file before the deltas of a concurrent flush are in it.
+        # Always taken before `_lock`
+        self._flush_lock = threading.RLock()
+        self._dirty_grammar: Dict[Tuple[str, str, str], float] = {}
+        self._dirty_start: Dict[Tuple[str, str], float] = {}
+        self._reset()
+        self.load()
+
+        self.snapshot_timer = LoopingTimer(snapshot_interval, self.flush)
+        self.snapshot_timer.start()
+
+    def _reset(self) -> None:
+        """Create empty in-memory structures."""
+        self.words: List[str] = []
+        self.word_ids: Dict[str, int] = {}
+        # The id of the case folded version of every word, indexed by word id
+        self.fold_of = array("I")
+        self.grammar: Dict[int, Tuple[array, array, int]] = {}
+        self.first_index: Dict[int, array] = {}
+        self.starts: Dict[str, Tuple[array, array, array]] = {}
+        self.start_index: Dict[int, int] = {}
+        self.start_first: Dict[int, array] = {}
+        # Cumulative start counts per suffix, invalidated when learning
+        self._start_cumulative: Dict[str, List[float]] = {}
+        self.end_id = self.intern("<END>")
+
+    def intern(self, word: str) -> int:
+        """Get the id of `word`, adding it to the vocabulary if it is new.
+
+        Args:
+            word (str): The word to intern.
+
+        Returns:
+            int: The id of the word.
+        """
+        word_id = self.word_ids.get(word)
+        if word_id is None:
+            word_id = len(self.words)
+            self.words.append(word)
+            self.word_ids[word] = word_id
+            self.fold_of.append(word_id)
+            folded = word.translate(FOLD_TABLE)
+            if folded != word:
+                self.fold_of[word_id] = self.intern(folded)
+        return word_id
+
+    def fold_id(self, word: str) -> Optional[int]:
+        """Get the id of the case folded `word`, or None if it was never learned.
+
+        Args:
+            word (str): The word to look up.
+
+        Returns:
+            Optional[int]: The id of the case folded word.
+        """
+        return self.word_ids.get(word.translate(FOLD_TABLE))
+
+    def load(self) -> None:
+        """Stream all tables of the database file into memory, one row at a time."""
+        logger.info(f"Loading {self.db_name} into memory...")
+        start = time.perf_counter()
+        rows = 0
+        with self.connect() as conn:
+            self._attach_archive(conn)
+            self.scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+            for first_char in list(string.ascii_uppercase) + ["_"]:
+                for word1, word2, count in conn.execute(f"SELECT word1, word2, count FROM MarkovStart{first_char};"):
+                    self._add_start(word1, word2, count)
+                    rows += 1
+                for second_char in list(string.ascii_uppercase) + ["_"]:
+                    for word1, word2, word3, count in conn.execute(f"SELECT word1, word2, word3, count FROM MarkovGrammar{first_char}{second_char};"):
+                        self._add_rule(word1, word2, word3, count)
+                        rows += 1
+            # Everything is kept in memory, so archived 3-grams are loaded as well
+            if self.archive_name:
+                for word1, word2, word3, count in conn.execute("SELECT word1, word2, word3, count FROM archive.MarkovGrammar;"):
+                    self._add_rule(word1, word2, word3, count)
+                    rows += 1
+        stats = self.stats()
+        logger.info(f"Loaded {rows} rows with {stats['words']} words in {time.perf_counter() - start:.2f} seconds, "
+                    f"using roughly {stats['bytes'] / 2 ** 20:.1f}MB ({stats['bytes_per_ngram']:.0f} bytes per n-gram).")
+
+    def _add_rule(self, word1: str, word2: str, word3: str, count: float) -> None:
+        """Add `count` to the 3-gram `word1 word2 word3` in memory."""
+        id2 = self.intern(word2)
+        key = self.fold_of[self.intern(word1)] << 32 | self.fold_of[id2]
+        id3 = self.intern(word3)
+        entry = self.grammar.get(key)
+        if entry is None:
+            self.grammar[key] = (array("I", [id3]), array("d", [count]), id2)
+            self.first_index.setdefault(key >> 32, array("Q")).append(key)
+            return
+        ids, counts, _ = entry
+        try:
+            counts[ids.index(id3)] += count
+        except ValueError:
+            ids.append(id3)
+            counts.append(count)
+
+    def _add_start(self, word1: str, word2: str, count: float) -> None:
+        """Add `count` to the start `word1 word2` in memory."""
+        id1 = self.intern(word1)
+        id2 = self.intern(word2)
+        suffix = self.get_suffix(word1[0])
+        words1, words2, counts = self.starts.setdefault(suffix, (array("I"), array("I"), array("d")))
+        position = self.start_index.get(id1 << 32 | id2)
+        if position is None:
+            self.start_index[id1 << 32 | id2] = len(counts)
+            self.start_first.setdefault(self.fold_of[id1], array("I")).append(len(counts))
+            words1.append(id1)
+            words2.append(id2)
+            counts.append(count)
+        else:
+            counts[position] += count
+        self._start_cumulative.pop(suffix, None)
+
+    def _pick(self, ids: array, counts: array, index: int, allow_end: bool = True) -> Optional[str]:
+        """Randomly pick a word from `ids`, weighted by `counts`, like `Database.pick_word`."""
+        if self.end_id in ids:
+            weights = list(counts)
+            position = ids.index(self.end_id)
+            weights[position] = weights[position] * ((index + 1) / 15) if allow_end else 0
+            if not any(weights):
+                return None
+            return self.words[self.random.choices(ids, weights=weights)[0]]
+        return self.words[self.random.choices(ids, weights=counts)[0]]
+
+    def _successors(self, words: List[str]) -> Optional[Tuple[array, array, int]]:
+        """Get the successor ids and counts of the key `words`, if any."""
+        fold1 = self.fold_id(words[0])
+        fold2 = self.fold_id(words[1])
+        if fold1 is None or fold2 is None:
+            return None
+        entry = self.grammar.get(fold1 << 32 | fold2)
+        if entry is None or not entry[0]:
+            return None
+        return entry
+
+    def get_next(self, index: int, words: List[str]) -> Optional[str]:
+        with self._lock:
+            entry = self._successors(words)
+            return None if entry is None else self._pick(entry[0], entry[1], index)
+
+    def get_next_initial(self, index: int, words) -> Optional[str]:
+        with self._lock:
+            entry = self._successors(words)
+            return None if entry is None else self._pick(entry[0], entry[1], index, allow_end=False)
+
+    def get_next_single_initial(self, index: int, word: str) -> Optional[List[str]]:
+        with self._lock:
+            fold1 = self.fold_id(word)
+            keys = self.first_index.get(fold1) if fold1 is not None else None
+            if not keys:
+                return None
+            # Weigh every possible second word by the total count of its 3-grams
+            candidates = [self.grammar[key] for key in keys if key & 0xFFFFFFFF != self.end_id]
+            weights = [sum(entry[1]) for entry in candidates]
+            if not any(weights):
+                return None
+            return [word, self.words[self.random.choices(candidates, weights=weights)[0][2]]]
+
+    def get_next_single_start(self, word: str) -> Optional[List[str]]:
+        with self._lock:
+            fold1 = self.fold_id(word)
+            positions = self.start_first.get(fold1) if fold1 is not None else None
+            if not positions:
+                return None
+            _, words2, counts = self.starts[self.get_suffix(word[0])]
+            weights = [counts[position] for position in positions]
+            if not any(weights):
+                return None
+            return [word, self.words[words2[self.random.choices(positions, weights=weights)[0]]]]
+
+    def _cumulative_starts(self, character: str) -> List[float]:
+        """Get the cumulative start counts of the suffix `character`, computing them again if learning invalidated them."""
+        cumulative = self._start_cumulative.get(character)
+        if cumulative is None:
+            counts = self.starts[character][2] if character in self.starts else ()
+            cumulative = self._start_cumulative[character] = list(itertools.accumulate(counts))
+        return cumulative
+
+    def get_start(self) -> List[str]:
+        with self._lock:
+            # Find one character start from, weighted by the total count of its starts like the totals of
+            # ModelStats in Database.get_start, so that every start is picked in proportion to its count
+            characters = list(string.ascii_uppercase) + ["_"]
+            weights = [max(cumulative[-1], 0) if cumulative else 0 for cumulative in map(self._cumulative_starts, characters)]
+            character = self.random.choices(characters,
+                                       weights=weights if any(weights) else self.word_frequency,
+                                       k=1)[0]
+            cumulative = self._cumulative_starts(character)
+            if not cumulative or cumulative[-1] <= 0:
+                return []
+            words1, words2, counts = self.starts[character]
+            position = bisect.bisect_right(cumulative, self.random.random() * cumulative[-1])
+            position = min(position, len(counts) - 1)
+            return [self.words[words1[position]], self.words[words2[position]]]
+
+    def add_rule_queue(self, item: List[str], weight: int = 1) -> None:
+        # Filter out recursive case.
+        if self.check_equal(item):
+            return
+        if "" in item:
+            logger.warning(f"Failed to add item to rules. Item contains empty string: {item!r}")
+            return
+        with self._lock:
+            self._add_rule(*item, weight * self.scale)
+            key = tuple(item)
+            self._dirty_grammar[key] = self._dirty_grammar.get(key, 0) + weight * self.scale
+
+    def add_start_queue(self, item: List[str], weight: int = 1) -> None:
+        with self._lock:
+            self._add_start(*item, weight * self.scale)
+            key = tuple(item)
+            self._dirty_start[key] = self._dirty_start.get(key, 0) + weight * self.scale
+
+    def unlearn(self, message: str) -> None:
+        with self._flush_lock, self._lock:
+            # Write pending changes first, so the database file can be unlearned from directly,
+            # and then reload the affected keys, so memory matches the database file exactly
+            self.flush()
+            super().unlearn(message)
+
+            words = message.split(" ")
+            with self.connect() as conn:
+                self._attach_archive(conn)
+                if len(words) > 1 and all(words[:2]):
+                    self._reload_start(conn, words[0], words[1])
+                for word1, word2 in zip(words, words[1:-1]):
+                    if word1 and word2:
+                        self._reload_key(conn, word1, word2)
+
+    def _reload_start(self, conn: sqlite3.Connection, word1: str, word2: str) -> None:
+        """Replace the in-memory counts of the start `word1 word2` with those in the database file."""
+        fold1, fold2 = self.fold_id(word1), self.fold_id(word2)
+        if fold1 is None or fold2 is None:
+            return
+        suffix = self.get_suffix(word1[0])
+        words1, words2, counts = self.starts[suffix]
+        for position in self.start_first.get(fold1, []):
+            if self.fold_of[words2[position]] == fold2:
+                counts[position] = 0
+        for row_word1, row_word2, count in conn.execute(f"SELECT word1, word2, count FROM MarkovStart{suffix} WHERE word1 = ? AND word2 = ?;", (word1, word2)):
+            counts[self.start_index[self.word_ids[row_word1] << 32 | self.word_ids[row_word2]]] = count
+        self._start_cumulative.pop(suffix, None)
+
+    def _reload_key(self, conn: sqlite3.Connection, word1: str, word2: str) -> None:
+        """Replace the in-memory successors of the key `word1 word2` with those in the database file."""
+        fold1, fold2 = self.fold_id(word1), self.fold_id(word2)
+        if fold1 is None or fold2 is None:
+            return
+        key = fold1 << 32 | fold2
+        entry = self.grammar.get(key)
+        if entry is None:
+            return
+        del entry[0][:]
+        del entry[1][:]
+        query = f"SELECT word1, word2, word3, count FROM main.MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])} WHERE word1 = ? AND word2 = ?"
+        if self.archive_name:
+            query += " UNION ALL SELECT word1, word2, word3, count FROM archive.MarkovGrammar WHERE word1 = ? AND word2 = ?"
+        for row in conn.execute(query, (word1, word2) * (2 if self.archive_name else 1)):
+            self._add_rule(*row)
+
+    def _attach_archive(self, conn: sqlite3.Connection) -> None:
+        """Attach the archive of `Database.enable_archive` to `conn`, if there is one."""
+        if self.archive_name:
+            conn.execute("ATTACH DATABASE ? AS archive;", (self.archive_name,))
+
+    def purge_word(self, target_word: str) -> None:
+        with self._flush_lock, self._lock:
+            self.flush()
+            super().purge_word(target_word)
+
+            target = self.fold_id(target_word.strip())
+            if target is None:
+                return
+            for key in list(self.grammar):
+                if key >> 32 == target or key & 0xFFFFFFFF == target:
+                    del self.grammar[key]
+                    self.first_index[key >> 32].remove(key)
+                    continue
+                ids, counts, _ = self.grammar[key]
+                for position in reversed(range(len(ids))):
+                    if self.fold_of[ids[position]] == target:
+                        del ids[position]
+                        del counts[position]
+            for suffix, (words1, words2, counts) in self.starts.items():
+                for position in range(len(counts)):
+                    if self.fold_of[words1[position]] == target or self.fold_of[words2[position]] == target:
+                        counts[position] = 0
+                self._start_cumulative.pop(suffix, None)
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of changed n-grams waiting to be written by `flush`, and queries waiting in the execute queue."""
+        return len(self._dirty_grammar) + len(self._dirty_start) + super().queue_depth
+
+    def memory_components(self) -> Dict[str, Any]:
+        """Get the in-memory chain and the changes waiting to be written, along with the structures of `Database`."""
+        return {**super().memory_components(),
+                "chain": (self.words, self.word_ids, self.fold_of, self.grammar, self.first_index,
+                          self.starts, self.start_index, self.start_first, self._start_cumulative),
+                "dirty": (self._dirty_grammar, self._dirty_start)}
+
+    def compacted(self, cutoff: float, scale: float, renormalized: bool, pruned: Optional[Dict[str, List[Tuple]]] = None) -> None:
+        """Remove exactly the n-grams that Compactor removed from the database file from memory as well.
+
+        Their stored counts are subtracted, so that changes learned since the last flush are kept.
+        The next flush writes those as new n-grams.
+        """
+        with self._flush_lock, self._lock:
+            if renormalized:
+                # Every stored count changed, so start over from the database file
+                self._reset()
+                self.load()
+                return
+            self.scale = scale
+            for table, rows in (pruned or {}).items():
+                if "Grammar" in table:
+                    for word1, word2, word3, count in rows:
+                        self._remove_rule(word1, word2, word3, count)
+                else:
+                    for word1, word2, count in rows:
+                        self._remove_start(word1, word2, count)
+
+    def _remove_rule(self, word1: str, word2: str, word3: str, count: float) -> None:
+        """Subtract `count` from the 3-gram `word1 word2 word3` in memory, removing it if nothing is left."""
+        if word1 not in self.word_ids or word2 not in self.word_ids or word3 not in self.word_ids:
+            return
+        entry = self.grammar.get(self.fold_of[self.word_ids[word1]] << 32 | self.fold_of[self.word_ids[word2]])
+        if entry is None or self.word_ids[word3] not in entry[0]:
+            return
+        ids, counts, _ = entry
+        position = ids.index(self.word_ids[word3])
+        # Case variants of the key share the in-memory count, so only the removed row is subtracted
+        remaining = counts[position] - count
+        if remaining <= counts[position] * 1e-9:
+            del ids[position]
+            del counts[position]
+        else:
+            counts[position] = remaining
+
+    def _remove_start(self, word1: str, word2: str, count: float) -> None:
+        """Subtract `count` from the start `word1 word2` in memory."""
+        if word1 not in self.word_ids or word2 not in self.word_ids:
+            return
+        position = self.start_index.get(self.word_ids[word1] << 32 | self.word_ids[word2])
+        if position is None:
+            return
+        suffix = self.get_suffix(word1[0])
+        counts = self.starts[suffix][2]
+        remaining = counts[position] - count
+        counts[position] = 0 if remaining <= counts[position] * 1e-9 else remaining
+        self._start_cumulative.pop(suffix, None)
+
+    def flush(self) -> None:
+        """Write the changes in counts since the previous flush to the database file.
+
+        Learning and generation continue while the changes are written, but unlearning and purging wait for it.
+        """
+        with self._flush_lock:
+            with self._lock:
+                dirty_grammar, self._dirty_grammar = self._dirty_grammar, {}
+                dirty_start, self._dirty_start = self._dirty_start, {}
+            self.execute_commit()
+            if not dirty_grammar and not dirty_start:
+                return
+
+            start = time.perf_counter()
+            with self.connect() as conn:
+                cur = conn.cursor()
+                cur.execute("begin")
+                stats = ModelStats()
+                for (word1, word2, word3), delta in dirty_grammar.items():
+                    self._learn(cur, stats, f"MarkovGrammar{self.get_suffix(word1[0])}{self.get_suffix(word2[0])}", (word1, word2, word3), delta, scaled=True)
+                for (word1, word2), delta in dirty_start.items():
+                    self._learn(cur, stats, f"MarkovStart{self.get_suffix(word1[0])}", (word1, word2), delta, scaled=True)
+                stats.write(cur)
+                cur.execute("commit")
+                self.scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+        logger.debug(f"Wrote {len(dirty_grammar) + len(dirty_start)} changed n-grams to {self.db_name} in {time.perf_counter() - start:.2f} seconds.")
+
+    def stats(self) -> Dict[str, float]:
+        """Measure the size of the in-memory structures.
+
+        Returns:
+            Dict[str, float]: The number of words, keys and n-grams, the estimated number of bytes used,
+                and the estimated number of bytes per n-gram.
+        """
+        with self._lock:
+            ngrams = sum(len(ids) for ids, _, _ in self.grammar.values()) + sum(len(counts) for _, _, counts in self.starts.values())
+            size = sum(sys.getsizeof(obj) for obj in (self.words, self.word_ids, self.fold_of, self.grammar, self.first_index,
+                                                      self.start_index, self.start_first))
+            size += sum(sys.getsizeof(word) for word in self.words)
+            size += sum(sys.getsizeof(entry) + sys.getsizeof(entry[0]) + sys.getsizeof(entry[1]) for entry in self.grammar.values())
+            size += sum(sys.getsizeof(keys) for keys in self.first_index.values())
+            size += sum(sys.getsizeof(positions) for positions in self.start_first.values())
+            size += sum(sum(map(sys.getsizeof, bucket)) for bucket in self.starts.values())
+            return {
+                "words": len(self.words),
+                "keys": len(self.grammar),
+                "ngrams": ngrams,
+                "bytes": size,
+                "bytes_per_ngram": size / ngrams if ngrams else 0,
+            }
+
+if __name__ == "__main__":
+    # Load a channel into memory, and measure the memory usage and generation lookups per second.
+    # Usage: python MemoryDatabase.py <channel>
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    db = MemoryDatabase(sys.argv[1])
+    keys = [db.get_start() for _ in range(1000)]
+    keys = [key for key in keys if key] or [["<END>", "<END>"]]
+    start = time.perf_counter()
+    lookups = 0
+    while time.perf_counter() - start < 2:
+        for key in keys:
+            db.get_next(5, key)
+        lookups += len(keys)
+    print({**db.stats(), "lookups_per_second": round(lookups / (time.perf_counter() - start))})
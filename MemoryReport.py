@@ -0,0 +1,266 @@
+import ctypes, functools, gc, itertools, logging, os, sqlite3, sys, threading, time, tracemalloc, types
+from collections import deque
+from array import array
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+from CompiledModel import CompiledModel
+
+logger = logging.getLogger(__name__)
+
+# Objects that are shared with the rest of the process, or that refer to it, and are never counted as part of a component
+_SKIPPED = (type, types.ModuleType, types.FunctionType, types.MethodType, types.BuiltinFunctionType,
+            threading.Thread, logging.Logger, sqlite3.Connection)
+# Objects without references to other objects, for which `sys.getsizeof` is their entire size
+_LEAVES = (str, bytes, bytearray, array, int, float, bool, complex, memoryview, range, type(None))
+
+def deep_size(obj: object, sample: int = 100, max_depth: int = 8) -> int:
+    """Estimate the number of bytes used by `obj` and all objects it refers to.
+
+    Containers with more than `sample` items are estimated from `sample` evenly spaced items,
+    so that containers with millions of items are estimated in milliseconds. Objects that are
+    referred to more than once are counted once.
+
+    Args:
+        obj (object): The object to measure.
+        sample (int, optional): The number of items measured per container. Defaults to 100.
+        max_depth (int, optional): The number of references followed from `obj`. Defaults to 8.
+
+    Returns:
+        int: The estimated size in bytes.
+    """
+    seen = set()
+
+    def size(obj: object, depth: int) -> float:
+        if id(obj) in seen or isinstance(obj, _SKIPPED):
+            return 0
+        seen.add(id(obj))
+        total = sys.getsizeof(obj)
+        if depth >= max_depth or isinstance(obj, _LEAVES):
+            return total
+        if isinstance(obj, dict):
+            items = obj.items()
+        elif isinstance(obj, (list, tuple, set, frozenset, deque)):
+            items = obj
+        else:
+            attributes = getattr(obj, "__dict__", None)
+            return total + (size(attributes, depth + 1) if attributes is not None else 0)
+        if not items:
+            return total
+        step = max(len(obj) // sample, 1)
+        sampled = list(itertools.islice(iter(items), 0, None, step))
+        if isinstance(obj, dict):
+            items_size = sum(size(key, depth + 1) + size(value, depth + 1) for key, value in sampled)
+        else:
+            items_size = sum(size(item, depth + 1) for item in sampled)
+        return total + items_size * len(obj) / len(sampled)
+
+    # Containers that are changed by another thread while they are measured raise a RuntimeError, so try again
+    for _ in range(3):
+        try:
+            seen.clear()
+            return int(size(obj, 0))
+        except RuntimeError:
+            continue
+    return 0
+
+def process_memory() -> Tuple[int, int]:
+    """Get the resident set size of this process and its peak, in bytes, or the peak twice if the current size is not available."""
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f if ":" in line)
+        return int(status["VmRSS"].split()[0]) * 1024, int(status["VmHWM"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Kilobytes on Linux, bytes on macOS
+        peak *= 1 if sys.platform == "darwin" else 1024
+        return peak, peak
+
+@functools.lru_cache(maxsize=None)
+def _sqlite_status() -> Optional[Callable]:
+    """Get `sqlite3_status64` of the SQLite library that _sqlite3 links to, or is statically linked with, or None if it is not exported."""
+    try:
+        import _sqlite3
+        status = ctypes.CDLL(_sqlite3.__file__).sqlite3_status64
+    except (ImportError, OSError, AttributeError):
+        return None
+    status.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.POINTER(ctypes.c_int64), ctypes.c_int]
+    return status
+
+def sqlite_memory() -> Optional[Dict[str, int]]:
+    """Get the memory SQLite allocated in this process, over all connections, from `sqlite3_status64`.
+
+    The Database classes open a connection per call, so the page caches of all connections
+    that are open right now are part of the "page_cache" bytes.
+
+    Returns:
+        Optional[Dict[str, int]]: The bytes "used" and their "peak", and the bytes of the "page_cache"
+            and its "page_cache_peak". None if the SQLite library does not export `sqlite3_status64`.
+    """
+    status = _sqlite_status()
+    if status is None:
+        return None
+    values = {}
+    # SQLITE_STATUS_MEMORY_USED and SQLITE_STATUS_PAGECACHE_OVERFLOW, i.e. page cache allocated with malloc
+    for name, op in (("used", 0), ("page_cache", 2)):
+        current, peak = ctypes.c_int64(), ctypes.c_int64()
+        if status(op, ctypes.byref(current), ctypes.byref(peak), 0) != 0:
+            return None
+        values[name], values[f"{name}_peak"] = current.value, peak.value
+    return values
+
+def _mb(size: float) -> str:
+    return f"{size / 2 ** 20:.1f}MB"
+
+def _signed_mb(size: float) -> str:
+    return f"{'+' if size >= 0 else '-'}{abs(size) / 2 ** 20:.2f}MB"
+
+def _kb(size: float) -> str:
+    return f"{size / 2 ** 10:+.1f}KB"
+
+def _format_traceback(traceback: tracemalloc.Traceback) -> str:
+    """Format the frames of an allocation site from the innermost to the outermost, e.g. "Database.py:12 <- MarkovChainBot.py:34"."""
+    return " <- ".join(f"{frame.filename}:{frame.lineno}" for frame in reversed(traceback))
+
+class MemoryReporter:
+    """
+    Writes reports of the memory use of the bot to a log file, on command, on SIGUSR2 or on a schedule.
+
+    A report contains the resident set size of the process, the memory SQLite allocated, the cache
+    and mmap settings and mapped files per database, an estimate of the size of every component
+    returned by `components`, such as the execute queues and in-memory models, and the change of
+    each of these since the previous report.
+
+    While allocations are traced with `start_tracing`, reports also contain the source lines that
+    allocated the most memory, and the lines whose allocations grew the most since the previous
+    report, which is the most direct way of finding a leak. Tracing makes every allocation slower
+    and uses memory itself, so it is off by default.
+    """
+    def __init__(self, path: str = "/app/db/memory_reports.log") -> None:
+        self.path = path
+        # Gets the objects to estimate the size of by name, e.g. {"cubiedev.db.execute_queue": [...]}, set by MarkovChain
+        self.components: Callable[[], Dict[str, object]] = dict
+        # Gets the databases by channel name, set by MarkovChain
+        self.databases: Callable[[], Dict[str, object]] = dict
+        self.last_run = 0.0
+        self._previous: Optional[Dict[str, object]] = None
+        self._snapshot: Optional[tracemalloc.Snapshot] = None
+        self._lock = threading.Lock()
+
+    def start_tracing(self, frames: int = 1) -> None:
+        """Trace allocations from now on, recording `frames` frames of the call stack of each allocation."""
+        if tracemalloc.is_tracing():
+            logger.info("Memory allocations are already being traced.")
+            return
+        tracemalloc.start(max(int(frames), 1))
+        self._snapshot = None
+        logger.info(f"Tracing memory allocations with {max(int(frames), 1)} frame(s) per allocation.")
+
+    def stop_tracing(self) -> None:
+        """Stop tracing allocations, and free the memory used for tracing."""
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+            self._snapshot = None
+            logger.info("Stopped tracing memory allocations.")
+
+    def start(self) -> bool:
+        """Write a report in a daemon thread, as estimating large models can take a few seconds.
+
+        Returns:
+            bool: Whether a report was started, i.e. no report was being written already.
+        """
+        if self._lock.locked():
+            return False
+        threading.Thread(target=self.report, name="MemoryReporter", daemon=True).start()
+        return True
+
+    def report(self, top: int = 15) -> List[str]:
+        """Write a report with the `top` components and allocation sites to the log file, and log a summary.
+
+        Returns:
+            List[str]: The lines of the report.
+        """
+        with self._lock:
+            now = datetime.now()
+            rss, peak = process_memory()
+            current = {"time": now, "rss": rss, "components": {}, "sqlite": sqlite_memory()}
+            previous = self._previous or {}
+            lines = [f"=== Memory report at {now.isoformat(sep=' ', timespec='seconds')} ===",
+                     f"RSS {_mb(rss)}, peak {_mb(peak)}" + (f", {_signed_mb(rss - previous['rss'])} since "
+                     f"{previous['time'].isoformat(sep=' ', timespec='seconds')}" if previous else "") +
+                     f". {len(gc.get_objects())} objects tracked by the garbage collector."]
+
+            sqlite = current["sqlite"]
+            if sqlite:
+                lines.append(f"SQLite: {_mb(sqlite['used'])} allocated (peak {_mb(sqlite['used_peak'])}), "
+                             f"of which {_mb(sqlite['page_cache'])} page cache (peak {_mb(sqlite['page_cache_peak'])}).")
+            for channel, db in self.databases().items():
+                lines.append(f"#{channel}: {self.describe_database(db)}")
+
+            start = time.perf_counter()
+            try:
+                components = self.components()
+            except Exception:
+                logger.exception("Failed to collect the components for the memory report.")
+                components = {}
+            sizes = {name: deep_size(component) for name, component in components.items()}
+            current["components"] = sizes
+            lines.append(f"Estimated size of the {len(sizes)} components, measured in {time.perf_counter() - start:.2f}s:")
+            previous_sizes = previous.get("components", {})
+            for name, size in sorted(sizes.items(), key=lambda item: item[1], reverse=True)[:top]:
+                change = f" ({_signed_mb(size - previous_sizes[name])})" if name in previous_sizes else ""
+                lines.append(f"    {_mb(size):>10}{change}: {name}")
+            lines.append(f"    {_mb(sum(sizes.values())):>10}: total")
+
+            if tracemalloc.is_tracing():
+                snapshot = tracemalloc.take_snapshot().filter_traces((
+                    tracemalloc.Filter(False, tracemalloc.__file__),
+                    tracemalloc.Filter(False, __file__),
+                    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                ))
+                traced, traced_peak = tracemalloc.get_traced_memory()
+                lines.append(f"Top allocation sites, of {_mb(traced)} traced (peak {_mb(traced_peak)}, "
+                             f"tracing overhead {_mb(tracemalloc.get_tracemalloc_memory())}):")
+                # Group by the whole call stack if more than one frame is recorded
+                key = "traceback" if tracemalloc.get_traceback_limit() > 1 else "lineno"
+                for stat in snapshot.statistics(key)[:top]:
+                    lines.append(f"    {_kb(stat.size)[1:]:>12} in {stat.count:>8} blocks: {_format_traceback(stat.traceback)}")
+                if self._snapshot is not None:
+                    lines.append("Largest changes since the previous report:")
+                    for stat in snapshot.compare_to(self._snapshot, key)[:top]:
+                        lines.append(f"    {_kb(stat.size_diff):>12} ({stat.count_diff:+} blocks): {_format_traceback(stat.traceback)}")
+                self._snapshot = snapshot
+
+            self._previous = current
+            self.last_run = now.timestamp()
+            try:
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write("\n".join(lines) + "\n\n")
+            except OSError:
+                logger.exception(f"Failed to write the memory report to {self.path}.")
+            logger.info(f"RSS is {_mb(rss)}, with {_mb(sum(sizes.values()))} estimated in the bot's components. "
+                        f"Wrote a memory report to {self.path}.")
+            return lines
+
+    @staticmethod
+    def describe_database(db) -> str:
+        """Describe the size, cache and memory map settings of a Database, and its compiled model."""
+        try:
+            with db.connect() as conn:
+                page_size = conn.execute("PRAGMA page_size;").fetchone()[0]
+                pages = conn.execute("PRAGMA page_count;").fetchone()[0]
+                cache_size = conn.execute("PRAGMA cache_size;").fetchone()[0]
+                mmap_size = conn.execute("PRAGMA mmap_size;").fetchone()[0]
+        except sqlite3.Error as error:
+            return f"failed to read the database settings: {error}"
+        # A negative cache size is in KiB, a positive one in pages
+        cache_bytes = -cache_size * 1024 if cache_size < 0 else cache_size * page_size
+        description = (f"file {_mb(page_size * pages)}, page cache up to {_mb(cache_bytes)} per connection, "
+                       f"mmap_size {_mb(mmap_size)} ({_mb(min(mmap_size, page_size * pages))} mapped per connection)")
+        model = CompiledModel.path_for(db.channel)
+        if os.path.isfile(model):
+            description += f", compiled model file {_mb(os.path.getsize(model))}"
+        return description
+
+MEMORY_REPORTER = MemoryReporter()
@@ -0,0 +1,265 @@
+import bisect, http.server, logging, threading, time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+logger = logging.getLogger(__name__)
+
+Labels = Tuple[str, ...]
+
+def _escape(value: str) -> str:
+    """Escape a label value for the Prometheus text format."""
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(names: Sequence[str], values: Labels, extra: str = "") -> str:
+    """Format label names and values as `{name="value",...}`, escaped as the Prometheus text format requires."""
+    pairs = [f'{name}="{_escape(str(value))}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    """Format a sample value, with integers without a fraction."""
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+class Registry:
+    """The metrics exposed by a MetricsServer, in the order in which they were created."""
+    def __init__(self) -> None:
+        self.metrics: List[Union["Counter", "Histogram", "Gauge"]] = []
+        self._lock = threading.Lock()
+
+    def register(self, metric: Union["Counter", "Histogram", "Gauge"]) -> None:
+        """Add `metric`, replacing an earlier metric with the same name."""
+        with self._lock:
+            self.metrics = [other for other in self.metrics if other.name != metric.name] + [metric]
+
+    def render(self) -> str:
+        """Get all metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric in list(self.metrics):
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            try:
+                lines += metric.samples()
+            except Exception:
+                logger.exception(f"Failed to collect the metric {metric.name}.")
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+class Counter:
+    """
+    A value that only goes up, optionally per combination of label values.
+
+    Increments take a lock and a dict update, which is cheap enough to count every chat message.
+    """
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Registry = REGISTRY) -> None:
+        """Create a Counter and register it.
+
+        Args:
+            name (str): The name of the metric, ending in "_total".
+            documentation (str): The help text of the metric.
+            labelnames (Sequence[str], optional): The names of the labels. Defaults to ().
+            registry (Registry, optional): The registry to add the metric to. Defaults to REGISTRY.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def inc(self, amount: float = 1, labels: Labels = ()) -> None:
+        """Add `amount` to the counter of the label values `labels`."""
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def get(self, labels: Labels = ()) -> float:
+        """Get the value of the counter of the label values `labels`."""
+        return self._values.get(labels, 0)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = list(self._values.items())
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}" for labels, value in values]
+
+class Histogram:
+    """
+    Counts observations, such as latencies or batch sizes, in cumulative buckets.
+
+    `time()` measures the duration of a block, or of every call to a decorated function.
+    """
+    TYPE = "histogram"
+    # Buckets for latencies in seconds, from 100 microseconds to 10 seconds
+    LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    # Buckets for sizes, such as the number of queries in a transaction
+    SIZE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 10000)
+
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labelnames: Sequence[str] = (), registry: Registry = REGISTRY) -> None:
+        """Create a Histogram and register it.
+
+        Args:
+            name (str): The name of the metric.
+            documentation (str): The help text of the metric.
+            buckets (Sequence[float], optional): The increasing upper bounds of the buckets, without +Inf.
+                Defaults to LATENCY_BUCKETS.
+            labelnames (Sequence[str], optional): The names of the labels. Defaults to ().
+            registry (Registry, optional): The registry to add the metric to. Defaults to REGISTRY.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labelnames = tuple(labelnames)
+        # Per combination of label values, the count per bucket and +Inf, and the sum of all observations
+        self._counts: Dict[Labels, List[int]] = {}
+        self._sums: Dict[Labels, float] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def observe(self, value: float, labels: Labels = ()) -> None:
+        """Add an observation of `value` for the label values `labels`."""
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts = self._counts.get(labels)
+            if counts is None:
+                counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+                self._sums[labels] = 0.0
+            counts[index] += 1
+            self._sums[labels] += value
+
+    def time(self, labels: Labels = ()) -> "_Timer":
+        """Observe the number of seconds a `with` block or a decorated function takes."""
+        return _Timer(self, labels)
+
+    def samples(self) -> List[str]:
+        with self._lock:
+            values = [(labels, list(counts), self._sums[labels]) for labels, counts in self._counts.items()]
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+class _Timer:
+    """Context manager and decorator returned by `Histogram.time`."""
+    def __init__(self, histogram: Histogram, labels: Labels) -> None:
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self) -> "_Timer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+    def __call__(self, function: Callable) -> Callable:
+        histogram, labels = self.histogram, self.labels
+        def timed(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - start, labels)
+        timed.__name__ = function.__name__
+        timed.__doc__ = function.__doc__
+        timed.__wrapped__ = function
+        return timed
+
+class Gauge:
+    """
+    A value that can go up and down, computed by a callback whenever the metrics are collected,
+    so it costs nothing between collections.
+    """
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Union[float, Dict[Labels, float]]],
+                 labelnames: Sequence[str] = (), registry: Registry = REGISTRY) -> None:
+        """Create a Gauge and register it.
+
+        Args:
+            name (str): The name of the metric.
+            documentation (str): The help text of the metric.
+            callback (Callable[[], Union[float, Dict[Labels, float]]]): Returns the current value, or the
+                value per combination of label values if there are labels.
+            labelnames (Sequence[str], optional): The names of the labels. Defaults to ().
+            registry (Registry, optional): The registry to add the metric to. Defaults to REGISTRY.
+        """
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        registry.register(self)
+
+    def samples(self) -> List[str]:
+        values = self.callback()
+        if not isinstance(values, dict):
+            values = {(): values}
+        return [f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+                for labels, value in values.items() if value is not None]
+
+# Metrics recorded throughout the bot. Gauges that depend on the state of the bot are created by MarkovChain.
+MESSAGES_RECEIVED = Counter("markov_messages_received_total", "Chat messages received.", ["channel"])
+MESSAGES_FILTERED = Counter("markov_messages_filtered_total", "Chat messages that were not learned, per reason.", ["channel", "reason"])
+MESSAGES_ADMITTED = Counter("markov_messages_admitted_total", "Chat messages that passed all filters.", ["channel"])
+MESSAGES_LEARNED = Counter("markov_messages_learned_total", "Chat messages that were learned, after adaptive sampling.", ["channel"])
+MESSAGE_HANDLER_SECONDS = Histogram("markov_message_handler_seconds", "Time spent handling a message from the chat connection.")
+GENERATE_SECONDS = Histogram("markov_generate_seconds", "Time spent generating a sentence.")
+DB_SECONDS = Histogram("markov_db_seconds", "Time spent in Database.execute and Database.execute_commit.", labelnames=["operation"])
+DB_BATCH_SIZE = Histogram("markov_db_batch_size", "Number of queued queries written per execute_commit transaction.",
+                          Histogram.SIZE_BUCKETS)
+CACHE_REQUESTS = Counter("markov_cache_requests_total", "Lookups in caches, per cache and result (hit or miss).", ["cache", "result"])
+
+def cache_hit_ratios() -> Dict[Labels, Optional[float]]:
+    """Get the fraction of lookups that were hits, per cache in CACHE_REQUESTS."""
+    caches = {labels[0] for labels in list(CACHE_REQUESTS._values)}
+    ratios = {}
+    for cache in caches:
+        hits, misses = CACHE_REQUESTS.get((cache, "hit")), CACHE_REQUESTS.get((cache, "miss"))
+        ratios[(cache,)] = hits / (hits + misses) if hits + misses else None
+    return ratios
+
+CACHE_HIT_RATIO = Gauge("markov_cache_hit_ratio", "Fraction of cache lookups that were hits since startup.", cache_hit_ratios, ["cache"])
+
+class MetricsServer:
+    """Serves the metrics of a Registry over HTTP at /metrics, from a daemon thread."""
+    def __init__(self, port: int, host: str = "127.0.0.1", registry: Registry = REGISTRY) -> None:
+        """Start serving on `host`:`port`.
+
+        Args:
+            port (int): The port to listen on.
+            host (str, optional): The address to listen on. Defaults to "127.0.0.1", i.e. only local connections.
+            registry (Registry, optional): The metrics to serve. Defaults to REGISTRY.
+        """
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                if self.path.split("?")[0] not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = registry.render().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format: str, *args) -> None:
+                logger.debug(format % args)
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        logger.info(f"Serving metrics at http://{host}:{self.server.server_address[1]}/metrics")
+
+    def stop(self) -> None:
+        """Stop serving."""
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,382 @@
+import logging, os, sqlite3, string, sys, time
+from abc import ABC, abstractmethod
+from typing import List, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUFFIXES = list(string.ascii_uppercase) + ["_"]
+
+def suffix_sql(column: str) -> str:
+    """Get an SQL expression for the table suffix of the first character of `column`, like `Database.get_suffix`."""
+    first = f"upper(substr({column}, 1, 1))"
+    return f"(CASE WHEN {first} BETWEEN 'A' AND 'Z' THEN {first} ELSE '_' END)"
+
+def suffix(character: str) -> str:
+    """Get the table suffix of `character`, like `Database.get_suffix`."""
+    if character.lower() in string.ascii_lowercase:
+        return character.upper()
+    return "_"
+
+def get_version(conn: sqlite3.Connection, schema: str = "main") -> int:
+    """Get the version in the Version table of `schema`, or 0 if it does not exist."""
+    try:
+        version = conn.execute(f"SELECT max(version) FROM {schema}.Version;").fetchone()[0]
+    except sqlite3.OperationalError:
+        return 0
+    return version or 0
+
+class Migration(ABC):
+    """
+    A step that updates the structure of a database file, one table at a time.
+
+    `run` migrates every table in its own transaction, which also records the table in the
+    MigrationProgress table, so an interrupted migration continues with the first table that
+    was not finished yet.
+    Work is done with set-based statements, such as `INSERT ... SELECT ... GROUP BY`, wherever possible.
+    """
+    # The version of the database after this migration
+    version = 0
+    description = ""
+
+    @abstractmethod
+    def needed(self, conn: sqlite3.Connection) -> bool:
+        """Whether the database of `conn` still needs this migration."""
+
+    def prepare(self, conn: sqlite3.Connection) -> None:
+        """Create everything the tables are migrated into. Must be safe to call again when resuming."""
+        pass
+
+    @abstractmethod
+    def tables(self, conn: sqlite3.Connection) -> List[str]:
+        """Get the tables that still need to be migrated, in order."""
+
+    @abstractmethod
+    def migrate_table(self, conn: sqlite3.Connection, table: str) -> int:
+        """Migrate `table` inside the transaction of `run`, and return the number of rows that were read."""
+
+    def finish(self, conn: sqlite3.Connection) -> None:
+        """Finish up after all tables were migrated, inside the transaction of `run`."""
+        pass
+
+    def run(self, conn: sqlite3.Connection) -> None:
+        """Migrate all remaining tables, logging the progress and throughput.
+
+        Args:
+            conn (sqlite3.Connection): A connection in autocommit mode, i.e. with `isolation_level=None`.
+        """
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS MigrationProgress (
+            version INTEGER,
+            name TEXT,
+            rows INTEGER,
+            seconds REAL,
+            PRIMARY KEY (version, name)
+        );""")
+        done, done_rows = conn.execute("SELECT count(*), coalesce(sum(rows), 0) FROM MigrationProgress WHERE version = ?;",
+                                       (self.version,)).fetchone()
+        if done:
+            logger.info(f"Resuming migration to version {self.version}, {done} tables with {done_rows} rows were already migrated.")
+        else:
+            logger.info(f"Migrating database to version {self.version}: {self.description}")
+        self.prepare(conn)
+
+        done_tables = {name for name, in conn.execute("SELECT name FROM MigrationProgress WHERE version = ?;", (self.version,))}
+        tables = [table for table in self.tables(conn) if table not in done_tables]
+        start = time.perf_counter()
+        last_report = start
+        rows = 0
+        for i, table in enumerate(tables):
+            table_start = time.perf_counter()
+            conn.execute("BEGIN IMMEDIATE;")
+            try:
+                table_rows = self.migrate_table(conn, table)
+                conn.execute("INSERT OR REPLACE INTO MigrationProgress (version, name, rows, seconds) VALUES (?, ?, ?, ?);",
+                             (self.version, table, table_rows, time.perf_counter() - table_start))
+                conn.execute("COMMIT;")
+            except BaseException:
+                conn.execute("ROLLBACK;")
+                raise
+            rows += table_rows
+
+            now = time.perf_counter()
+            logger.debug(f"Migrated {table} with {table_rows} rows in {now - table_start:.2f} seconds.")
+            if now - last_report > 10 or i == len(tables) - 1:
+                last_report = now
+                logger.info(f"[{(i + 1) / len(tables) * 100:.2f}%] Migrated {i + 1} of {len(tables)} tables, "
+                            f"{rows} rows at {rows / max(now - start, 1e-9):.0f} rows per second.")
+
+        conn.execute("BEGIN IMMEDIATE;")
+        self.finish(conn)
+        conn.execute("DELETE FROM MigrationProgress WHERE version = ?;", (self.version,))
+        conn.execute("COMMIT;")
+        logger.info(f"Finished migrating to version {self.version} in {time.perf_counter() - start:.2f} seconds.")
+
+class SplitTables(Migration):
+    """Version 1: Split up MarkovGrammarA, MarkovGrammarB, etc. by the first character of the second word.
+
+    The "Other" tables and the tables for digits are merged into the "_" tables first. Every table
+    that is split gets an index on the suffix of the second word, so that it is read once,
+    rather than once per new table. The split table is dropped afterwards.
+    """
+    version = 1
+    description = "splitting MarkovGrammar tables by the first two characters."
+
+    def __init__(self, db_name: str):
+        self.db_name = db_name
+
+    def needed(self, conn: sqlite3.Connection) -> bool:
+        return bool(self.tables(conn))
+
+    def prepare(self, conn: sqlite3.Connection) -> None:
+        backup_name = self.db_name[:-3] + "_backup.db"
+        if not conn.execute("SELECT 1 FROM MigrationProgress WHERE version = ?;", (self.version,)).fetchone():
+            logger.info("Creating backup before updating Database...")
+            with sqlite3.connect(backup_name) as back_conn:
+                conn.backup(back_conn, pages=1000)
+            logger.info(f"Created backup {backup_name}.")
+
+        for table in ("MarkovStart_", "MarkovGrammar_"):
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                word1 TEXT COLLATE NOCASE,
+                word2 TEXT COLLATE NOCASE,
+                {"word3 TEXT COLLATE NOCASE," if table == "MarkovGrammar_" else ""}
+                occurances INTEGER,
+                PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY{", word3 COLLATE BINARY" if table == "MarkovGrammar_" else ""})
+            );""")
+
+    def tables(self, conn: sqlite3.Connection) -> List[str]:
+        existing = {name for name, in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table';")}
+        merged = [f"{kind}{character}" for character in ["Other"] + list(string.digits) for kind in ("MarkovGrammar", "MarkovStart")]
+        split = [f"MarkovGrammar{character}" for character in SUFFIXES]
+        return [table for table in merged + split if table in existing]
+
+    def migrate_table(self, conn: sqlite3.Connection, table: str) -> int:
+        rows = conn.execute(f"SELECT count(*) FROM {table};").fetchone()[0]
+        if not table.startswith("MarkovGrammar") or table[len("MarkovGrammar"):] not in SUFFIXES:
+            # "Other" and digits are merged into "_"
+            conn.execute(f"INSERT INTO {table.rstrip(string.digits).replace('Other', '')}_ SELECT * FROM {table};")
+            conn.execute(f"DROP TABLE {table};")
+            return rows
+
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {table}Split ON {table} ({suffix_sql('word2')});")
+        for second_char in SUFFIXES:
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table}{second_char} (
+                word1 TEXT COLLATE NOCASE,
+                word2 TEXT COLLATE NOCASE,
+                word3 TEXT COLLATE NOCASE,
+                occurances INTEGER,
+                PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
+            );""")
+            conn.execute(f"INSERT INTO {table}{second_char} SELECT * FROM {table} WHERE {suffix_sql('word2')} = ?;", (second_char,))
+        conn.execute(f"DROP TABLE {table};")
+        return rows
+
+class RenameCount(Migration):
+    """Version 2: Rename the misspelled "occurances" column to "count".
+
+    `ALTER TABLE ... RENAME COLUMN` checks the entire schema for every table, which takes minutes for
+    all 756 tables. Instead, the column is renamed in the stored CREATE TABLE statements of all tables
+    at once, in a single atomic schema change. Nothing else refers to the column, and the data
+    of a table does not depend on its column names.
+    """
+    version = 2
+    description = "renaming \"occurances\" to \"count\"."
+
+    def needed(self, conn: sqlite3.Connection) -> bool:
+        return bool(self.tables(conn))
+
+    def tables(self, conn: sqlite3.Connection) -> List[str]:
+        # A single unit of work, as all tables are changed at once
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name LIKE 'Markov%' AND sql LIKE '%occurances INTEGER%';").fetchone():
+            return ["sqlite_master"]
+        return []
+
+    def migrate_table(self, conn: sqlite3.Connection, table: str) -> int:
+        schema_version = conn.execute("PRAGMA schema_version;").fetchone()[0]
+        conn.execute("PRAGMA writable_schema = ON;")
+        rows = conn.execute("""
+            UPDATE sqlite_master SET sql = replace(sql, 'occurances INTEGER', 'count INTEGER')
+            WHERE type = 'table' AND name LIKE 'Markov%';""").rowcount
+        # Make every connection reload the schema
+        conn.execute(f"PRAGMA schema_version = {schema_version + 1};")
+        conn.execute("PRAGMA writable_schema = OFF;")
+        return rows
+
+class Retokenize(Migration):
+    """Version 3: Re-tokenize all learned n-grams, to mark punctuation as a separate word.
+
+    Previously, "Hello," was a valid single word. Now, it would be split as "Hello" and ",".
+    This allows people to generate "!g hello", and have the bot generate "hello, how are you?",
+    or have "!g it" result in "it's a wonderful day".
+
+    This migration runs on a new database file, with the original attached as "old", see `migrate`.
+    The words of every row of an old table are joined and tokenized again in Python, which cannot
+    be done in SQL. The resulting n-grams are inserted into a temporary staging table, and then
+    summed into the new tables with one `INSERT ... SELECT ... GROUP BY` per target table.
+    """
+    version = 3
+    description = "re-tokenizing, for better punctuation handling."
+
+    def needed(self, conn: sqlite3.Connection) -> bool:
+        return get_version(conn) < 3
+
+    def prepare(self, conn: sqlite3.Connection) -> None:
+        for first_char in SUFFIXES:
+            conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS main.MarkovStart{first_char} (
+                word1 TEXT COLLATE NOCASE,
+                word2 TEXT COLLATE NOCASE,
+                count INTEGER,
+                PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY)
+            );""")
+            for second_char in SUFFIXES:
+                conn.execute(f"""
+                CREATE TABLE IF NOT EXISTS main.MarkovGrammar{first_char}{second_char} (
+                    word1 TEXT COLLATE NOCASE,
+                    word2 TEXT COLLATE NOCASE,
+                    word3 TEXT COLLATE NOCASE,
+                    count INTEGER,
+                    PRIMARY KEY (word1 COLLATE BINARY, word2 COLLATE BINARY, word3 COLLATE BINARY)
+                );""")
+        # Without COLLATE NOCASE, so that GROUP BY only merges identical n-grams
+        conn.execute("CREATE TEMP TABLE IF NOT EXISTS Staging (target TEXT, word1 TEXT, word2 TEXT, word3 TEXT, count INTEGER);")
+        conn.execute("CREATE INDEX IF NOT EXISTS temp.StagingTarget ON Staging (target);")
+
+    def tables(self, conn: sqlite3.Connection) -> List[str]:
+        existing = {name for name, in conn.execute("SELECT name FROM old.sqlite_master WHERE type = 'table';")}
+        tables = []
+        for first_char in SUFFIXES:
+            tables.append(f"MarkovStart{first_char}")
+            tables += [f"MarkovGrammar{first_char}{second_char}" for second_char in SUFFIXES]
+        return [table for table in tables if table in existing]
+
+    def migrate_table(self, conn: sqlite3.Connection, table: str) -> int:
+        from Tokenizer import tokenize
+        from nltk import ngrams
+
+        is_start = table.startswith("MarkovStart")
+        staged: List[Tuple[str, str, str, str, int]] = []
+        targets: Set[str] = set()
+        rows = 0
+        for row in conn.execute(f"SELECT * FROM old.{table};"):
+            rows += 1
+            # Remove "count" from the row for now
+            count = row[-1]
+            words = list(row[:-1])
+
+            if is_start:
+                two_gram = tokenize(" ".join(words))[:2]
+                # In case there was some issue in the previous Database
+                if len(two_gram) < 2:
+                    continue
+                target = f"MarkovStart{suffix(two_gram[0][0])}"
+                staged.append((target, two_gram[0], two_gram[1], None, count))
+                targets.add(target)
+            else:
+                # If it ends on "<END>", ignore that, as we don't want it to get tokenized
+                end = words[-1] == "<END>"
+                if end:
+                    words = words[:-1]
+                tokenized = tokenize(" ".join(words))
+                if end:
+                    tokenized.append("<END>")
+
+                for ngram in ngrams(tokenized, 3):
+                    # Filter out recursive case.
+                    if ngram[0] == ngram[1] == ngram[2]:
+                        continue
+                    target = f"MarkovGrammar{suffix(ngram[0][0])}{suffix(ngram[1][0])}"
+                    staged.append((target, *ngram, count))
+                    targets.add(target)
+
+        conn.executemany("INSERT INTO temp.Staging (target, word1, word2, word3, count) VALUES (?, ?, ?, ?, ?);", staged)
+        for target in sorted(targets):
+            if is_start:
+                conn.execute(f"""
+                INSERT INTO main.{target} (word1, word2, count)
+                SELECT word1, word2, sum(count) FROM temp.Staging WHERE target = ? GROUP BY word1, word2
+                ON CONFLICT (word1, word2) DO UPDATE SET count = count + excluded.count;""", (target,))
+            else:
+                conn.execute(f"""
+                INSERT INTO main.{target} (word1, word2, word3, count)
+                SELECT word1, word2, word3, sum(count) FROM temp.Staging WHERE target = ? GROUP BY word1, word2, word3
+                ON CONFLICT (word1, word2, word3) DO UPDATE SET count = count + excluded.count;""", (target,))
+        conn.execute("DELETE FROM temp.Staging;")
+        return rows
+
+    def finish(self, conn: sqlite3.Connection) -> None:
+        # Copy all other tables, such as WhisperIgnore
+        for name, sql in conn.execute("""
+            SELECT name, sql FROM old.sqlite_master
+            WHERE type = 'table' AND name NOT LIKE 'Markov%' AND name NOT LIKE 'sqlite%' AND name != 'Version';""").fetchall():
+            conn.execute(sql.replace("CREATE TABLE", "CREATE TABLE IF NOT EXISTS", 1))
+            conn.execute(f"INSERT OR IGNORE INTO main.{name} SELECT * FROM old.{name};")
+        conn.execute("CREATE TABLE IF NOT EXISTS main.Version (version INTEGER);")
+        conn.execute("DELETE FROM main.Version;")
+        conn.execute("INSERT INTO main.Version (version) VALUES (3);")
+
+def migrate(db_name: str) -> None:
+    """Update the database file `db_name` to the newest version, if it exists.
+
+    Versions 1 and 2 are migrated in place, after creating `MarkovChain_{channel}_backup.db`.
+    Version 3 is migrated into a new file, `MarkovChain_{channel}_modified.db`, and the original is never changed.
+    Once the migration is done, the original is renamed to `MarkovChain_{channel}_backup.db`,
+    and the new file takes its place.
+    *This `MarkovChain_{channel}_backup.db` file can safely be deleted, as it is NOT used*
+
+    Every migration continues where it stopped if it was interrupted.
+
+    Args:
+        db_name (str): The path of the database file, e.g. "/app/db/MarkovChain_cubiedev.db".
+    """
+    modified_name = db_name[:-3] + "_modified.db"
+    backup_name = db_name[:-3] + "_backup.db"
+    if not os.path.isfile(db_name):
+        if os.path.isfile(modified_name) and os.path.isfile(backup_name):
+            # Interrupted between renaming the original and renaming the migrated file
+            os.replace(modified_name, db_name)
+        return
+
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    try:
+        # Versions 1 and 2 predate the Version table, so check for them only if it is missing
+        if get_version(conn) >= 3:
+            return
+        for migration in (SplitTables(db_name), RenameCount()):
+            if migration.needed(conn):
+                migration.run(conn)
+        retokenize = Retokenize()
+        if not retokenize.needed(conn):
+            return
+    finally:
+        conn.close()
+
+    conn = sqlite3.connect(modified_name, isolation_level=None)
+    try:
+        # Let Compactor return freed pages to the filesystem, like new databases.
+        # This has no effect when resuming, as the tables already exist.
+        conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+        conn.execute("ATTACH DATABASE ? AS old;", (db_name,))
+        retokenize.run(conn)
+    finally:
+        conn.close()
+
+    # Turn the non-modified, old version of the Database into a "_backup.db" file,
+    # and turn the modified file into the new main file.
+    os.replace(db_name, backup_name)
+    os.replace(modified_name, db_name)
+    logger.info(f"Renamed original database file \"{os.path.basename(db_name)}\" to \"{os.path.basename(backup_name)}\". "
+                "This file is *not* used, and can safely be deleted.")
+
+if __name__ == "__main__":
+    # Migrate the databases of channels offline, before starting the bot.
+    # Opening them as a Database also creates the tables of versions after 3.
+    # Usage: python Migrations.py <channel> [<channel> ...]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    from Database import Database
+    for channel in sys.argv[1:]:
+        db_name = f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.db"
+        if os.path.isfile(db_name) or os.path.isfile(db_name[:-3] + "_modified.db"):
+            Database(channel)
@@ -0,0 +1,224 @@
+import logging, sqlite3, string, sys, time
+from typing import Dict, List, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUFFIXES = list(string.ascii_uppercase) + ["_"]
+
+class ModelStats:
+    """
+    Keeps the number of rows and the total stored count of every n-gram table, and the size of the
+    vocabulary, in the ModelStats table of a database, so they can be read with a single small query
+    rather than by scanning 756 tables.
+
+    ModelStats has a row (name, rows, total) for every table, e.g. "MarkovStartA", "MarkovGrammarAB"
+    and "archive.MarkovGrammar", and a row "Vocabulary" whose `rows` is the number of distinct words
+    that can be generated, i.e. that were learned as the third word of a 3-gram, excluding "<END>".
+    ModelVocabulary holds the number of 3-grams ending in each of these words.
+    ModelStats also has a row "TrieNode" with the number of nodes of the trie of TrieDatabase, which
+    is only used for key lengths other than 2, and the total of their stored counts.
+
+    Writers create a ModelStats for every transaction, account for every change in it right before
+    making the change, and call `write` before committing. The statistics are therefore exactly as
+    durable as the n-grams themselves.
+    """
+    VOCABULARY = "Vocabulary"
+    TRIE = "TrieNode"
+
+    def __init__(self) -> None:
+        # Changes in the number of rows and the total count per table
+        self.rows: Dict[str, int] = {}
+        self.totals: Dict[str, float] = {}
+        # Changes in the number of 3-grams ending in a word
+        self.refs: Dict[str, int] = {}
+        self._scale = None
+
+    @staticmethod
+    def create(conn: sqlite3.Connection) -> None:
+        """Create the ModelStats and ModelVocabulary tables if they do not exist yet."""
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS ModelStats (
+            name TEXT PRIMARY KEY,
+            rows INTEGER NOT NULL,
+            total REAL NOT NULL
+        );""")
+        conn.execute("""
+        CREATE TABLE IF NOT EXISTS ModelVocabulary (
+            word TEXT PRIMARY KEY,
+            refs INTEGER NOT NULL
+        );""")
+
+    @staticmethod
+    def tables(conn: sqlite3.Connection) -> List[str]:
+        """Get the qualified names of all n-gram tables, including the archive if it is attached to `conn`."""
+        tables = [f"MarkovStart{first_char}" for first_char in SUFFIXES]
+        tables += [f"MarkovGrammar{first_char}{second_char}" for first_char in SUFFIXES for second_char in SUFFIXES]
+        if any(name == "archive" for _, name, _ in conn.execute("PRAGMA database_list;")):
+            tables.append("archive.MarkovGrammar")
+        return tables
+
+    @staticmethod
+    def trie_tables(conn: sqlite3.Connection) -> List[str]:
+        """Get ["TrieNode"] if the database of `conn` has the trie of TrieDatabase, and an empty list otherwise."""
+        return [ModelStats.TRIE] if conn.execute("SELECT 1 FROM main.sqlite_master WHERE name = ?;", (ModelStats.TRIE,)).fetchone() else []
+
+    @staticmethod
+    def rebuild(conn: sqlite3.Connection) -> None:
+        """Recompute all statistics by scanning every table, in a single transaction.
+
+        Args:
+            conn (sqlite3.Connection): A connection in autocommit mode, with the archive attached if there is one.
+        """
+        start = time.perf_counter()
+        ModelStats.create(conn)
+        conn.execute("BEGIN IMMEDIATE;")
+        try:
+            conn.execute("DELETE FROM ModelStats;")
+            conn.execute("DELETE FROM ModelVocabulary;")
+            for table in ModelStats.tables(conn) + ModelStats.trie_tables(conn):
+                conn.execute(f"INSERT INTO ModelStats (name, rows, total) SELECT ?, count(*), total(count) FROM {table};", (table,))
+                if "Grammar" in table:
+                    conn.execute(f"""
+                        INSERT INTO ModelVocabulary (word, refs)
+                        SELECT word3, count(*) FROM {table} WHERE word3 != '<END>' GROUP BY word3 COLLATE BINARY
+                        ON CONFLICT (word) DO UPDATE SET refs = refs + excluded.refs;""")
+            conn.execute("INSERT INTO ModelStats (name, rows, total) SELECT ?, count(*), 0 FROM ModelVocabulary;", (ModelStats.VOCABULARY,))
+            conn.execute("COMMIT;")
+        except BaseException:
+            conn.execute("ROLLBACK;")
+            raise
+        logger.info(f"Computed the model statistics in {time.perf_counter() - start:.2f} seconds.")
+
+    @staticmethod
+    def read(conn: sqlite3.Connection) -> Dict[str, Tuple[int, float]]:
+        """Get the number of rows and the total stored count of every table, and the vocabulary size as ("Vocabulary", (size, 0)).
+
+        Returns an empty dict if the statistics do not exist yet.
+        """
+        try:
+            return {name: (rows, total) for name, rows, total in conn.execute("SELECT name, rows, total FROM ModelStats;")}
+        except sqlite3.OperationalError:
+            return {}
+
+    @staticmethod
+    def summary(stats: Dict[str, Tuple[int, float]], scale: float = 1.0) -> Dict[str, float]:
+        """Summarize the result of `read`.
+
+        Args:
+            stats (Dict[str, Tuple[int, float]]): The statistics from `read`.
+            scale (float, optional): The decay scale, to turn stored counts into effective counts. Defaults to 1.0.
+
+        Returns:
+            Dict[str, float]: The number of 3-grams and starts, their total effective counts, the number
+                of archived 3-grams, the vocabulary size, and the number of trie nodes with their total effective count.
+        """
+        summary = {"ngrams": 0, "ngram_total": 0.0, "archived": 0, "starts": 0, "start_total": 0.0,
+                   "vocabulary": stats.get(ModelStats.VOCABULARY, (0, 0))[0],
+                   "trie_nodes": stats.get(ModelStats.TRIE, (0, 0))[0],
+                   "trie_total": stats.get(ModelStats.TRIE, (0, 0))[1] / scale}
+        for name, (rows, total) in stats.items():
+            if name.startswith("MarkovStart"):
+                summary["starts"] += rows
+                summary["start_total"] += total / scale
+            elif "MarkovGrammar" in name:
+                summary["ngrams"] += rows
+                summary["ngram_total"] += total / scale
+                if name.startswith("archive."):
+                    summary["archived"] += rows
+        return summary
+
+    def scale(self, cur: sqlite3.Cursor) -> float:
+        """Get the scale of the Decay table, read once per transaction."""
+        if self._scale is None:
+            self._scale = cur.execute("SELECT scale FROM main.Decay;").fetchone()[0]
+        return self._scale
+
+    def learn(self, cur: sqlite3.Cursor, table: str, words: Sequence[str], weight: float) -> None:
+        """Account for adding `weight` times the decay scale to the n-gram `words` of `table`, before it is written.
+
+        Args:
+            cur (sqlite3.Cursor): A cursor in the transaction that learns the n-gram.
+            table (str): The table of the n-gram, e.g. "MarkovGrammarAB".
+            words (Sequence[str]): The 2 or 3 words of the n-gram.
+            weight (float): The weight that is learned, before multiplying it with the decay scale.
+        """
+        where = " AND ".join(f"word{i + 1} = ? COLLATE BINARY" for i in range(len(words)))
+        new = cur.execute(f"SELECT 1 FROM {table} WHERE {where};", tuple(words)).fetchone() is None
+        self.learned(table, words, weight * self.scale(cur), new)
+
+    def learned(self, table: str, words: Sequence[str], delta: float, new: bool) -> None:
+        """Account for adding `delta` to the stored count of the n-gram `words` of `table`, which did not exist before if `new`.
+
+        For trie nodes, `words` is empty.
+        """
+        if new:
+            self.rows[table] = self.rows.get(table, 0) + 1
+            if len(words) == 3 and words[2] != "<END>":
+                self.refs[words[2]] = self.refs.get(words[2], 0) + 1
+        self.totals[table] = self.totals.get(table, 0) + delta
+
+    def change(self, cur: sqlite3.Cursor, table: str, where: str, values: Sequence, delta: float) -> None:
+        """Account for adding `delta` to the stored count of every row of `table` matching `where`, before it is updated."""
+        rows = cur.execute(f"SELECT count(*) FROM {table} WHERE {where};", tuple(values)).fetchone()[0]
+        self.totals[table] = self.totals.get(table, 0) + rows * delta
+
+    def delete(self, cur: sqlite3.Cursor, table: str, where: str, values: Sequence = ()) -> None:
+        """Account for deleting all rows of `table` matching `where`, before they are deleted."""
+        rows, total = cur.execute(f"SELECT count(*), total(count) FROM {table} WHERE {where};", tuple(values)).fetchone()
+        if not rows:
+            return
+        self.rows[table] = self.rows.get(table, 0) - rows
+        self.totals[table] = self.totals.get(table, 0) - total
+        if "Grammar" in table:
+            for word, refs in cur.execute(f"""
+                SELECT word3, count(*) FROM {table} WHERE ({where}) AND word3 != '<END>'
+                GROUP BY word3 COLLATE BINARY;""", tuple(values)):
+                self.refs[word] = self.refs.get(word, 0) - refs
+
+    def move(self, cur: sqlite3.Cursor, source: str, target: str, where: str, values: Sequence = ()) -> None:
+        """Account for moving all rows of `source` matching `where` to `target`, e.g. to or from the archive, before they are moved."""
+        rows, total = cur.execute(f"SELECT count(*), total(count) FROM {source} WHERE {where};", tuple(values)).fetchone()
+        self.rows[source] = self.rows.get(source, 0) - rows
+        self.totals[source] = self.totals.get(source, 0) - total
+        self.rows[target] = self.rows.get(target, 0) + rows
+        self.totals[target] = self.totals.get(target, 0) + total
+
+    def write(self, cur: sqlite3.Cursor) -> None:
+        """Apply the accounted changes to the ModelStats and ModelVocabulary tables, in the transaction of `cur`."""
+        if not self.rows and not self.totals and not self.refs:
+            return
+        refs = [(word, delta) for word, delta in self.refs.items() if delta]
+        # Words that were not in the vocabulary yet are inserted with 0 references first, and words that lost
+        # all their references are removed afterwards, so the vocabulary size changes by the difference.
+        cur.executemany("INSERT OR IGNORE INTO main.ModelVocabulary (word, refs) VALUES (?, 0);", [(word,) for word, _ in refs])
+        vocabulary = max(cur.rowcount, 0)
+        cur.executemany("UPDATE main.ModelVocabulary SET refs = refs + ? WHERE word = ?;", [(delta, word) for word, delta in refs])
+        cur.executemany("DELETE FROM main.ModelVocabulary WHERE word = ? AND refs <= 0;", [(word,) for word, delta in refs if delta < 0])
+        vocabulary -= max(cur.rowcount, 0)
+        changes = [(table, self.rows.get(table, 0), self.totals.get(table, 0)) for table in self.rows.keys() | self.totals.keys()]
+        if vocabulary:
+            changes.append((self.VOCABULARY, vocabulary, 0))
+        cur.executemany("""
+            INSERT INTO main.ModelStats (name, rows, total) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET rows = rows + excluded.rows, total = total + excluded.total;""", changes)
+        self.rows.clear()
+        self.totals.clear()
+        self.refs.clear()
+        self._scale = None
+
+if __name__ == "__main__":
+    # Show the statistics of the model of a channel, optionally recomputing them first.
+    # Usage: python ModelStats.py <channel> [--rebuild]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    from Database import Database
+    db = Database(sys.argv[1])
+    conn = sqlite3.connect(db.db_name, isolation_level=None)
+    if db.archive_name:
+        conn.execute("ATTACH DATABASE ? AS archive;", (db.archive_name,))
+    if "--rebuild" in sys.argv:
+        ModelStats.rebuild(conn)
+    stats = ModelStats.read(conn)
+    scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+    for name, (rows, total) in sorted(stats.items()):
+        print(f"{name:<24} {rows:>12} {total / scale:>16.1f}")
+    print(ModelStats.summary(stats, scale))
@@ -0,0 +1,341 @@
+import gzip, json, logging, os, sqlite3, struct, sys, time
+from typing import BinaryIO, Dict, Iterator, List, Tuple
+
+from Admin import Admin, LiveWriterError
+from Database import Database
+from Migrations import suffix
+from ModelStats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+# Exports the learned model of a channel to a compact file, and merges such files into a database.
+#
+# An export is a gzipped stream of length-prefixed blocks, so a model of any size is moved with constant memory:
+# > Header: b"MKVX", format version (1 byte), length of the metadata (varint), metadata as JSON
+# > Block:  kind (b"S" for starts, b"G" for 3-grams), number of rows (varint), length of the rows (varint), rows
+# > End:    b"E"
+#
+# Rows are written sorted, and delta-encoded against the previous row of their block:
+# > flags (1 byte): the number of leading words equal to the previous row, plus 4 if the count is a float
+# > every other word: its length in bytes (varint), followed by its UTF-8 bytes
+# > count: a varint, or a little-endian double with flag 4
+#
+# Counts are exported as effective counts, i.e. divided by the decay scale of the source database,
+# and multiplied by the scale of the target database on import.
+
+MAGIC = b"MKVX"
+FORMAT = 1
+# Approximate number of bytes of rows per block
+BLOCK_SIZE = 2 ** 16
+
+def _varint(value: int, out: bytearray) -> None:
+    """Append `value` to `out` as a varint, 7 bits per byte."""
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+def _read_varint(buffer: bytes, i: int) -> Tuple[int, int]:
+    """Read a varint from `buffer` at index `i`, and return its value and the index after it."""
+    value = shift = 0
+    while True:
+        byte = buffer[i]
+        i += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, i
+        shift += 7
+
+def _read_stream_varint(f: BinaryIO) -> int:
+    """Read a varint from the file `f`."""
+    value = shift = 0
+    while True:
+        byte = f.read(1)[0]
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+
+def _write_block(f: BinaryIO, kind: bytes, rows: int, payload: bytearray) -> None:
+    """Write a block of `rows` encoded rows of `kind` to `f`."""
+    header = bytearray(kind)
+    _varint(rows, header)
+    _varint(len(payload), header)
+    f.write(header)
+    f.write(payload)
+
+def _encode_rows(f: BinaryIO, kind: bytes, rows: Iterator[Tuple], width: int, scale: float) -> int:
+    """Write `rows` of `width` words and a count as blocks of `kind` to `f`, and return the number of rows written."""
+    payload = bytearray()
+    append = payload.append
+    previous = None
+    in_block = written = 0
+    for row in rows:
+        shared = 0
+        if previous is not None:
+            # At least the last word of a row always differs from the previous row
+            while shared < width - 1 and row[shared] == previous[shared]:
+                shared += 1
+        count = row[width] / scale
+        integral = count >= 0 and count.is_integer()
+        append(shared if integral else shared | 4)
+        for word in row[shared:width]:
+            encoded = word.encode("utf-8")
+            # Nearly all words are shorter than 128 bytes, i.e. a single byte varint
+            if len(encoded) < 0x80:
+                append(len(encoded))
+            else:
+                _varint(len(encoded), payload)
+            payload += encoded
+        if integral:
+            count = int(count)
+            if count < 0x80:
+                append(count)
+            else:
+                _varint(count, payload)
+        else:
+            payload += struct.pack("<d", count)
+        previous = row
+        in_block += 1
+        if len(payload) >= BLOCK_SIZE:
+            _write_block(f, kind, in_block, payload)
+            written += in_block
+            payload.clear()
+            previous = None
+            in_block = 0
+    if in_block:
+        _write_block(f, kind, in_block, payload)
+        written += in_block
+    return written
+
+def _decode_rows(payload: bytes, rows: int, width: int) -> List[Tuple]:
+    """Decode a block of `rows` rows of `width` words and a count."""
+    decoded = []
+    append = decoded.append
+    previous = ()
+    i = 0
+    for _ in range(rows):
+        flags = payload[i]
+        i += 1
+        words = previous[:flags & 3]
+        for _ in range(width - (flags & 3)):
+            length = payload[i]
+            if length < 0x80:
+                i += 1
+            else:
+                length, i = _read_varint(payload, i)
+            words += (payload[i:i + length].decode("utf-8"),)
+            i += length
+        if flags & 4:
+            count = struct.unpack_from("<d", payload, i)[0]
+            i += 8
+        else:
+            count = payload[i]
+            if count < 0x80:
+                i += 1
+            else:
+                count, i = _read_varint(payload, i)
+        previous = words
+        append(words + (count,))
+    return decoded
+
+def read_blocks(path: str) -> Tuple[Dict, Iterator[Tuple[bytes, List[Tuple]]]]:
+    """Open the export at `path`.
+
+    Args:
+        path (str): The path of the export.
+
+    Raises:
+        ValueError: If `path` is not an export, or was written by a newer version.
+
+    Returns:
+        Tuple[Dict, Iterator[Tuple[bytes, List[Tuple]]]]: The metadata, and an iterator over the
+            kind and the decoded rows of every block, with effective counts.
+    """
+    f = gzip.open(path, "rb")
+    if f.read(len(MAGIC)) != MAGIC:
+        f.close()
+        raise ValueError(f"{path} is not an exported model.")
+    version = f.read(1)[0]
+    if version > FORMAT:
+        f.close()
+        raise ValueError(f"{path} was exported with format {version}, but only format {FORMAT} is supported.")
+    metadata = json.loads(f.read(_read_stream_varint(f)))
+
+    def blocks() -> Iterator[Tuple[bytes, List[Tuple]]]:
+        with f:
+            while True:
+                kind = f.read(1)
+                if kind in (b"E", b""):
+                    return
+                rows = _read_stream_varint(f)
+                payload = f.read(_read_stream_varint(f))
+                yield kind, _decode_rows(payload, rows, 3 if kind == b"G" else 2)
+    return metadata, blocks()
+
+def export_model(channel: str, path: str) -> Dict[str, float]:
+    """Export the starts and 3-grams of `channel`, including its archive, to `path`.
+
+    This can be done while the bot is running. With the "WAL" setting, the export is a consistent
+    snapshot, and does not block learning at all. Otherwise, every table is read in its own transaction.
+    The trie of a `KeyLength` other than 2 is not exported.
+
+    Args:
+        channel (str): The channel name, e.g. "cubiedev".
+        path (str): The path of the export, e.g. "cubiedev.mkvx".
+
+    Returns:
+        Dict[str, float]: The number of rows and bytes written, and the number of seconds taken.
+    """
+    db_name = f"/app/db/MarkovChain_{channel.replace('#', '').lower()}.db"
+    if not os.path.isfile(db_name):
+        raise FileNotFoundError(f"There is no database for {channel} at {db_name}.")
+    start = time.perf_counter()
+    conn = sqlite3.connect(db_name, isolation_level=None)
+    try:
+        if os.path.isfile(db_name[:-3] + "_archive.db"):
+            conn.execute("ATTACH DATABASE ? AS archive;", (db_name[:-3] + "_archive.db",))
+        wal = conn.execute("PRAGMA journal_mode;").fetchone()[0].lower() == "wal"
+        if wal:
+            # One read transaction, so the export is consistent while the bot keeps learning
+            conn.execute("BEGIN;")
+        scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+        tables = [("main", name) for name, in conn.execute("""
+            SELECT name FROM sqlite_master
+            WHERE type = 'table' AND (name LIKE 'MarkovStart_' OR name LIKE 'MarkovGrammar__')
+            ORDER BY name;""")]
+        if os.path.isfile(db_name[:-3] + "_archive.db"):
+            tables.append(("archive", "MarkovGrammar"))
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'TrieNode';").fetchone():
+            logger.warning(f"The trie of {channel} is not exported. Only the 3-grams learned with a KeyLength of 2 are.")
+
+        metadata = {"channel": channel, "exported": time.time(), "key_length": 2}
+        encoded = json.dumps(metadata).encode("utf-8")
+        rows = 0
+        reported = time.perf_counter()
+        with gzip.open(path + ".tmp", "wb", compresslevel=6) as f:
+            header = bytearray(MAGIC)
+            header.append(FORMAT)
+            _varint(len(encoded), header)
+            f.write(header + encoded)
+            for schema, table in tables:
+                kind, width = (b"S", 2) if table.startswith("MarkovStart") else (b"G", 3)
+                columns = ", ".join(f"word{i + 1}" for i in range(width))
+                # Sorted by the primary key, so the rows are read in index order and share their first words
+                order = ", ".join(f"{column} COLLATE BINARY" for column in columns.split(", "))
+                rows += _encode_rows(f, kind, conn.execute(f"SELECT {columns}, count FROM {schema}.{table} ORDER BY {order};"), width, scale)
+                if time.perf_counter() - reported > 10:
+                    reported = time.perf_counter()
+                    logger.info(f"Exported {rows} rows ({rows / (reported - start):.0f} rows/s)...")
+            f.write(b"E")
+        if wal:
+            conn.execute("COMMIT;")
+    finally:
+        conn.close()
+    os.replace(path + ".tmp", path)
+
+    stats = {"rows": rows, "bytes": os.path.getsize(path), "seconds": time.perf_counter() - start}
+    logger.info(f"Exported {rows} rows of {channel} to {path} ({stats['bytes'] / 2 ** 20:.1f}MB) in {stats['seconds']:.2f} seconds "
+                f"({rows / max(stats['seconds'], 1e-9):.0f} rows/s).")
+    return stats
+
+def import_model(channel: str, path: str) -> Dict[str, float]:
+    """Merge the export at `path` into the database of `channel`, adding its counts to the existing ones.
+
+    The database is created if it does not exist yet. Only allowed while the bot is not running,
+    as the "memory" Engine and the compiled model would not see the imported rows. The writer lock
+    is held like Admin does, so a bot that starts in the meantime waits for the import.
+
+    Everything is imported in a single transaction, so an interrupted import changes nothing,
+    and can simply be run again.
+
+    Args:
+        channel (str): The channel name, e.g. "cubiedev".
+        path (str): The path of the export, e.g. "cubiedev.mkvx".
+
+    Raises:
+        LiveWriterError: If a running bot writes to the database of `channel`.
+
+    Returns:
+        Dict[str, float]: The number of rows imported, and the number of seconds taken.
+    """
+    start = time.perf_counter()
+    admin = Admin(channel)
+    admin.lock()
+    if admin.live_writer is not None:
+        raise LiveWriterError(f"A running bot (process {admin.live_writer.get('pid')}) writes to {admin.db_name}. Stop it before importing.")
+    try:
+        metadata, blocks = read_blocks(path)
+        logger.info(f"Importing the model of {metadata.get('channel')} into {channel}...")
+        # Creates or migrates the database if needed
+        db = Database(channel)
+        conn = sqlite3.connect(db.db_name, isolation_level=None)
+        try:
+            if db.archive_name:
+                conn.execute("ATTACH DATABASE ? AS archive;", (db.archive_name,))
+            cur = conn.cursor()
+            scale = conn.execute("SELECT scale FROM Decay;").fetchone()[0]
+            # Target table by the first character of the first word, and of the second word for 3-grams
+            tables: Dict[Tuple[str, ...], str] = {}
+            rows = 0
+            reported = time.perf_counter()
+            cur.execute("BEGIN IMMEDIATE;")
+            try:
+                for kind, block in blocks:
+                    by_table: Dict[str, List[Tuple]] = {}
+                    for row in block:
+                        characters = (row[0][0], row[1][0]) if kind == b"G" else (row[0][0],)
+                        table = tables.get(characters)
+                        if table is None:
+                            table = tables[characters] = ("MarkovGrammar" if kind == b"G" else "MarkovStart") + "".join(map(suffix, characters))
+                        if db.archive_name and kind == b"G":
+                            # Moved back from the archive first, so the imported counts are added to the archived ones
+                            db._learned_keys.add((table, row[0], row[1]))
+                        by_table.setdefault(table, []).append(row if scale == 1 else (*row[:-1], row[-1] * scale))
+
+                    stats = ModelStats()
+                    if db._learned_keys:
+                        db._unarchive_learned_keys(cur, stats)
+                    for table, values in by_table.items():
+                        for row in values:
+                            stats.learn(cur, table, row[:-1], row[-1] / scale)
+                    for table, values in by_table.items():
+                        if kind == b"G":
+                            cur.executemany(f"""
+                                INSERT INTO {table} (word1, word2, word3, count) VALUES (?, ?, ?, ?)
+                                ON CONFLICT (word1, word2, word3) DO UPDATE SET count = count + excluded.count;""", values)
+                        else:
+                            cur.executemany(f"""
+                                INSERT INTO {table} (word1, word2, count) VALUES (?, ?, ?)
+                                ON CONFLICT (word1, word2) DO UPDATE SET count = count + excluded.count;""", values)
+                    stats.write(cur)
+
+                    rows += len(block)
+                    if time.perf_counter() - reported > 10:
+                        reported = time.perf_counter()
+                        logger.info(f"Imported {rows} rows ({rows / (reported - start):.0f} rows/s)...")
+            except BaseException:
+                cur.execute("ROLLBACK;")
+                raise
+            cur.execute("COMMIT;")
+        finally:
+            conn.close()
+    finally:
+        admin.close()
+
+    stats = {"rows": rows, "seconds": time.perf_counter() - start}
+    logger.info(f"Imported {rows} rows into {channel} in {stats['seconds']:.2f} seconds ({rows / max(stats['seconds'], 1e-9):.0f} rows/s).")
+    return stats
+
+if __name__ == "__main__":
+    # Move a model between hosts, or merge the model of one channel into another.
+    # Usage: python Portable.py export <channel> <file>
+    #        python Portable.py import <channel> <file>
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    if len(sys.argv) != 4 or sys.argv[1] not in ("export", "import"):
+        print("Usage: python Portable.py export|import <channel> <file>")
+        sys.exit(1)
+    if sys.argv[1] == "export":
+        export_model(sys.argv[2], sys.argv[3])
+    else:
+        import_model(sys.argv[2], sys.argv[3])
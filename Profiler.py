@@ -0,0 +1,181 @@
+import cProfile, functools, logging, os, pstats, threading
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class Profiler:
+    """
+    Profiles the functions decorated with `profiled` with cProfile, for a limited number of seconds.
+
+    Either every call is profiled, or only one in `every` calls per function, which keeps the
+    overhead low enough to profile a busy production bot for a longer time. Calls made while
+    another call is being profiled, e.g. Database calls from `message_handler`, are part of the
+    profile of the outer call. Calls in other threads during that time are not profiled.
+
+    When the time is up, a profile per channel is written to `directory` as
+    `{channel}_{start time}.pstats`, which can be read with `python -m pstats`, and as
+    `{channel}_{start time}.collapsed`, with one line per call stack, for flame graph tools.
+    """
+    def __init__(self, directory: str = "/app/db/profiles") -> None:
+        self.directory = directory
+        # Checked by every decorated call, so disabled profiling costs a single attribute lookup
+        self.active = False
+        self.every = 1
+        self._calls: Dict[str, int] = {}
+        self._profiles: Dict[str, cProfile.Profile] = {}
+        self._started = ""
+        self._timer: Optional[threading.Timer] = None
+        # Held while a call is profiled, as only one profile can be enabled at a time
+        self._busy = threading.Lock()
+        self._lock = threading.Lock()
+
+    def start(self, seconds: float = 60, every: int = 1) -> bool:
+        """Start profiling for `seconds`, after which the profiles are written.
+
+        Args:
+            seconds (float, optional): The number of seconds to profile for. Defaults to 60.
+            every (int, optional): Profile one in `every` calls of each function. Defaults to 1, i.e. all calls.
+
+        Returns:
+            bool: Whether profiling started, i.e. was not running already.
+        """
+        with self._lock:
+            if self.active:
+                return False
+            self.every = max(int(every), 1)
+            self._calls.clear()
+            self._profiles.clear()
+            self._started = datetime.now().strftime("%Y%m%d-%H%M%S")
+            self._timer = threading.Timer(seconds, self.stop)
+            self._timer.daemon = True
+            self._timer.start()
+            self.active = True
+        logger.info(f"Profiling {'every call' if self.every == 1 else f'one in {self.every} calls'} for {seconds:g} seconds.")
+        return True
+
+    def start_from_spec(self, spec: str) -> bool:
+        """Start profiling as described by `spec`, e.g. "60" for every call for 60 seconds, or "600:100" for one in 100 calls for 600 seconds."""
+        try:
+            seconds, _, every = spec.partition(":")
+            return self.start(float(seconds or 60), int(every or 1))
+        except ValueError:
+            logger.warning(f"Invalid profiling specification \"{spec}\". Expected \"<seconds>\" or \"<seconds>:<every>\".")
+            return False
+
+    def stop(self) -> List[str]:
+        """Stop profiling, and write the profiles.
+
+        Returns:
+            List[str]: The paths of the written files.
+        """
+        with self._lock:
+            if not self.active:
+                return []
+            self.active = False
+            if self._timer is not None:
+                self._timer.cancel()
+        # Wait for a call that is being profiled right now
+        with self._busy:
+            profiles, self._profiles = self._profiles, {}
+        paths = []
+        os.makedirs(self.directory, exist_ok=True)
+        for channel, profile in profiles.items():
+            path = os.path.join(self.directory, f"{channel}_{self._started}")
+            stats = pstats.Stats(profile)
+            stats.dump_stats(path + ".pstats")
+            with open(path + ".collapsed", "w", encoding="utf-8") as f:
+                for stack, microseconds in sorted(collapse(stats).items()):
+                    f.write(f"{stack} {microseconds}\n")
+            paths += [path + ".pstats", path + ".collapsed"]
+        logger.info(f"Stopped profiling. Wrote {len(paths)} files to {self.directory}.")
+        return paths
+
+    def toggle(self) -> None:
+        """Stop profiling if it is running, and profile every call for 60 seconds otherwise. Used for SIGUSR1."""
+        if self.active:
+            # Writing the files from the signal handler could block the main thread
+            threading.Thread(target=self.stop, daemon=True).start()
+        else:
+            self.start()
+
+    def call(self, name: str, channel: str, function: Callable, args: tuple, kwargs: dict):
+        """Call `function`, profiling it into the profile of `channel` if it is sampled."""
+        calls = self._calls.get(name, 0) + 1
+        self._calls[name] = calls
+        if calls % self.every or not self._busy.acquire(blocking=False):
+            return function(*args, **kwargs)
+        try:
+            if not self.active:
+                return function(*args, **kwargs)
+            profile = self._profiles.get(channel)
+            if profile is None:
+                profile = self._profiles[channel] = cProfile.Profile()
+            profile.enable()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                profile.disable()
+        finally:
+            self._busy.release()
+
+PROFILER = Profiler()
+
+def profiled(name: str, channel: Callable[..., Optional[str]]) -> Callable[[Callable], Callable]:
+    """Decorate a function to be profiled by PROFILER while it is active.
+
+    Args:
+        name (str): The name of the function, used for sampling one in `every` calls per function.
+        channel (Callable[..., Optional[str]]): Gets the channel of a call from the arguments of the function.
+    """
+    def decorator(function: Callable) -> Callable:
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not PROFILER.active:
+                return function(*args, **kwargs)
+            return PROFILER.call(name, channel(*args, **kwargs) or "unknown", function, args, kwargs)
+        return wrapper
+    return decorator
+
+def _label(function: Tuple[str, int, str]) -> str:
+    """Format a function of pstats, e.g. ("Database.py", 12, "execute") as "execute (Database.py:12)"."""
+    filename, line, name = function
+    if filename == "~":
+        return name
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+def collapse(stats: pstats.Stats, max_depth: int = 64) -> Dict[str, int]:
+    """Approximate the call stacks of a profile, as "outer;inner;innermost" mapped to microseconds spent in the innermost function.
+
+    cProfile only records the callers of every function, so the time of a function called from
+    several places is split over its callers in proportion to the time spent in it from each caller.
+    """
+    callees: Dict[tuple, List[tuple]] = {}
+    for function, (_, _, _, _, callers) in stats.stats.items():
+        for caller in callers:
+            callees.setdefault(caller, []).append(function)
+    roots = [function for function, (_, _, _, _, callers) in stats.stats.items() if not callers]
+    stacks: Dict[str, int] = {}
+
+    def visit(function: tuple, stack: List[str], path: set, fraction: float) -> None:
+        _, _, own, cumulative, _ = stats.stats[function]
+        if cumulative * fraction < 1e-6:
+            return
+        stack = stack + [_label(function)]
+        microseconds = round(own * fraction * 1e6)
+        if microseconds:
+            key = ";".join(stack)
+            stacks[key] = stacks.get(key, 0) + microseconds
+        if len(stack) >= max_depth:
+            return
+        for callee in callees.get(function, []):
+            if callee in path:
+                continue
+            callee_cumulative = stats.stats[callee][3]
+            edge_cumulative = stats.stats[callee][4][function][3]
+            if callee_cumulative > 0 and edge_cumulative > 0:
+                visit(callee, stack, path | {callee}, fraction * edge_cumulative / callee_cumulative)
+
+    for root in roots:
+        visit(root, [], {root}, 1.0)
+    return stacks
@@ -1,5 +1,5 @@
 import json, os, logging
-from typing import List
+from typing import Dict, List, Union
 try:
     from typing import TypedDict
 except ImportError:
@@ -10,18 +10,45 @@ logger = logging.getLogger(__name__)
 class SettingsData(TypedDict):
     Host: str
     Port: int
-    Channel: str
+    Channel: Union[str, List[str]]
     Nickname: str
     Authentication: str
     DeniedUsers: List[str]
     AllowedUsers: List[str]
-    KeyLength: int
+    KeyLength: Union[int, Dict[str, int]]
     MaxSentenceWordAmount: int
     MinSentenceWordAmount: int
     SentenceSeparator: str
     EmotePrefix : str
     AutomaticGenerationMessageCount : int
     AutoWake : bool
+    LearningWorker : bool
+    DuplicateThreshold : int
+    DuplicateWindow : int
+    DuplicateMode : str
+    AdaptiveSampling : bool
+    LearningRateLimit : float
+    Engine : str
+    SnapshotInterval : int
+    CompiledModel : bool
+    CompileInterval : float
+    DecayHalfLife : float
+    PruneThreshold : float
+    CompactionTimeBudget : float
+    MaxDatabaseSize : float
+    Archive : bool
+    ArchiveThreshold : float
+    WAL : bool
+    BackupInterval : float
+    BackupKeep : int
+    BackupCompress : bool
+    MetricsPort : int
+    MetricsHost : str
+    QueryTracing : bool
+    SlowQueryThreshold : float
+    MemoryReportInterval : float
+    MemoryTracing : bool
+    WarmCacheSize : float
 
 class Settings:
     """ Loads data from settings.json into the bot """
@@ -42,7 +69,34 @@ class Settings:
         "SentenceSeparator": ". ",
         "EmotePrefix": "NA",
         "AutomaticGenerationMessageCount": 150,
-        "AutoWake": False
+        "AutoWake": False,
+        "LearningWorker": False,
+        "DuplicateThreshold": 0,
+        "DuplicateWindow": 60,
+        "DuplicateMode": "drop",
+        "AdaptiveSampling": False,
+        "LearningRateLimit": 0,
+        "Engine": "sqlite",
+        "SnapshotInterval": 300,
+        "CompiledModel": False,
+        "CompileInterval": 10,
+        "DecayHalfLife": 0,
+        "PruneThreshold": 1,
+        "CompactionTimeBudget": 5,
+        "MaxDatabaseSize": 0,
+        "Archive": False,
+        "ArchiveThreshold": 2,
+        "WAL": False,
+        "BackupInterval": 0,
+        "BackupKeep": 7,
+        "BackupCompress": True,
+        "MetricsPort": 0,
+        "MetricsHost": "127.0.0.1",
+        "QueryTracing": False,
+        "SlowQueryThreshold": 100,
+        "MemoryReportInterval": 0,
+        "MemoryTracing": False,
+        "WarmCacheSize": 0
     }
 
     def __init__(self, bot) -> None:
@@ -195,9 +249,14 @@ class Settings:
     def get_channel() -> str:
         """Get the "Channel" value from the settings file.
 
+        If multiple channels are configured, the first one is returned.
+
         Returns:
             str: The name of the Channel described in the settings file. 
                 Stripped of "#" and converted to lowercase.
         """
         settings = Settings.read_settings()
-        return settings["Channel"].replace("#", "").lower()
+        channels = settings["Channel"]
+        if isinstance(channels, str):
+            channels = channels.split(",")
+        return channels[0].strip().replace("#", "").lower()
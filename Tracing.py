@@ -0,0 +1,207 @@
+import logging, re, sqlite3, threading, time
+from collections import deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+class StatementStats:
+    """The number of executions and the durations of one statement shape."""
+    # Number of recent durations kept for the percentiles
+    SAMPLES = 1000
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.recent: Deque[float] = deque(maxlen=self.SAMPLES)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        self.recent.append(seconds)
+
+    def percentile(self, fraction: float) -> float:
+        """Get the duration below which `fraction` of the recent executions finished."""
+        recent = sorted(self.recent)
+        return recent[min(int(fraction * len(recent)), len(recent) - 1)] if recent else 0.0
+
+class QueryTracer:
+    """
+    Times every statement and transaction executed on the connections of a Database, while `enabled`.
+
+    Statements are aggregated per shape: whitespace is collapsed, literals are replaced by "?",
+    and the 756 n-gram tables are folded into their families "MarkovStart*" and "MarkovGrammar**".
+    Transactions are aggregated as "TRANSACTION" followed by the shape of their first statement.
+
+    Statements that take longer than `threshold` seconds are appended to the slow log, with their
+    values and their `EXPLAIN QUERY PLAN`.
+
+    Statements are timed until their first row is available, which includes all the work of
+    writes and aggregates, but not fetching the remaining rows of a SELECT.
+    """
+    TABLE_REGEXES = [(re.compile(r"\bMarkovGrammar[A-Z_]{2}\b"), "MarkovGrammar**"),
+                     (re.compile(r"\bMarkovStart[A-Z_]\b"), "MarkovStart*")]
+    LITERAL_REGEX = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+    # Statements whose query plan is logged, as opposed to e.g. BEGIN or ATTACH
+    EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "WITH")
+    # Maximum number of SQL strings whose shape is cached
+    MAX_CACHED_SHAPES = 10_000
+
+    def __init__(self, slow_log: str, threshold: float = 0.1, enabled: bool = False) -> None:
+        """Create a QueryTracer.
+
+        Args:
+            slow_log (str): The path of the file to append slow statements to.
+            threshold (float, optional): The number of seconds above which a statement is slow. Defaults to 0.1.
+            enabled (bool, optional): Whether to start tracing right away. Defaults to False.
+        """
+        self.slow_log = slow_log
+        self.threshold = threshold
+        self.enabled = enabled
+        self.stats: Dict[str, StatementStats] = {}
+        self.slow = 0
+        self._shapes: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def shape(self, sql: str) -> str:
+        """Get the normalized shape of `sql`, e.g. "SELECT word3, count FROM MarkovGrammar** WHERE word1 = ? AND word2 = ?;"."""
+        shape = self._shapes.get(sql)
+        if shape is None:
+            shape = " ".join(sql.split())
+            for regex, family in self.TABLE_REGEXES:
+                shape = regex.sub(family, shape)
+            shape = self.LITERAL_REGEX.sub("?", shape)
+            if len(self._shapes) >= self.MAX_CACHED_SHAPES:
+                self._shapes.clear()
+            self._shapes[sql] = shape
+        return shape
+
+    def record(self, conn: "TracedConnection", sql: str, values: Any, seconds: float) -> None:
+        """Add an execution of `sql` on `conn` that took `seconds`, and log it if it was slow.
+
+        Args:
+            conn (TracedConnection): The connection `sql` was executed on.
+            sql (str): The executed statement.
+            values (Any): The values of the statement, or None if they are unknown, as for `executemany`.
+            seconds (float): The duration of the statement.
+        """
+        shape = self.shape(sql)
+        with self._lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = StatementStats()
+            stats.add(seconds)
+        if seconds >= self.threshold:
+            self.log_slow(conn, sql, values, seconds)
+
+    def record_transaction(self, first_shape: str, seconds: float) -> None:
+        """Add a transaction that started with a statement of `first_shape` and took `seconds`."""
+        shape = f"TRANSACTION {first_shape}"
+        with self._lock:
+            stats = self.stats.get(shape)
+            if stats is None:
+                stats = self.stats[shape] = StatementStats()
+            stats.add(seconds)
+
+    def log_slow(self, conn: sqlite3.Connection, sql: str, values: Any, seconds: float) -> None:
+        """Append `sql` with its values and query plan to the slow log."""
+        self.slow += 1
+        sql = " ".join(sql.split())
+        plan = []
+        if values is not None and sql.upper().startswith(self.EXPLAINABLE):
+            try:
+                plan = [row[-1] for row in conn.cursor(sqlite3.Cursor).execute("EXPLAIN QUERY PLAN " + sql, values)]
+            except sqlite3.Error as error:
+                plan = [f"(no query plan: {error})"]
+        try:
+            with open(self.slow_log, "a", encoding="utf-8") as f:
+                f.write(f"[{datetime.now().isoformat(sep=' ', timespec='seconds')}] {seconds * 1000:.1f}ms: {sql}\n")
+                if values:
+                    f.write(f"    values: {repr(tuple(values))[:500]}\n")
+                for step in plan:
+                    f.write(f"    plan: {step}\n")
+        except OSError:
+            logger.exception(f"Failed to write to the slow query log {self.slow_log}.")
+
+    def report(self, top: int = 10) -> List[str]:
+        """Get a line per statement shape with its count, total and percentile durations, for the `top` shapes by total time."""
+        with self._lock:
+            stats = sorted(self.stats.items(), key=lambda item: item[1].total, reverse=True)[:top]
+            return [f"{item.count:>8}x {item.total:>8.2f}s total, p50 {item.percentile(0.5) * 1000:.2f}ms, "
+                    f"p99 {item.percentile(0.99) * 1000:.2f}ms, max {item.max * 1000:.2f}ms: {shape[:200]}"
+                    for shape, item in stats]
+
+    def reset(self) -> None:
+        """Forget all recorded statements."""
+        with self._lock:
+            self.stats.clear()
+            self.slow = 0
+
+class TracedCursor(sqlite3.Cursor):
+    """A cursor that reports the duration of every statement to the QueryTracer of its connection."""
+    def execute(self, sql: str, parameters: Any = ()) -> "TracedCursor":
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.traced(sql, parameters, start)
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> "TracedCursor":
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            # The parameters may be an iterator that was consumed, so no query plan is logged
+            self.connection.traced(sql, None, start)
+
+class TracedConnection(sqlite3.Connection):
+    """A connection whose cursors are TracedCursors, used by `Database.connect` while tracing is enabled."""
+    tracer: QueryTracer = None
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        # Start of the current transaction, and the shape of its first statement
+        self._transaction_start: Optional[float] = None
+        self._transaction_shape = ""
+
+    def cursor(self, factory: type = TracedCursor) -> sqlite3.Cursor:
+        return super().cursor(factory)
+
+    def execute(self, sql: str, parameters: Any = ()) -> sqlite3.Cursor:
+        # The shortcuts of sqlite3.Connection do not use `cursor`
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql: str, seq_of_parameters: Any) -> sqlite3.Cursor:
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def traced(self, sql: str, values: Any, start: float) -> None:
+        """Record a statement that started at `start`, and the transaction it started or ended, if any."""
+        end = time.perf_counter()
+        self.tracer.record(self, sql, values, end - start)
+        if self.in_transaction:
+            if self._transaction_start is None and not sql.lstrip().upper().startswith("BEGIN"):
+                self._transaction_start = start
+                self._transaction_shape = self.tracer.shape(sql)
+        else:
+            self._end_transaction(end)
+
+    def _end_transaction(self, end: float) -> None:
+        if self._transaction_start is not None:
+            self.tracer.record_transaction(self._transaction_shape[:120], end - self._transaction_start)
+            self._transaction_start = None
+
+    def commit(self) -> None:
+        super().commit()
+        self._end_transaction(time.perf_counter())
+
+    def rollback(self) -> None:
+        super().rollback()
+        self._end_transaction(time.perf_counter())
+
+    def __exit__(self, *exc_info) -> bool:
+        # Commits or rolls back without calling `commit` or `rollback`
+        result = super().__exit__(*exc_info)
+        self._end_transaction(time.perf_counter())
+        return result
@@ -0,0 +1,352 @@
+import logging, sqlite3
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from Database import Database
+from Metrics import CACHE_REQUESTS
+from ModelStats import ModelStats
+
+logger = logging.getLogger(__name__)
+
+class TrieDatabase(Database):
+    """
+    Database for key lengths other than 2, storing n-grams of any order in a prefix trie.
+
+    Alongside the regular tables, two tables are added to `MarkovChain_{channel}.db`:
+    > Vocabulary (id, word)
+    > TrieNode (id, parent, word, count)
+
+    Every learned sentence is surrounded by "<START>" and "<END>", and every window of
+    `key_length + 1` words is inserted as a path from the root (parent 0), incrementing the count
+    of every node along the path. Windows at the end of a sentence that are shorter than
+    `key_length + 1` words are inserted as well. The count of a node is therefore the number of
+    times its prefix was learned, and the children of the node at the end of a key of any length
+    up to `key_length` are the words that followed it, weighted by their count.
+
+    The number of nodes and the total of their counts are kept in the "TrieNode" row of ModelStats.
+
+    N-grams sharing a prefix share nodes, so a higher order only adds nodes for the words at the
+    end of a window that differ, rather than a full row per n-gram.
+
+    When generating, the longest key with successors is used, backing off to shorter keys down to
+    a single word. If the trie has nothing at all, e.g. for data learned before the key length was
+    changed, the 3-gram tables of `Database` are used instead.
+
+    Like the COLLATE NOCASE columns of `Database`, words in keys are matched case insensitively,
+    while the generated words keep their original case.
+    """
+    START = "<START>"
+    END = "<END>"
+
+    # Maximum number of cached (parent, word) -> node id entries
+    MAX_CACHED_NODES = 100_000
+
+    def __init__(self, channel: str, key_length: int):
+        """Open or create the database of `channel`, whose trie tables are created by `Database.create_tables`.
+
+        Args:
+            channel (str): The channel name, e.g. "cubiedev".
+            key_length (int): The number of words used as a key when learning and generating.
+        """
+        self.key_length = key_length
+        # Windows waiting to be inserted, with the sum of their weights
+        self._pending_windows: Dict[Tuple[str, ...], int] = {}
+        self._word_ids: Dict[str, int] = {}
+        self._node_ids: Dict[Tuple[int, int], int] = {}
+        super().__init__(channel)
+
+    def add_start_queue(self, item: List[str], weight: int = 1) -> None:
+        """Queue the start of a sentence, as a window starting with "<START>".
+
+        Args:
+            item (List[str]): The first `key_length` words of a sentence.
+            weight (int, optional): The amount to increment the frequencies by. Defaults to 1.
+        """
+        self._queue_window((self.START, *item), weight)
+
+    def add_rule_queue(self, item: List[str], weight: int = 1) -> None:
+        """Queue a window of `key_length + 1` words.
+
+        If the window ends with "<END>", the shorter windows at the end of the sentence are queued as well,
+        so that shorter keys near the end of a sentence also have successors.
+
+        Args:
+            item (List[str]): A window of `key_length + 1` words.
+            weight (int, optional): The amount to increment the frequencies by. Defaults to 1.
+        """
+        # Filter out recursive case.
+        if self.check_equal(item):
+            return
+        if "" in item:
+            logger.warning(f"Failed to add item to rules. Item contains empty string: {item!r}")
+            return
+        self._queue_window(tuple(item), weight)
+        if item[-1] == self.END:
+            for i in range(1, len(item) - 1):
+                self._queue_window(tuple(item[i:]), weight)
+
+    def _queue_window(self, window: Tuple[str, ...], weight: int) -> None:
+        """Queue `window` to be inserted, and insert all queued windows if there are more than 25."""
+        self._pending_windows[window] = self._pending_windows.get(window, 0) + weight
+        if len(self._pending_windows) > 25:
+            self.execute_commit()
+
+    @property
+    def queue_depth(self) -> int:
+        """The number of windows waiting to be inserted, and queries waiting in the execute queue."""
+        return len(self._pending_windows) + super().queue_depth
+
+    def memory_components(self) -> Dict[str, Any]:
+        """Get the queued windows and the id caches, along with the structures of `Database`."""
+        return {**super().memory_components(),
+                "pending_windows": self._pending_windows,
+                "word_ids": self._word_ids,
+                "node_ids": self._node_ids}
+
+    def execute_commit(self, fetch: bool = False):
+        """Insert the queued windows, and execute the queued SQL queries of `Database`."""
+        if self._pending_windows:
+            windows, self._pending_windows = self._pending_windows, {}
+            with self.connect() as conn:
+                cur = conn.cursor()
+                cur.execute("begin")
+                stats = ModelStats()
+                for window, weight in windows.items():
+                    self._insert_window(cur, stats, window, weight)
+                stats.write(cur)
+                cur.execute("commit")
+        return super().execute_commit(fetch)
+
+    def _word_id(self, cur: sqlite3.Cursor, word: str) -> int:
+        """Get the id of `word` in the Vocabulary, adding it if it is new."""
+        word_id = self._word_ids.get(word)
+        CACHE_REQUESTS.inc(labels=("trie_words", "miss" if word_id is None else "hit"))
+        if word_id is None:
+            cur.execute("INSERT OR IGNORE INTO Vocabulary (word) VALUES (?);", (word,))
+            word_id = cur.execute("SELECT id FROM Vocabulary WHERE word = ?;", (word,)).fetchone()[0]
+            self._word_ids[word] = word_id
+        return word_id
+
+    def _insert_window(self, cur: sqlite3.Cursor, stats: ModelStats, window: Sequence[str], weight: int) -> None:
+        """Increment the count of every node along the path of `window` by `weight`, creating nodes as needed, and account for it in `stats`."""
+        if len(self._node_ids) > self.MAX_CACHED_NODES:
+            self._node_ids.clear()
+        delta = weight * stats.scale(cur)
+        parent = 0
+        for word in window:
+            word_id = self._word_id(cur, word)
+            node = self._node_ids.get((parent, word_id))
+            CACHE_REQUESTS.inc(labels=("trie_nodes", "miss" if node is None else "hit"))
+            new = False
+            # A cached node may have been removed since, e.g. by Compactor
+            if node is None or not cur.execute("UPDATE TrieNode SET count = count + ? WHERE id = ?;", (delta, node)).rowcount:
+                row = cur.execute("SELECT id FROM TrieNode WHERE parent = ? AND word = ?;", (parent, word_id)).fetchone()
+                new = row is None
+                if new:
+                    node = cur.execute("INSERT INTO TrieNode (parent, word, count) VALUES (?, ?, ?);", (parent, word_id, delta)).lastrowid
+                else:
+                    node = row[0]
+                    cur.execute("UPDATE TrieNode SET count = count + ? WHERE id = ?;", (delta, node))
+                self._node_ids[(parent, word_id)] = node
+            stats.learned(ModelStats.TRIE, (), delta, new)
+            parent = node
+
+    def _find_nodes(self, conn: sqlite3.Connection, words: Sequence[str]) -> List[int]:
+        """Get the ids of all nodes at the end of the path `words`, matching words case insensitively."""
+        nodes = [0]
+        for word in words:
+            word_ids = [row[0] for row in conn.execute("SELECT id FROM Vocabulary WHERE word = ? COLLATE NOCASE;", (word,))]
+            if not word_ids:
+                return []
+            nodes = [row[0] for row in conn.execute(f"""
+                SELECT id FROM TrieNode
+                WHERE parent IN ({", ".join("?" * len(nodes))}) AND word IN ({", ".join("?" * len(word_ids))});""",
+                                                    (*nodes, *word_ids))]
+            if not nodes:
+                return []
+        return nodes
+
+    def _children(self, conn: sqlite3.Connection, nodes: List[int], allow_end: bool = True) -> List[Tuple[int, str, int]]:
+        """Get the (node id, word, count) of all children of `nodes`."""
+        if not nodes:
+            return []
+        return conn.execute(f"""
+            SELECT n.id, v.word, n.count FROM TrieNode n JOIN Vocabulary v ON v.id = n.word
+            WHERE n.parent IN ({", ".join("?" * len(nodes))}) AND n.count > 0{"" if allow_end else " AND v.word != '<END>'"};""",
+                            nodes).fetchall()
+
+    def _descend(self, conn: sqlite3.Connection, nodes: List[int], depth: int) -> Optional[List[str]]:
+        """Randomly walk `depth` levels down from `nodes`, weighted by count, never picking "<END>"."""
+        words = []
+        for _ in range(depth):
+            children = self._children(conn, nodes, allow_end=False)
+            if not children:
+                return None
+            node, word, _ = self.random.choices(children, weights=[child[-1] for child in children])[0]
+            nodes = [node]
+            words.append(word)
+        return words
+
+    def _next(self, index: int, words: List[str], allow_end: bool) -> Optional[str]:
+        """Pick the next word given the longest suffix of `words` that has successors."""
+        with self.connect() as conn:
+            for length in range(min(len(words), self.key_length), 0, -1):
+                children = self._children(conn, self._find_nodes(conn, words[-length:]), allow_end)
+                if children:
+                    # Merge case variants of the same word from different nodes
+                    counts: Dict[str, int] = {}
+                    for _, word, count in children:
+                        counts[word] = counts.get(word, 0) + count
+                    return self.pick_word(list(counts.items()), index)
+        return None
+
+    def get_next(self, index: int, words: List[str]) -> Optional[str]:
+        """Generate the next word in the sentence using learned data, given the previous words.
+
+        The successors of the last `key_length` words are used first. If there are none, the key backs off
+        to the last `key_length - 1` words, and so on down to the last word. If the trie has no successors
+        for any of these keys, e.g. for data learned with a different key length, `Database.get_next` picks
+        from the 3-gram tables given the last 2 words.
+
+        Args:
+            index (int): The index of this new word in the sentence.
+            words (List[str]): The previous words. Only the last `key_length` are used.
+
+        Returns:
+            Optional[str]: The next word in the sentence, generated given the learned data.
+        """
+        word = self._next(index, words, allow_end=True)
+        if word is None and len(words) >= 2:
+            return super().get_next(index, words[-2:])
+        return word
+
+    def get_next_initial(self, index: int, words) -> Optional[str]:
+        """Generate the next word in the sentence using learned data, given the previous words.
+
+        Backs off from the longest key to shorter keys, and then to the 3-gram tables, like `get_next`,
+        with the exception that it cannot immediately generate "<END>".
+
+        Args:
+            index (int): The index of this new word in the sentence.
+            words (List[str]): The previous words. Only the last `key_length` are used.
+
+        Returns:
+            Optional[str]: The next word in the sentence, generated given the learned data.
+        """
+        word = self._next(index, words, allow_end=False)
+        if word is None and len(words) >= 2:
+            return super().get_next_initial(index, words[-2:])
+        return word
+
+    def get_next_single_initial(self, index: int, word: str) -> Optional[List[str]]:
+        """Generate the next `key_length - 1` words in the sentence using learned data, given the previous word.
+
+        Walks down the trie from `word` anywhere in a sentence, picking every next word weighted by its count,
+        and never "<END>". If `word` has no path of that length in the trie, `Database.get_next_single_initial`
+        picks a single second word from the 3-gram tables instead.
+
+        Args:
+            index (int): The index of this new word in the sentence.
+            word (str): The previous word.
+
+        Returns:
+            Optional[List[str]]: `word` followed by the generated words, i.e. a key for `get_next`,
+                or None if nothing was learned after `word`.
+        """
+        with self.connect() as conn:
+            words = self._descend(conn, self._find_nodes(conn, [word]), self.key_length - 1)
+        if words is None:
+            return super().get_next_single_initial(index, word)
+        return [word] + words
+
+    def get_next_single_start(self, word: str) -> Optional[List[str]]:
+        """Generate the next `key_length - 1` words in the sentence using learned data, given the very first word in the sentence.
+
+        Walks down the trie from "<START>" and `word`, so only sentences that started with `word` are used.
+        If there is no such path of that length, `Database.get_next_single_start` picks a single second word
+        from the start tables instead.
+
+        Args:
+            word (str): The first word in the sentence.
+
+        Returns:
+            Optional[List[str]]: `word` followed by the generated words, i.e. a key for `get_next`,
+                or None if no sentence started with `word`.
+        """
+        with self.connect() as conn:
+            words = self._descend(conn, self._find_nodes(conn, [self.START, word]), self.key_length - 1)
+        if words is None:
+            return super().get_next_single_start(word)
+        return [word] + words
+
+    def get_start(self) -> List[str]:
+        """Get a list of `key_length` words that mark the start of a sentence.
+
+        Walks down the trie from "<START>", picking every word weighted by its count. If the trie has no
+        starts of that length, `Database.get_start` picks a start of two words from the start tables instead.
+
+        Returns:
+            List[str]: A list of starting words, such as ["I", "am", "very"] for a key length of 3.
+                Empty if nothing has been learned.
+        """
+        with self.connect() as conn:
+            words = self._descend(conn, self._find_nodes(conn, [self.START]), self.key_length)
+        if words is None:
+            return super().get_start()
+        return words
+
+    def _delete_subtrees(self, cur: sqlite3.Cursor, stats: ModelStats, where: str, values: Sequence) -> None:
+        """Delete the nodes matching `where`, and all of their descendants, and account for it in `stats`."""
+        subtrees = f"""id IN (
+            WITH RECURSIVE doomed(id) AS (
+                SELECT id FROM TrieNode WHERE {where}
+                UNION
+                SELECT n.id FROM TrieNode n JOIN doomed d ON n.parent = d.id
+            )
+            SELECT id FROM doomed)"""
+        stats.delete(cur, ModelStats.TRIE, subtrees, values)
+        cur.execute(f"DELETE FROM TrieNode WHERE {subtrees};", values)
+        self._node_ids.clear()
+
+    def compacted(self, cutoff: float, scale: float, renormalized: bool, pruned: Optional[Dict[str, List[Tuple]]] = None) -> None:
+        """Forget the cached ids of nodes that Compactor may have removed."""
+        self._node_ids.clear()
+
+    def unlearn(self, message: str) -> None:
+        """Reduce the count of every window of `message` by 5, like `Database.unlearn`.
+
+        Args:
+            message (str): The message to unlearn.
+        """
+        self.execute_commit()
+        words = [self.START] + message.split(" ")
+        with self.connect() as conn:
+            cur = conn.cursor()
+            stats = ModelStats()
+            delta = -5 * stats.scale(cur)
+            for i in range(len(words) - 1):
+                window = words[i: i + self.key_length + 1]
+                for length in range(1, len(window) + 1):
+                    nodes = self._find_nodes(conn, window[:length])
+                    if not nodes:
+                        break
+                    where = f"id IN ({', '.join('?' * len(nodes))})"
+                    stats.change(cur, ModelStats.TRIE, where, nodes, delta)
+                    cur.execute(f"UPDATE TrieNode SET count = count + ? WHERE {where};", (delta, *nodes))
+                    self._delete_subtrees(cur, stats, f"{where} AND count <= 0", nodes)
+            stats.write(cur)
+        # Also unlearn from the 3-gram tables, which are used when the trie has no successors
+        super().unlearn(message)
+
+    def purge_word(self, target_word: str) -> None:
+        """Remove every node for `target_word`, and everything learned after it.
+
+        Args:
+            target_word (str): The word to purge.
+        """
+        self.execute_commit()
+        with self.connect() as conn:
+            cur = conn.cursor()
+            stats = ModelStats()
+            self._delete_subtrees(cur, stats, "word IN (SELECT id FROM Vocabulary WHERE word = ? COLLATE NOCASE)", (target_word.strip(),))
+            stats.write(cur)
+        super().purge_word(target_word)
@@ -0,0 +1,255 @@
+import logging, string, sys, time
+from typing import Dict, List, Optional
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from CompiledModel import CompiledModel
+from Tokenizer import detokenize
+
+logger = logging.getLogger(__name__)
+
+class VectorSampler:
+    """
+    Generates many sentences at once from a CompiledModel, using NumPy.
+
+    The arrays of the compiled model are wrapped with `numpy.frombuffer`, so no data is copied.
+    A batch of sentences is advanced one position at a time: the keys of all unfinished sentences
+    are looked up with a single `searchsorted` over the sorted keys, and their next words are
+    sampled with a single `searchsorted` over the global cumulative counts.
+
+    Sampling uses the same weights as `Database.pick_word`: the count of "<END>" is multiplied by
+    (index + 1) / 15, and "<END>" is never picked for the first generated word.
+
+    Requires the optional `numpy` dependency.
+    """
+    def __init__(self, model: CompiledModel, seed: Optional[int] = None):
+        """Wrap the arrays of `model`.
+
+        Args:
+            model (CompiledModel): The compiled model to sample from.
+            seed (Optional[int], optional): Seed for the random number generator. Defaults to None.
+
+        Raises:
+            ImportError: If numpy is not installed.
+        """
+        if np is None:
+            raise ImportError("VectorSampler requires numpy. Install it with `pip install numpy`.")
+        self.model = model
+        self.rng = np.random.default_rng(seed)
+
+        self.fold_of = np.frombuffer(model.fold_of, dtype=np.uint32).astype(np.uint64)
+        self.keys = np.frombuffer(model.keys, dtype=np.uint64)
+        self.row_offsets = np.frombuffer(model.row_offsets, dtype=np.uint32).astype(np.int64)
+        self.successors = np.frombuffer(model.successors, dtype=np.uint32)
+        self.cumulative = np.frombuffer(model.cumulative, dtype=np.float64)
+        self.start_offsets = np.frombuffer(model.start_offsets, dtype=np.uint32).astype(np.int64)
+        self.start_word1 = np.frombuffer(model.start_word1, dtype=np.uint32)
+        self.start_word2 = np.frombuffer(model.start_word2, dtype=np.uint32)
+        self.start_cumulative = np.frombuffer(model.start_cumulative, dtype=np.float64)
+        self.end_id = model.end_id
+
+        # Probability of every table suffix, as in Database.get_start
+        self.suffix_weights = np.array(model.word_frequency) / sum(model.word_frequency)
+        # Decoded words, and whether they count as words rather than punctuation, filled as they are needed
+        self._words: Dict[int, str] = {}
+        self._word_flags: Dict[int, bool] = {}
+
+    def _before(self, cumulative: "np.ndarray", offsets: "np.ndarray") -> "np.ndarray":
+        """Get the running total before every offset, i.e. cumulative[offsets - 1], or 0 for offset 0."""
+        return np.where(offsets > 0, cumulative[np.maximum(offsets - 1, 0)], 0)
+
+    def starts(self, n: int) -> "np.ndarray":
+        """Pick `n` random starts, like `Database.get_start`.
+
+        Args:
+            n (int): The number of starts to pick.
+
+        Returns:
+            np.ndarray: An (n, 2) array of word ids. Rows are -1 if the picked suffix has no starts.
+        """
+        result = np.full((n, 2), -1, dtype=np.int64)
+        if not len(self.start_word1):
+            return result
+        suffixes = self.rng.choice(len(self.suffix_weights), size=n, p=self.suffix_weights)
+        lo = self.start_offsets[suffixes]
+        hi = self.start_offsets[suffixes + 1]
+        base = self._before(self.start_cumulative, lo)
+        total = self._before(self.start_cumulative, hi) - base
+        valid = (hi > lo) & (total > 0)
+
+        target = base + self.rng.random(n) * total
+        positions = np.minimum(np.searchsorted(self.start_cumulative, target, side="right"), np.maximum(hi - 1, 0))
+        result[valid, 0] = self.start_word1[positions[valid]]
+        result[valid, 1] = self.start_word2[positions[valid]]
+        return result
+
+    def step(self, words1: "np.ndarray", words2: "np.ndarray", index: int) -> "np.ndarray":
+        """Pick the next word for every key `words1[i] words2[i]`, like `Database.get_next`.
+
+        Args:
+            words1 (np.ndarray): The ids of the first words of the keys.
+            words2 (np.ndarray): The ids of the second words of the keys.
+            index (int): The index of the newly generated words in the sentences.
+                For index 0, "<END>" is never picked, like `Database.get_next_initial`.
+
+        Returns:
+            np.ndarray: The ids of the next words, or -1 for keys without any successors.
+        """
+        n = len(words1)
+        result = np.full(n, -1, dtype=np.int64)
+        if not len(self.keys) or not n:
+            return result
+        keys = self.fold_of[words1] << np.uint64(32) | self.fold_of[words2]
+        rows = np.searchsorted(self.keys, keys, side="right") - 1
+        found = (rows >= 0) & (self.keys[np.maximum(rows, 0)] == keys)
+        rows = rows[found]
+
+        lo = self.row_offsets[rows]
+        hi = self.row_offsets[rows + 1]
+        base = self._before(self.cumulative, lo)
+        # "<END>" is always the first successor of a row
+        end = np.where(self.successors[lo] == self.end_id, self.cumulative[lo] - base, 0)
+        end_weight = 0 if index == 0 else (index + 1) / 15
+        total = self.cumulative[hi - 1] - base - end + end * end_weight
+
+        target = self.rng.random(len(rows)) * total
+        is_end = target < end * end_weight
+        positions = np.searchsorted(self.cumulative, base + end + (target - end * end_weight), side="right")
+        picked = self.successors[np.minimum(positions, hi - 1)].astype(np.int64)
+        picked[is_end] = self.end_id
+        picked[total <= 0] = -1
+        result[found] = picked
+        return result
+
+    def _is_word(self, ids: "np.ndarray") -> "np.ndarray":
+        """Get whether every token of `ids` counts as a word, like `MarkovChain.sentence_length`, i.e. is not punctuation."""
+        unique, inverse = np.unique(ids, return_inverse=True)
+        unique = unique.tolist()
+        for word_id in unique:
+            if word_id not in self._word_flags:
+                word = self._decode(word_id)
+                self._word_flags[word_id] = word not in string.punctuation and word[0] != "'"
+        return np.array([self._word_flags[word_id] for word_id in unique], dtype=np.int64)[inverse]
+
+    def _decode(self, word_id: int) -> str:
+        """Get the word of `word_id`, decoding it from the model only once."""
+        word = self._words.get(word_id)
+        if word is None:
+            word = self._words[word_id] = self.model.word(word_id)
+        return word
+
+    def generate(self, n: int, max_length: int = 25, min_length: int = -1, separator: str = ". ") -> List[str]:
+        """Generate `n` messages from random starts, like `MarkovChain.generate` without any input.
+
+        Every message has fewer than `max_length` words, not counting punctuation, or stops after
+        `max_length * 2` generated tokens. If a sentence ends before `min_length` tokens were generated,
+        another sentence is started, and the sentences are joined with `separator`.
+
+        Args:
+            n (int): The number of messages to generate.
+            max_length (int, optional): The maximum number of words, see "MaxSentenceWordAmount". Defaults to 25.
+            min_length (int, optional): The minimum number of generated tokens, see "MinSentenceWordAmount". Defaults to -1.
+            separator (str, optional): The separator between sentences, see "SentenceSeparator". Defaults to ". ".
+
+        Returns:
+            List[str]: The detokenized messages. Empty strings if nothing was learned for the picked start.
+        """
+        # Every generated token takes one position, and every new sentence one for the separator and two for its start
+        tokens = np.full((n, 2 + 3 * 2 * max(max_length, 1)), -1, dtype=np.int64)
+        tokens[:, :2] = self.starts(n)
+        active = np.flatnonzero(tokens[:, 0] >= 0)
+        positions = np.full(n, 2, dtype=np.int64)
+        words = np.zeros(n, dtype=np.int64)
+        words[active] = self._is_word(tokens[active, 0]) + self._is_word(tokens[active, 1])
+        keys = tokens[:, :2].copy()
+        for index in range(max_length * 2):
+            active = active[words[active] < max_length]
+            if not len(active):
+                break
+            picked = self.step(keys[active, 0], keys[active, 1], index)
+            ended = (picked < 0) | (picked == self.end_id)
+
+            restarted = active[ended] if index + 1 < min_length else active[:0]
+            if len(restarted):
+                starts = self.starts(len(restarted))
+                found = starts[:, 0] >= 0
+                restarted, starts = restarted[found], starts[found]
+                # -2 marks the end of a sentence
+                tokens[restarted, positions[restarted]] = -2
+                tokens[restarted, positions[restarted] + 1] = starts[:, 0]
+                tokens[restarted, positions[restarted] + 2] = starts[:, 1]
+                positions[restarted] += 3
+                words[restarted] += self._is_word(starts[:, 0]) + self._is_word(starts[:, 1])
+                keys[restarted] = starts
+
+            continued = active[~ended]
+            picked = picked[~ended]
+            tokens[continued, positions[continued]] = picked
+            positions[continued] += 1
+            if len(continued):
+                words[continued] += self._is_word(picked)
+            keys[continued, 0] = keys[continued, 1]
+            keys[continued, 1] = picked
+            active = np.concatenate((continued, restarted))
+
+        messages = []
+        for row, length in zip(tokens.tolist(), positions.tolist()):
+            if row[0] < 0:
+                messages.append("")
+                continue
+            sentences = [[]]
+            for word_id in row[:length]:
+                if word_id == -2:
+                    sentences.append([])
+                else:
+                    sentences[-1].append(self._decode(word_id))
+            messages.append(separator.join(detokenize(sentence) for sentence in sentences))
+        return messages
+
+def generate_sequential(model: CompiledModel, n: int, max_length: int = 25, min_length: int = -1, separator: str = ". ") -> List[str]:
+    """Generate `n` messages one word at a time with the pure Python sampling of `model`, like `MarkovChain.generate`, for comparison."""
+    messages = []
+    for _ in range(n):
+        sentences = [model.get_start()]
+        if not sentences[0]:
+            messages.append("")
+            continue
+        key = sentences[0][-2:]
+        index = 0
+        while sum(token not in string.punctuation and token[0] != "'" for sentence in sentences for token in sentence) < max_length and index < max_length * 2:
+            word = model.get_next_initial(index, key) if index == 0 else model.get_next(index, key)
+            index += 1
+            if word is None or word == "<END>":
+                if index < min_length:
+                    key = model.get_start()
+                    if key:
+                        sentences.append(key.copy())
+                        continue
+                break
+            sentences[-1].append(word)
+            key = [key[-1], word]
+        messages.append(separator.join(detokenize(sentence) for sentence in sentences))
+    return messages
+
+if __name__ == "__main__":
+    # Compare the throughput of batched and sequential generation from a compiled model.
+    # Usage: python VectorSampler.py <channel> [number of sentences]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    model = CompiledModel(CompiledModel.path_for(sys.argv[1]))
+    n = int(sys.argv[2]) if len(sys.argv) > 2 else 10000
+    sampler = VectorSampler(model)
+
+    start = time.perf_counter()
+    sentences = sampler.generate(n)
+    vector_rate = n / (time.perf_counter() - start)
+    start = time.perf_counter()
+    generate_sequential(model, n)
+    sequential_rate = n / (time.perf_counter() - start)
+
+    logger.info(f"Batched: {vector_rate:.0f} sentences per second. Sequential: {sequential_rate:.0f} sentences per second "
+                f"({vector_rate / sequential_rate:.1f}x).")
+    for message in sentences[:5]:
+        logger.info(message)
@@ -0,0 +1,204 @@
+import json, logging, os, string, threading, time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Tuple
+
+from Metrics import CACHE_REQUESTS
+
+logger = logging.getLogger(__name__)
+
+# ("next", word1, word2) for the successors of a key, or ("start", character) for a MarkovStart table
+Key = Tuple[str, ...]
+# SQLite's NOCASE collation, used by every word column, only folds ASCII letters
+NOCASE = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+class WarmCache:
+    """
+    A read cache for a Database, holding the successors of keys, i.e. every (word3, count) of a
+    (word1, word2), and the start tables. It is bounded by a memory budget, and evicts the least
+    recently used entries.
+
+    How often each key is used is tracked, and the hottest keys are written to
+    `MarkovChain_{channel}_hot_keys.json` by the maintenance task and on shutdown. After a restart,
+    `prefetch` loads them again in a background thread, while the bot is already serving, so that
+    the first generations do not have to query SQLite for every word.
+
+    Successors that are learned in this process are dropped from the cache once they are committed.
+    Every entry is also reloaded after `max_age` seconds, which picks up the changes made by
+    other processes, such as the learning worker. Nearly every learned message adds a start, so
+    start tables are only reloaded after `max_age` seconds.
+    """
+    def __init__(self, db, budget: int, max_age: float = 300, max_keys: int = 20000) -> None:
+        """Create a WarmCache.
+
+        Args:
+            db (Database): The Database to cache lookups of.
+            budget (int): The maximum estimated size of the cached entries, in bytes.
+            max_age (float, optional): The number of seconds after which an entry is reloaded. Defaults to 300.
+            max_keys (int, optional): The maximum number of hot keys written to the file. Defaults to 20000.
+        """
+        self.db = db
+        self.path = db.db_name[:-3] + "_hot_keys.json"
+        self.budget = budget
+        self.max_age = max_age
+        self.max_keys = max_keys
+        # Key -> (data, estimated size, time it was loaded), from least to most recently used
+        self._entries: "OrderedDict[Key, Tuple[List[Tuple[Any, ...]], int, float]]" = OrderedDict()
+        self.size = 0
+        # Number of uses per key, decayed by `save` so that keys that went cold are eventually forgotten
+        self.uses: Dict[Key, int] = {}
+        # Keys learned since the last commit
+        self._learned: set = set()
+        # Increased on every invalidation, so that data read before it is not cached after it
+        self._version = 0
+        self._lock = threading.Lock()
+        self.prefetcher: Optional[threading.Thread] = None
+        self.stopped = threading.Event()
+
+    @staticmethod
+    def next_key(words: List[str]) -> Key:
+        """The key of the successors of `words`, matching case insensitively like SQLite does."""
+        return ("next", words[0].translate(NOCASE), words[1].translate(NOCASE))
+
+    @staticmethod
+    def start_key(character: str) -> Key:
+        """The key of the MarkovStart table of `character`."""
+        return ("start", character)
+
+    @staticmethod
+    def estimate_size(data: List[Tuple[Any, ...]]) -> int:
+        """Roughly estimate the bytes of a list of rows of words and counts."""
+        return 56 + sum(56 + 8 * len(row) + sum(49 + len(value) if isinstance(value, str) else 24 for value in row)
+                        for row in data)
+
+    def get(self, key: Key) -> Tuple[Optional[List[Tuple[Any, ...]]], int]:
+        """Get the cached data of `key`, and count it as a use.
+
+        Returns:
+            Tuple[Optional[List[Tuple[Any, ...]]], int]: The data, or None if it must be read from the
+                Database, and the version to pass on to `put` along with the data that was read.
+        """
+        with self._lock:
+            self.uses[key] = self.uses.get(key, 0) + 1
+            entry = self._entries.get(key)
+            if entry is not None and time.monotonic() - entry[2] >= self.max_age:
+                self._drop(key)
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+            version = self._version
+        CACHE_REQUESTS.inc(labels=("warm", "miss" if entry is None else "hit"))
+        return (None if entry is None else entry[0]), version
+
+    def put(self, key: Key, data: List[Tuple[Any, ...]], version: int) -> bool:
+        """Cache `data` of `key`, read from the Database after `get` returned `version`.
+
+        Returns:
+            bool: Whether the data was cached. Not if it was invalidated in the meantime,
+                or if it is larger than a quarter of the budget.
+        """
+        size = self.estimate_size(data)
+        if size > self.budget // 4:
+            return False
+        with self._lock:
+            if version != self._version:
+                return False
+            self._drop(key)
+            self._entries[key] = (data, size, time.monotonic())
+            self.size += size
+            while self.size > self.budget:
+                self._drop(next(iter(self._entries)))
+        return True
+
+    def _drop(self, key: Key) -> None:
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def learned(self, key: Key) -> None:
+        """Mark `key` as learned, so that it is dropped from the cache once it is committed."""
+        with self._lock:
+            self._learned.add(key)
+
+    def committed(self) -> None:
+        """Drop the keys that were learned before the commit that just finished."""
+        with self._lock:
+            for key in self._learned:
+                self._drop(key)
+            self._learned.clear()
+            self._version += 1
+
+    def clear(self) -> None:
+        """Drop all entries, e.g. after unlearning or purging, which may change any of them."""
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+            self._version += 1
+
+    def hottest(self) -> List[Tuple[Key, int]]:
+        """Get up to `max_keys` of the most used keys, along with their number of uses, from most to least used."""
+        with self._lock:
+            uses = list(self.uses.items())
+        uses.sort(key=lambda item: item[1], reverse=True)
+        return uses[:self.max_keys]
+
+    def save(self) -> None:
+        """Write the hottest keys to the file, and halve the number of uses of every key."""
+        hottest = self.hottest()
+        if not hottest:
+            return
+        # Written to a temporary file first, so a crash while writing never loses the previous keys
+        with open(self.path + ".tmp", "w") as f:
+            json.dump({"keys": [[*key, count] for key, count in hottest]}, f)
+        os.replace(self.path + ".tmp", self.path)
+        with self._lock:
+            self.uses = {key: count // 2 for key, count in self.uses.items() if count > 1}
+        logger.debug(f"[#{self.db.channel}] Saved {len(hottest)} hot keys to {self.path}.")
+
+    def load(self) -> List[Tuple[Key, int]]:
+        """Read the hot keys written by `save`, from most to least used, or an empty list if there are none."""
+        try:
+            with open(self.path, "r") as f:
+                return [(tuple(item[:-1]), item[-1]) for item in json.load(f)["keys"]]
+        except FileNotFoundError:
+            return []
+        except (ValueError, KeyError, TypeError, IndexError):
+            logger.warning(f"[#{self.db.channel}] Ignoring the unreadable hot keys file {self.path}.")
+            return []
+
+    def prefetch(self) -> None:
+        """Load the hot keys of the previous run into the cache in a background thread."""
+        self.prefetcher = threading.Thread(target=self._prefetch, name=f"WarmCache-{self.db.channel}", daemon=True)
+        self.prefetcher.start()
+
+    def _prefetch(self) -> None:
+        hot_keys = self.load()
+        if not hot_keys:
+            return
+        start = time.perf_counter()
+        loaded = 0
+        conn = self.db.connect()
+        try:
+            for key, count in hot_keys:
+                if self.stopped.is_set() or self.size >= self.budget * 0.9:
+                    break
+                with self._lock:
+                    # Keep the hot keys hot until they are used again, at half their previous uses
+                    self.uses[key] = self.uses.get(key, 0) + count // 2
+                    if key in self._entries:
+                        continue
+                    version = self._version
+                if key[0] == "next":
+                    data = self.db.select_successors(list(key[1:]), conn=conn)
+                else:
+                    data = self.db.select_starts(key[1], conn=conn)
+                loaded += self.put(key, data, version)
+        except Exception:
+            logger.exception(f"[#{self.db.channel}] Prefetching the hot keys failed.")
+        finally:
+            conn.close()
+        logger.info(f"[#{self.db.channel}] Prefetched {loaded} of {len(hot_keys)} hot keys "
+                    f"({self.size / 2 ** 20:.1f}MB) in {time.perf_counter() - start:.2f} seconds.")
+
+    def memory_components(self) -> Dict[str, Any]:
+        """Get the in-memory structures of this WarmCache by name, whose size is estimated in memory reports."""
+        return {"warm_cache": self._entries, "warm_cache_uses": self.uses}
@@ -0,0 +1,339 @@
+import argparse, json, logging, os, platform, re, sqlite3, statistics, subprocess, sys, time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChatGenerator import ChatGenerator
+from CompiledModel import CompiledModel
+from Database import Database
+from Learner import learn_words
+from ModelStats import ModelStats
+from Settings import Settings
+from Tokenizer import detokenize, tokenize
+from VectorSampler import VectorSampler, np
+from WarmCache import WarmCache
+
+logger = logging.getLogger(__name__)
+
+# Version of the result format, increased when metrics are renamed or change meaning
+FORMAT = 1
+SENTENCE_REGEX = re.compile(r"(?<=[.!?])\s+")
+SIZE_SUFFIXES = {"k": 10 ** 3, "m": 10 ** 6}
+# Megabytes of lookups cached by the warm cache in the restart benchmark, as it is disabled by default
+WARM_CACHE_SIZE = 16
+
+def parse_size(size: str) -> int:
+    """Parse a number of n-grams such as "10k" or "50M"."""
+    size = size.strip().lower()
+    if size[-1:] in SIZE_SUFFIXES:
+        return int(float(size[:-1]) * SIZE_SUFFIXES[size[-1]])
+    return int(size)
+
+def format_size(size: int) -> str:
+    """Format a number of n-grams as e.g. "10k" or "50M"."""
+    if size % 10 ** 6 == 0:
+        return f"{size // 10 ** 6}M"
+    if size % 10 ** 3 == 0:
+        return f"{size // 10 ** 3}k"
+    return str(size)
+
+def database_files(channel: str) -> List[str]:
+    """Get the paths of all files of the Database of `channel`."""
+    db_name = f"/app/db/MarkovChain_{channel}.db"
+    return [db_name, db_name + "-wal", db_name + "-shm", db_name[:-3] + "_archive.db", db_name[:-3] + "_slow_queries.log",
+            db_name[:-3] + "_hot_keys.json", db_name[:-3] + ".model"]
+
+def database_bytes(channel: str) -> int:
+    """Get the total size of the files of the Database of `channel`."""
+    return sum(os.path.getsize(path) for path in database_files(channel) if os.path.isfile(path))
+
+def remove_database(channel: str) -> None:
+    for path in database_files(channel):
+        if os.path.isfile(path):
+            os.remove(path)
+
+def sentences(text: str) -> List[List[str]]:
+    """Split `text` into tokenized sentences, like `Learner.learn` does, without nltk's punkt resource."""
+    return [[word for word in tokenize(sentence) if word] for sentence in SENTENCE_REGEX.split(text.strip()) if sentence]
+
+def percentiles(durations: List[float]) -> Dict[str, float]:
+    """Summarize durations in seconds as the mean, p50, p95 and p99 in milliseconds."""
+    durations = sorted(durations)
+    def at(fraction: float) -> float:
+        return durations[min(int(fraction * len(durations)), len(durations) - 1)] * 1000
+    return {"mean_ms": statistics.fmean(durations) * 1000, "p50_ms": at(0.5), "p95_ms": at(0.95), "p99_ms": at(0.99)}
+
+def bench_tokenize(generator: ChatGenerator, count: int) -> Dict[str, float]:
+    """Measure the throughput of `tokenize` and `detokenize` on chat messages."""
+    texts = [message.text for message in generator.messages(count)]
+    start = time.perf_counter()
+    tokenized = [tokenize(text) for text in texts]
+    tokenize_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    for words in tokenized:
+        detokenize(words)
+    detokenize_seconds = time.perf_counter() - start
+    return {"tokenize.messages_per_second": count / tokenize_seconds,
+            "detokenize.messages_per_second": count / detokenize_seconds}
+
+def bench_learn(generator: ChatGenerator, count: int) -> Tuple[Dict[str, float], List[str]]:
+    """Measure learning `count` messages into a new Database, through the execute queue.
+
+    Returns:
+        Tuple[Dict[str, float], List[str]]: The metrics, and the learned messages.
+    """
+    channel = "benchmark_learn"
+    remove_database(channel)
+    db = Database(channel)
+    texts = [message.text for message in generator.messages(count)]
+    tokenized = [sentences(text) for text in texts]
+    # A sentence of n words is learned as n - 2 3-grams and one 3-gram ending in <END>
+    ngrams = sum(len(words) - 1 for message in tokenized for words in message if len(words) > 2)
+    start = time.perf_counter()
+    for message in tokenized:
+        for words in message:
+            learn_words(db, words, 2)
+    db.execute_commit()
+    seconds = time.perf_counter() - start
+    stats = db.model_stats()
+    size = database_bytes(channel)
+    return {"learn.messages_per_second": count / seconds,
+            "learn.ngrams_per_second": ngrams / seconds,
+            "learn.db_bytes": size,
+            "learn.db_bytes_per_ngram": size / max(stats["ngrams"] + stats["starts"], 1)}, texts
+
+def bench_unlearn(texts: List[str], count: int) -> Dict[str, float]:
+    """Measure `unlearn` of learned messages and `purge_word` of learned words, on the Database of `bench_learn`."""
+    db = Database("benchmark_learn")
+    durations = []
+    for text in texts[:count]:
+        start = time.perf_counter()
+        db.unlearn(text)
+        durations.append(time.perf_counter() - start)
+    results = {f"unlearn.{key}": value for key, value in percentiles(durations).items()}
+    # Purge words of different frequencies, from the later messages, which were not unlearned
+    words = [words[len(words) // 2] for text in texts[count:] for words in sentences(text)[:1] if words]
+    durations = []
+    for word in words[:max(count // 10, 1)]:
+        start = time.perf_counter()
+        db.purge_word(word)
+        durations.append(time.perf_counter() - start)
+    results.update({f"purge_word.{key}": value for key, value in percentiles(durations).items()})
+    return results
+
+def build_database(channel: str, ngrams: int, seed: int) -> None:
+    """Create the Database of `channel` with about `ngrams` distinct 3-grams of synthetic chat.
+
+    Rows are written in large batches, which is much faster than learning them message by message,
+    so that models with tens of millions of n-grams can be created in minutes.
+    """
+    remove_database(channel)
+    db = Database(channel)
+    generator = ChatGenerator(seed, vocabulary=min(max(2000, int(ngrams ** 0.6)), 200_000))
+    conn = db.connect(isolation_level=None)
+    rows = 0
+    start = time.perf_counter()
+    while rows < ngrams:
+        grammar: Dict[str, Dict[Tuple[str, ...], int]] = {}
+        starts: Dict[str, Dict[Tuple[str, ...], int]] = {}
+        batch = 0
+        while batch < min(500_000, ngrams - rows + 1000):
+            for words in sentences(generator.text()):
+                if len(words) <= 2:
+                    continue
+                table = starts.setdefault(f"MarkovStart{db.get_suffix(words[0][0])}", {})
+                table[(words[0], words[1])] = table.get((words[0], words[1]), 0) + 1
+                for item in zip(words, words[1:], words[2:] + ["<END>"]):
+                    table = grammar.setdefault(f"MarkovGrammar{db.get_suffix(item[0][0])}{db.get_suffix(item[1][0])}", {})
+                    table[item] = table.get(item, 0) + 1
+                    batch += 1
+        conn.execute("BEGIN;")
+        for tables, columns in ((grammar, "word1, word2, word3"), (starts, "word1, word2")):
+            for table, counts in tables.items():
+                placeholders = ", ".join("?" * (columns.count(",") + 1))
+                before = conn.total_changes
+                conn.executemany(f"INSERT OR IGNORE INTO {table} ({columns}, count) VALUES ({placeholders}, 0);", counts.keys())
+                if tables is grammar:
+                    rows += conn.total_changes - before
+                where = " AND ".join(f"{column} = ? COLLATE BINARY" for column in columns.split(", "))
+                conn.executemany(f"UPDATE {table} SET count = count + ? WHERE {where};",
+                                 ((count, *key) for key, count in counts.items()))
+        conn.execute("COMMIT;")
+        logger.info(f"Created {rows} of {ngrams} 3-grams in {channel} in {time.perf_counter() - start:.1f} seconds.")
+    ModelStats.rebuild(conn)
+    conn.close()
+
+def make_bot(db: Database):
+    """Create a MarkovChain that generates from `db`, without connecting to Twitch."""
+    from types import SimpleNamespace
+    from MarkovChainBot import MarkovChain
+    bot = MarkovChain.__new__(MarkovChain)
+    bot.set_settings(dict(Settings.DEFAULTS, Channel=f"#{db.channel}"))
+    bot.channels = {db.channel: SimpleNamespace(name=db.channel, db=db, model=db, key_length=2)}
+    return bot
+
+def bench_generate(size: int, seed: int, count: int, keep: bool) -> Dict[str, float]:
+    """Measure the latency of `MarkovChain.generate` on a Database with `size` 3-grams."""
+    channel = f"benchmark_{format_size(size).lower()}"
+    existing = {}
+    if keep and os.path.isfile(database_files(channel)[0]):
+        existing = Database(channel).model_stats()
+    if not existing or abs(existing["ngrams"] - size) > size * 0.1:
+        build_database(channel, size, seed)
+    db = Database(channel)
+    db.seed(seed)
+    bot = make_bot(db)
+    # Warm up the page cache, as in a bot that has been running for a while
+    for _ in range(min(count // 10, 20)):
+        bot.generate()
+    durations = []
+    for _ in range(count):
+        start = time.perf_counter()
+        bot.generate()
+        durations.append(time.perf_counter() - start)
+    results = {f"generate.{format_size(size)}.{key}": value for key, value in percentiles(durations).items()}
+    results[f"generate.{format_size(size)}.db_bytes"] = database_bytes(channel)
+    if not keep:
+        remove_database(channel)
+    return results
+
+def bench_batch(size: int, seed: int, count: int, keep: bool) -> Dict[str, float]:
+    """Measure generating `count` messages at once with VectorSampler, and one by one with `MarkovChain.generate`.
+
+    Both generate from a CompiledModel of a Database with `size` 3-grams. Skipped if numpy is not installed.
+    """
+    if np is None:
+        logger.warning("Skipping the batch benchmark, as it requires numpy. Install it with `pip install -r requirements-optional.txt`.")
+        return {}
+    channel = f"benchmark_{format_size(size).lower()}"
+    existing = {}
+    if keep and os.path.isfile(database_files(channel)[0]):
+        existing = Database(channel).model_stats()
+    if not existing or abs(existing["ngrams"] - size) > size * 0.1:
+        build_database(channel, size, seed)
+    CompiledModel.compile(channel)
+    model = CompiledModel(CompiledModel.path_for(channel))
+    model.seed(seed)
+    bot = make_bot(Database(channel))
+    bot.channels[channel].model = model
+    sampler = VectorSampler(model, seed)
+
+    start = time.perf_counter()
+    sampler.generate(count, bot.max_sentence_length, bot.min_sentence_length, bot.sent_separator)
+    batched = count / (time.perf_counter() - start)
+    start = time.perf_counter()
+    for _ in range(count):
+        bot.generate()
+    sequential = count / (time.perf_counter() - start)
+    # The arrays of the sampler refer to the memory map of the model
+    del sampler
+    model.close()
+    if not keep:
+        remove_database(channel)
+    return {f"batch.{format_size(size)}.batched_sentences_per_second": batched,
+            f"batch.{format_size(size)}.sequential_sentences_per_second": sequential}
+
+def bench_restart(size: int, seed: int, count: int, keep: bool) -> Dict[str, float]:
+    """Measure the latency of the first `count` generations after a restart, without and with the warm cache.
+
+    A first run generates `count` sentences and saves its hot keys. Then another seed generates
+    the same sentences with a Database without a cache, and with one that prefetched the saved hot keys.
+    """
+    channel = f"benchmark_restart_{format_size(size).lower()}"
+    if not (keep and os.path.isfile(database_files(channel)[0])):
+        build_database(channel, size, seed)
+    budget = WARM_CACHE_SIZE * 2 ** 20
+    db = Database(channel)
+    db.warm_cache = WarmCache(db, budget)
+    db.seed(seed)
+    bot = make_bot(db)
+    for _ in range(count):
+        bot.generate()
+    db.warm_cache.save()
+
+    results = {}
+    for name in ("cold", "warm"):
+        db = Database(channel)
+        if name == "warm":
+            db.warm_cache = WarmCache(db, budget)
+            start = time.perf_counter()
+            db.warm_cache.prefetch()
+            db.warm_cache.prefetcher.join()
+            results["restart.prefetch_seconds"] = time.perf_counter() - start
+        db.seed(seed + 1)
+        bot = make_bot(db)
+        durations = []
+        for _ in range(count):
+            start = time.perf_counter()
+            bot.generate()
+            durations.append(time.perf_counter() - start)
+        results.update({f"restart.{name}.{key}": value for key, value in percentiles(durations).items()})
+    if not keep:
+        remove_database(channel)
+    return results
+
+def metadata(**arguments) -> Dict[str, object]:
+    """Describe the commit and environment of a run, along with its `arguments`."""
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {"commit": commit, "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(), "sqlite": sqlite3.sqlite_version, "platform": platform.platform(),
+            **arguments}
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run the benchmarks, and write the results as JSON.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic chat and of generation.")
+    parser.add_argument("--messages", type=int, default=20000, help="Number of messages to tokenize and learn.")
+    parser.add_argument("--sizes", default="10k,100k,1M", help="Comma separated numbers of 3-grams to measure generation at, e.g. 10k,1M,50M.")
+    parser.add_argument("--generations", type=int, default=500, help="Number of sentences to generate per size.")
+    parser.add_argument("--restart-size", default="100k", help="Number of 3-grams to measure generation right after a restart at.")
+    parser.add_argument("--batch", type=int, default=10000, help="Number of messages to generate at once in the batch benchmark.")
+    parser.add_argument("--only", default="tokenize,learn,unlearn,generate,batch,restart", help="Comma separated benchmarks to run.")
+    parser.add_argument("--keep", action="store_true", help="Keep the generated databases, and reuse them in later runs.")
+    parser.add_argument("--output", default="", help="File to write the results to. Defaults to benchmarks/results/<commit>.json.")
+    args = parser.parse_args()
+    only = set(args.only.split(","))
+
+    results: Dict[str, float] = {}
+    def run(name: str, function: Callable[[], Dict[str, float]]) -> None:
+        start = time.perf_counter()
+        results.update(function())
+        logger.info(f"Ran the {name} benchmark in {time.perf_counter() - start:.1f} seconds.")
+
+    if "tokenize" in only:
+        run("tokenize", lambda: bench_tokenize(ChatGenerator(args.seed), args.messages))
+    if "learn" in only or "unlearn" in only:
+        learned, texts = bench_learn(ChatGenerator(args.seed), args.messages)
+        results.update(learned)
+        if "unlearn" in only:
+            run("unlearn", lambda: bench_unlearn(texts, min(200, len(texts) // 2)))
+        if not args.keep:
+            remove_database("benchmark_learn")
+    if "generate" in only:
+        for size in args.sizes.split(","):
+            run(f"generate {size}", lambda: bench_generate(parse_size(size), args.seed, args.generations, args.keep))
+    if "batch" in only:
+        for size in args.sizes.split(","):
+            run(f"batch {size}", lambda: bench_batch(parse_size(size), args.seed, args.batch, args.keep))
+    if "restart" in only:
+        run("restart", lambda: bench_restart(parse_size(args.restart_size), args.seed, args.generations, args.keep))
+
+    meta = metadata(seed=args.seed, messages=args.messages, sizes=args.sizes, generations=args.generations,
+                    batch=args.batch, restart_size=args.restart_size)
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results", f"{meta['commit'] or 'unknown'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({"format": FORMAT, "meta": meta, "results": results}, f, indent=2, sort_keys=True)
+    for name, value in sorted(results.items()):
+        print(f"{name:<40} {value:>16.3f}")
+    logger.info(f"Wrote the results to {output}.")
+
+if __name__ == "__main__":
+    # Run the benchmarks and write the results, e.g. to compare them with Compare.py.
+    # Usage: python benchmarks/Benchmark.py [--seed 0] [--sizes 10k,100k,1M] [--output results.json]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    main()
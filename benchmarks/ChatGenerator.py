@@ -0,0 +1,239 @@
+import heapq, math, random, string, uuid
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+
+class ChatMessage(NamedTuple):
+    """A generated chat message, sent `time` seconds after the first one."""
+    time: float
+    user: str
+    text: str
+    # IRC tags, e.g. {"badges": "subscriber/12", "emotes": "25:0-4"}
+    tags: Dict[str, str]
+
+class ChatGenerator:
+    """
+    Generates a reproducible synthetic Twitch chat from a seed.
+
+    Words are drawn from a Zipf distribution over a synthetic vocabulary, so a few words are very
+    common and most are rare, as in real chat. Message lengths follow a log-normal distribution
+    with a median of about 6 words. Messages contain global and channel emotes, with matching
+    `emotes` tags, and some are links, commands, emote walls or copypasta bursts, in which many
+    users repeat the same long message within a few seconds.
+    """
+    EMOTES = {"25": "Kappa", "88": "PogChamp", "425618": "LUL", "41": "Kreygasm", "354": "4Head",
+              "30259": "HeyGuys", "86": "BibleThump", "1902": "Keepo", "58765": "NotLikeThis", "160400": "KonCha"}
+    CHANNEL_EMOTES = {"300000001": "cubieHi", "300000002": "cubieLove", "300000003": "cubieHype"}
+    COMMANDS = ["!g", "!generate", "!discord", "!uptime", "!so", "!followage", "!lurk"]
+    LINKS = ["https://clips.twitch.tv/{}", "https://youtu.be/{}", "www.example.com/{}", "https://imgur.com/{}"]
+    PUNCTUATION = [".", "!", "?", "...", ",", "!!"]
+    BADGES = [("", 0.45), ("subscriber/1", 0.25), ("subscriber/12", 0.15), ("vip/1", 0.03),
+              ("moderator/1", 0.04), ("subscriber/3,bits/100", 0.08)]
+
+    def __init__(self, seed: int = 0, vocabulary: int = 5000, users: int = 500, rate: float = 10.0,
+                 channel: str = "benchmark") -> None:
+        """Create a ChatGenerator.
+
+        Args:
+            seed (int, optional): The seed of the generated chat. Defaults to 0.
+            vocabulary (int, optional): The number of distinct words. Defaults to 5000.
+            users (int, optional): The number of distinct chatters. Defaults to 500.
+            rate (float, optional): The average number of messages per second. Defaults to 10.0.
+            channel (str, optional): The channel name used in IRC lines. Defaults to "benchmark".
+        """
+        self.random = random.Random(seed)
+        self.rate = rate
+        self.channel = channel
+        self.words = self._make_words(vocabulary)
+        # Cumulative Zipf weights, for bisecting with a uniform sample
+        weights = [1 / (rank + 1) ** 1.1 for rank in range(vocabulary)]
+        total = sum(weights)
+        self.cumulative = list(self._accumulate(weight / total for weight in weights))
+        self.users = [f"{self.random.choice(['', 'the', 'xx', 'lil'])}{self._word(5, 9)}{self.random.randint(0, 999)}"
+                      for _ in range(users)]
+        self.user_badges = {user: self._pick_badges() for user in self.users}
+        self.user_ids = {user: str(200000 + i) for i, user in enumerate(self.users)}
+        self.copypastas = [self.sentence(self.random.randint(20, 40)) for _ in range(20)]
+        self.time = 0.0
+        # Messages that are still to be sent in a copypasta burst
+        self._burst: List[str] = []
+
+    @staticmethod
+    def _accumulate(values: Iterator[float]) -> Iterator[float]:
+        total = 0.0
+        for value in values:
+            total += value
+            yield total
+
+    def _word(self, low: int, high: int) -> str:
+        """Make a random pronounceable word of `low` to `high` letters."""
+        consonants, vowels = "bcdfghjklmnprstvwz", "aeiou"
+        length = self.random.randint(low, high)
+        return "".join(self.random.choice(vowels if i % 2 else consonants) for i in range(length))
+
+    def _make_words(self, vocabulary: int) -> List[str]:
+        """Make `vocabulary` distinct words, with the most common ones the shortest."""
+        words = ["I", "the", "a", "you", "is", "it", "to", "and", "that", "what", "lol", "this"]
+        seen = set(words)
+        while len(words) < vocabulary:
+            word = self._word(1 + min(len(words) // 500, 4), 3 + min(len(words) // 200, 7))
+            if len(words) % 7 == 0:
+                word = word.capitalize()
+            if word not in seen:
+                seen.add(word)
+                words.append(word)
+        return words[:vocabulary]
+
+    def _pick_badges(self) -> str:
+        target = self.random.random()
+        for badges, probability in self.BADGES:
+            target -= probability
+            if target <= 0:
+                return badges
+        return ""
+
+    def word(self) -> str:
+        """Draw a word from the Zipf distribution of the vocabulary."""
+        target = self.random.random() * self.cumulative[-1]
+        low, high = 0, len(self.cumulative) - 1
+        while low < high:
+            middle = (low + high) // 2
+            if self.cumulative[middle] < target:
+                low = middle + 1
+            else:
+                high = middle
+        return self.words[low]
+
+    def sentence(self, length: int) -> str:
+        """Make a sentence of `length` words, with occasional punctuation and emotes."""
+        words = []
+        for i in range(length):
+            roll = self.random.random()
+            if roll < 0.06:
+                words.append(self.random.choice(list(self.EMOTES.values())))
+            elif roll < 0.08:
+                words.append(self.random.choice(list(self.CHANNEL_EMOTES.values())))
+            else:
+                words.append(self.word())
+            if i < length - 1 and self.random.random() < 0.05:
+                words[-1] += ","
+        text = " ".join(words)
+        if self.random.random() < 0.6:
+            text += self.random.choice(self.PUNCTUATION)
+        return text
+
+    def text(self) -> str:
+        """Make the text of the next message."""
+        if self._burst:
+            return self._burst.pop()
+        roll = self.random.random()
+        if roll < 0.003:
+            # A copypasta that is repeated by 10 to 60 users
+            self._burst = [self.random.choice(self.copypastas)] * self.random.randint(10, 60)
+            return self._burst.pop()
+        if roll < 0.02:
+            return self.random.choice(self.COMMANDS) + (" " + self.sentence(self.random.randint(0, 3))).rstrip()
+        if roll < 0.04:
+            link = self.random.choice(self.LINKS).format("".join(self.random.choices(string.ascii_letters, k=10)))
+            return f"{self.sentence(self.random.randint(1, 5))} {link}"
+        if roll < 0.07:
+            emote = self.random.choice(list(self.EMOTES.values()))
+            return " ".join([emote] * self.random.randint(3, 12))
+        # Log-normal number of words, with a median of about 6 and a long tail
+        length = max(1, min(60, round(math.exp(self.random.gauss(1.8, 0.7)))))
+        return self.sentence(length)
+
+    def emote_tag(self, text: str) -> str:
+        """Get the `emotes` tag of `text`, e.g. "25:0-4,6-10/88:12-19"."""
+        positions: Dict[str, List[str]] = {}
+        ids = {name: emote_id for emote_id, name in {**self.EMOTES, **self.CHANNEL_EMOTES}.items()}
+        start = 0
+        for word in text.split(" "):
+            name = word.rstrip(",.!?")
+            if name in ids:
+                positions.setdefault(ids[name], []).append(f"{start}-{start + len(name) - 1}")
+            start += len(word) + 1
+        return "/".join(f"{emote_id}:{','.join(ranges)}" for emote_id, ranges in positions.items())
+
+    def message(self) -> ChatMessage:
+        """Generate the next message, with a Poisson arrival time."""
+        self.time += self.random.expovariate(self.rate) if not self._burst else self.random.uniform(0.01, 0.2)
+        user = self.random.choice(self.users)
+        text = self.text()
+        badges = self.user_badges[user]
+        tags = {
+            "badge-info": f"subscriber/{badges.split('/')[1].split(',')[0]}" if badges.startswith("subscriber") else "",
+            "badges": badges,
+            "color": "",
+            "display-name": user,
+            "emotes": self.emote_tag(text),
+            "first-msg": "0",
+            "flags": "",
+            "id": str(uuid.UUID(int=self.random.getrandbits(128))),
+            "mod": "1" if "moderator" in badges else "0",
+            "room-id": "100000",
+            "subscriber": "1" if "subscriber" in badges else "0",
+            "tmi-sent-ts": str(1_600_000_000_000 + int(self.time * 1000)),
+            "turbo": "0",
+            "user-id": self.user_ids[user],
+            "user-type": "mod" if "moderator" in badges else "",
+        }
+        return ChatMessage(self.time, user, text, tags)
+
+    def messages(self, count: int) -> List[ChatMessage]:
+        """Generate the next `count` messages."""
+        return [self.message() for _ in range(count)]
+
+    @staticmethod
+    def escape_tag(value: str) -> str:
+        """Escape an IRC tag value."""
+        return value.replace("\\", "\\\\").replace(";", "\\:").replace(" ", "\\s").replace("\r", "\\r").replace("\n", "\\n")
+
+    def irc_line(self, message: ChatMessage, channel: Optional[str] = None) -> str:
+        """Format `message` as the raw IRC line Twitch would send, without the trailing CRLF."""
+        tags = ";".join(f"{key}={self.escape_tag(value)}" for key, value in message.tags.items())
+        user = message.user.lower()
+        return f"@{tags} :{user}!{user}@{user}.tmi.twitch.tv PRIVMSG #{channel or self.channel} :{message.text}"
+
+    def clear_line(self, message: ChatMessage, time: float, channel: Optional[str] = None) -> str:
+        """Format the CLEARMSG line of a moderator deleting `message` at `time`."""
+        tags = {"login": message.user.lower(), "room-id": "", "target-msg-id": message.tags["id"],
+                "tmi-sent-ts": str(1_600_000_000_000 + int(time * 1000))}
+        tags = ";".join(f"{key}={self.escape_tag(value)}" for key, value in tags.items())
+        return f"@{tags} :tmi.twitch.tv CLEARMSG #{channel or self.channel} :{message.text}"
+
+    def gift_line(self, time: float, channel: Optional[str] = None) -> str:
+        """Format the USERNOTICE line of a random user gifting 1 to 50 subscriptions at `time`."""
+        user = self.random.choice(self.users)
+        count = self.random.choice([1, 1, 1, 5, 5, 10, 20, 50])
+        tags = {
+            "badge-info": "", "badges": self.user_badges[user], "color": "", "display-name": user, "emotes": "", "flags": "",
+            "id": str(uuid.UUID(int=self.random.getrandbits(128))), "login": user.lower(), "mod": "0",
+            "msg-id": "submysterygift", "msg-param-mass-gift-count": str(count), "msg-param-sender-count": str(count),
+            "msg-param-sub-plan": "1000", "room-id": "100000", "subscriber": "1",
+            "system-msg": f"{user} is gifting {count} Tier 1 Subs to {channel or self.channel}'s community!",
+            "tmi-sent-ts": str(1_600_000_000_000 + int(time * 1000)), "user-id": self.user_ids[user], "user-type": "",
+        }
+        tags = ";".join(f"{key}={self.escape_tag(value)}" for key, value in tags.items())
+        return f"@{tags} :tmi.twitch.tv USERNOTICE #{channel or self.channel}"
+
+    def lines(self, count: int, channel: Optional[str] = None) -> Iterator[Tuple[float, str]]:
+        """Generate `count` chat messages as raw IRC lines with their times, along with the events around them.
+
+        About 1 in 200 messages is deleted by a moderator 1 to 10 seconds after it was sent, with a
+        CLEARMSG, and about 1 in 1000 messages is followed by a USERNOTICE for subscription gifts.
+        """
+        # CLEARMSG lines that are still to be sent, by time
+        pending: List[Tuple[float, int, str]] = []
+        for i in range(count):
+            message = self.message()
+            while pending and pending[0][0] <= message.time:
+                time, _, line = heapq.heappop(pending)
+                yield time, line
+            yield message.time, self.irc_line(message, channel)
+            if self.random.random() < 0.005:
+                time = message.time + self.random.uniform(1, 10)
+                heapq.heappush(pending, (time, i, self.clear_line(message, time, channel)))
+            if self.random.random() < 0.001:
+                yield message.time, self.gift_line(message.time, channel)
+        while pending:
+            time, _, line = heapq.heappop(pending)
+            yield time, line
@@ -0,0 +1,68 @@
+import argparse, json, logging, sys
+from typing import Dict, List, Tuple
+
+logger = logging.getLogger(__name__)
+
+def higher_is_better(metric: str) -> bool:
+    """Whether an increase of `metric` is an improvement, i.e. for throughputs, as opposed to latencies and sizes."""
+    return metric.endswith("_per_second")
+
+def compare(base: Dict[str, float], head: Dict[str, float], threshold: float) -> Tuple[List[str], List[str]]:
+    """Compare the metrics of two benchmark runs.
+
+    Args:
+        base (Dict[str, float]): The results of the earlier run.
+        head (Dict[str, float]): The results of the later run.
+        threshold (float): The change in percent above which a metric counts as a regression or improvement.
+
+    Returns:
+        Tuple[List[str], List[str]]: A line per metric, and the names of the metrics that regressed.
+    """
+    lines = []
+    regressions = []
+    for metric in sorted(set(base) | set(head)):
+        if metric not in base or metric not in head:
+            lines.append(f"{metric:<40} {'only in ' + ('head' if metric in head else 'base'):>35}")
+            continue
+        before, after = base[metric], head[metric]
+        change = (after - before) / before * 100 if before else 0.0
+        improvement = change if higher_is_better(metric) else -change
+        verdict = ""
+        if improvement < -threshold:
+            verdict = "REGRESSION"
+            regressions.append(metric)
+        elif improvement > threshold:
+            verdict = "improvement"
+        lines.append(f"{metric:<40} {before:>14.3f} {after:>14.3f} {change:>+8.1f}%  {verdict}")
+    return lines, regressions
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the results of two runs of Benchmark.py.")
+    parser.add_argument("base", help="The results of the earlier run, e.g. of the main branch.")
+    parser.add_argument("head", help="The results of the later run.")
+    parser.add_argument("--threshold", type=float, default=10.0, help="Change in percent that is reported as a regression. Defaults to 10.")
+    args = parser.parse_args()
+
+    runs = []
+    for path in (args.base, args.head):
+        with open(path, "r") as f:
+            runs.append(json.load(f))
+    for name, run in zip(("base", "head"), runs):
+        meta = run["meta"]
+        logger.info(f"{name}: commit {meta['commit'] or 'unknown'}, Python {meta['python']}, SQLite {meta['sqlite']}, seed {meta['seed']}")
+    if runs[0]["meta"]["seed"] != runs[1]["meta"]["seed"]:
+        logger.warning("The runs used different seeds, so their results are not directly comparable.")
+
+    lines, regressions = compare(runs[0]["results"], runs[1]["results"], args.threshold)
+    print(f"{'metric':<40} {'base':>14} {'head':>14} {'change':>9}")
+    for line in lines:
+        print(line)
+    if regressions:
+        logger.warning(f"{len(regressions)} metrics regressed by more than {args.threshold:g}%: {', '.join(regressions)}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    # Compare two result files of Benchmark.py, exiting with status 1 if any metric regressed.
+    # Usage: python benchmarks/Compare.py base.json head.json [--threshold 10]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    main()
@@ -0,0 +1,102 @@
+import argparse, gzip, logging, os, random, socket, sys, time
+from typing import List
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ChatGenerator import ChatGenerator
+
+logger = logging.getLogger(__name__)
+
+class Recorder:
+    """
+    Records the raw IRC lines of one or more Twitch chats to a gzip compressed file, for `Replay.py`.
+
+    Every line of the file is the time the line was received, in seconds since the epoch,
+    followed by a space and the raw IRC line, e.g. "1700000000.123 @badges=...;id=... :user!... PRIVMSG #channel :hi".
+    Chat is read anonymously, so no account or OAuth token is needed.
+    """
+    def __init__(self, channels: List[str], path: str, host: str = "irc.chat.twitch.tv", port: int = 6667) -> None:
+        self.channels = [channel.strip().lstrip("#").lower() for channel in channels if channel.strip()]
+        self.path = path
+        self.host = host
+        self.port = port
+        self.lines = 0
+
+    def connect(self) -> socket.socket:
+        """Connect and log in anonymously, requesting the tags and commands capabilities Twitch sends the bot."""
+        conn = socket.create_connection((self.host, self.port), timeout=330)
+        nick = f"justinfan{random.randint(10000, 99999)}"
+        conn.sendall(f"CAP REQ :twitch.tv/tags twitch.tv/commands\r\nPASS SCHMOOPIIE\r\nNICK {nick}\r\n".encode("utf-8"))
+        # Twitch limits JOINs to 20 per 10 seconds
+        for i in range(0, len(self.channels), 20):
+            if i:
+                time.sleep(10)
+            conn.sendall(f"JOIN {','.join('#' + channel for channel in self.channels[i:i + 20])}\r\n".encode("utf-8"))
+        logger.info(f"Recording {', '.join('#' + channel for channel in self.channels)} to {self.path}.")
+        return conn
+
+    def record(self, seconds: float) -> None:
+        """Record for `seconds`, or until interrupted if `seconds` is 0, reconnecting when Twitch asks to."""
+        end = time.time() + seconds if seconds else float("inf")
+        with gzip.open(self.path, "at", encoding="utf-8") as f:
+            while time.time() < end:
+                conn = self.connect()
+                data = ""
+                try:
+                    while time.time() < end:
+                        chunk = conn.recv(8192)
+                        if not chunk:
+                            logger.warning("The connection was closed. Reconnecting.")
+                            break
+                        data += chunk.decode("utf-8", errors="replace")
+                        *lines, data = data.split("\r\n")
+                        received = time.time()
+                        for line in lines:
+                            if line.startswith("PING"):
+                                conn.sendall(b"PONG :tmi.twitch.tv\r\n")
+                                continue
+                            f.write(f"{received:.3f} {line}\n")
+                            self.lines += 1
+                            if " RECONNECT" in line.split(" :", 2)[0]:
+                                raise ConnectionResetError("RECONNECT")
+                except OSError as error:
+                    logger.warning(f"[OSError: {error}] - Reconnecting.")
+                finally:
+                    conn.close()
+                f.flush()
+        logger.info(f"Recorded {self.lines} lines to {self.path}.")
+
+def write_synthetic(path: str, count: int, seed: int, channel: str) -> None:
+    """Write `count` synthetic chat messages from a ChatGenerator, with their events, in the format of a recording."""
+    generator = ChatGenerator(seed, channel=channel)
+    start = time.time()
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        for offset, line in generator.lines(count):
+            f.write(f"{start + offset:.3f} {line}\n")
+    logger.info(f"Wrote {count} synthetic messages to {path}.")
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Record Twitch chat, or generate synthetic chat, for Replay.py.")
+    parser.add_argument("output", help="The gzip compressed file to append the recording to, e.g. chat.log.gz.")
+    parser.add_argument("channels", nargs="*", help="The channels to record.")
+    parser.add_argument("--seconds", type=float, default=0, help="Number of seconds to record for. Defaults to 0, i.e. until interrupted.")
+    parser.add_argument("--synthetic", type=int, default=0, help="Instead of recording, write this many synthetic messages.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic messages.")
+    args = parser.parse_args()
+
+    if args.synthetic:
+        write_synthetic(args.output, args.synthetic, args.seed, (args.channels or ["benchmark"])[0].lstrip("#").lower())
+    elif args.channels:
+        try:
+            Recorder(args.channels, args.output).record(args.seconds)
+        except KeyboardInterrupt:
+            logger.info("Stopped recording.")
+    else:
+        parser.error("Either channels to record or --synthetic is required.")
+
+if __name__ == "__main__":
+    # Record the chat of channels until interrupted, or write synthetic chat in the same format.
+    # Usage: python benchmarks/Recorder.py chat.log.gz <channel> [<channel> ...] [--seconds 3600]
+    #        python benchmarks/Recorder.py chat.log.gz --synthetic 100000 [--seed 0]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    main()
@@ -0,0 +1,403 @@
+import argparse, gzip, json, logging, os, random, re, socket, socketserver, sys, tempfile, threading, time
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from TwitchWebsocket import Message
+
+from Benchmark import FORMAT, metadata, percentiles, remove_database
+from ChatGenerator import ChatGenerator
+from MarkovChainBot import MarkovChain
+from Settings import Settings
+
+logger = logging.getLogger(__name__)
+
+# Commands that are replayed to the bot. Other recorded lines, such as JOINs, are answered by the server itself.
+REPLAYED = ("PRIVMSG", "CLEARMSG", "USERNOTICE", "CLEARCHAT", "NOTICE", "ROOMSTATE", "USERSTATE", "RECONNECT")
+ID_REGEX = re.compile(r"(?:^@|;)id=([^; ]+)")
+SENT_TS_REGEX = re.compile(r"(?<=tmi-sent-ts=)\d+")
+
+def split_line(line: str) -> Tuple[str, str, str]:
+    """Split a raw IRC line into its command, channel without "#" (or ""), and the line without its tags."""
+    rest = line.split(" ", 1)[1] if line.startswith("@") else line
+    parts = rest.split(" ", 3)
+    if parts[0].startswith(":"):
+        parts = parts[1:]
+    command = parts[0] if parts else ""
+    channel = parts[1][1:].lower() if len(parts) > 1 and parts[1].startswith("#") else ""
+    return command, channel, rest
+
+def read_recording(paths: List[str]) -> Iterator[Tuple[float, str]]:
+    """Read the lines of recordings made by `Recorder.py`, with the times they were received."""
+    for path in paths:
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            for line in f:
+                received, _, raw = line.rstrip("\r\n").partition(" ")
+                if raw:
+                    yield float(received), raw
+
+def rss_bytes() -> int:
+    """Get the resident set size of this process, or its peak if the current size is not available."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+class LagStats:
+    """The number, mean and maximum of lags, and a uniform sample of them for percentiles, in bounded memory."""
+    SAMPLES = 10_000
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.sample: List[float] = []
+        self._random = random.Random(0)
+
+    def add(self, seconds: float) -> None:
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        # Reservoir sampling, so every lag has the same chance of being in the sample
+        if len(self.sample) < self.SAMPLES:
+            self.sample.append(seconds)
+        else:
+            index = self._random.randrange(self.count)
+            if index < self.SAMPLES:
+                self.sample[index] = seconds
+
+    def summary(self, prefix: str) -> Dict[str, float]:
+        if not self.sample:
+            return {}
+        results = {f"{prefix}.{key}": value for key, value in percentiles(self.sample).items()}
+        results[f"{prefix}.mean_ms"] = self.total / self.count * 1000
+        results[f"{prefix}.max_ms"] = self.max * 1000
+        return results
+
+class FakeTwitchServer(socketserver.ThreadingTCPServer):
+    """
+    A local IRC server that behaves like Twitch chat towards `TwitchWebsocket`, and replays chat lines to it.
+
+    Logins, capability requests, JOINs and PINGs are answered like Twitch does. Lines are only sent
+    to the most recently logged in connection, for the channels it has joined, so lines sent while
+    the bot reconnects are lost, as they would be on Twitch.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, channels: Dict[str, str]) -> None:
+        """Start listening on a free local port.
+
+        Args:
+            channels (Dict[str, str]): The channel name in the replayed lines, mapped to the channel the bot joins.
+        """
+        super().__init__(("127.0.0.1", 0), FakeTwitchHandler)
+        self.port = self.server_address[1]
+        self.channels = channels
+        self.client: Optional["FakeTwitchHandler"] = None
+        # Set once the bot joined all channels
+        self.ready = threading.Event()
+        # Scheduled send time of every PRIVMSG by its id, until the bot receives it
+        self.in_flight: Dict[str, float] = {}
+        self.scheduled = 0
+        self.skipped = 0
+        self.reconnects = 0
+        self.logins = 0
+        self.bot_messages = 0
+        self.lock = threading.Lock()
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def login(self, client: "FakeTwitchHandler") -> None:
+        """Make `client` the connection lines are sent to, closing the previous one, as Twitch does after a RECONNECT."""
+        with self.lock:
+            previous, self.client = self.client, client
+            self.logins += 1
+        if previous is not None:
+            previous.close()
+
+    def send(self, line: str) -> bool:
+        """Send `line` to the current connection, if it joined the channel of the line. Returns whether it was sent."""
+        client = self.client
+        _, channel, _ = split_line(line)
+        if client is None or (channel and channel not in client.joined):
+            return False
+        return client.send(line)
+
+    def replay(self, lines: Iterator[Tuple[float, str]], speed: float, reconnect_every: float = 0) -> None:
+        """Send `lines` at `speed` times the speed at which they were recorded, or as fast as possible if `speed` is 0.
+
+        Args:
+            lines (Iterator[Tuple[float, str]]): The lines with the times they were received at.
+            speed (float): The speed multiplier.
+            reconnect_every (float, optional): Send a RECONNECT every this many seconds. Defaults to 0, i.e. never.
+        """
+        self.ready.wait()
+        channel_regex = re.compile(r"(?<= #)(" + "|".join(map(re.escape, self.channels)) + r")\b", re.IGNORECASE)
+        start = time.perf_counter()
+        first = None
+        next_reconnect = start + reconnect_every if reconnect_every else float("inf")
+        for received, line in lines:
+            command, channel, _ = split_line(line)
+            if command not in REPLAYED or (channel and channel not in self.channels):
+                continue
+            if first is None:
+                first = received
+            due = start + (received - first) / speed if speed else time.perf_counter()
+            delay = due - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            if channel:
+                line = channel_regex.sub(lambda match: self.channels[match.group(1).lower()], line, count=1)
+            line = SENT_TS_REGEX.sub(str(int(time.time() * 1000)), line, count=1)
+            if command == "PRIVMSG":
+                match = ID_REGEX.search(line)
+                if match:
+                    self.scheduled += 1
+                    self.in_flight[match.group(1)] = due
+            if not self.send(line):
+                self.skipped += 1
+            if time.perf_counter() >= next_reconnect:
+                next_reconnect += reconnect_every
+                self.reconnects += 1
+                self.send(":tmi.twitch.tv RECONNECT")
+
+    def close(self) -> None:
+        """Close the connection to the bot and stop listening."""
+        if self.client is not None:
+            self.client.close()
+        self.shutdown()
+        self.server_close()
+
+class FakeTwitchHandler(socketserver.StreamRequestHandler):
+    """A connection from the bot to the FakeTwitchServer."""
+    server: FakeTwitchServer
+
+    def setup(self) -> None:
+        super().setup()
+        self.nick = ""
+        self.joined: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def send(self, line: str) -> bool:
+        try:
+            with self._lock:
+                self.wfile.write((line + "\r\n").encode("utf-8"))
+                self.wfile.flush()
+            return True
+        except (OSError, ValueError):
+            return False
+
+    def close(self) -> None:
+        try:
+            self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def handle(self) -> None:
+        for raw in self.rfile:
+            line = raw.decode("utf-8", errors="replace").rstrip("\r\n")
+            command, _, argument = line.partition(" ")
+            if command == "NICK":
+                self.nick = argument.strip().lower()
+                self.server.login(self)
+                for reply in ("001 {nick} :Welcome, GLHF!", "002 {nick} :Your host is tmi.twitch.tv", "376 {nick} :>"):
+                    self.send(":tmi.twitch.tv " + reply.format(nick=self.nick))
+            elif command == "CAP":
+                self.send(f":tmi.twitch.tv CAP * ACK {argument.partition(' ')[2]}")
+            elif command == "JOIN":
+                for channel in argument.strip().lower().split(","):
+                    channel = channel.strip().lstrip("#")
+                    self.joined.add(channel)
+                    self.send(f":{self.nick}!{self.nick}@{self.nick}.tmi.twitch.tv JOIN #{channel}")
+                    self.send(f":{self.nick}.tmi.twitch.tv 353 {self.nick} = #{channel} :{self.nick}")
+                    self.send(f":{self.nick}.tmi.twitch.tv 366 {self.nick} #{channel} :End of /NAMES list")
+                if self.joined >= set(self.server.channels.values()):
+                    self.server.ready.set()
+            elif command == "PING":
+                self.send(":tmi.twitch.tv PONG tmi.twitch.tv")
+            elif command == "PRIVMSG":
+                self.server.bot_messages += 1
+
+class ReplayedMarkovChain(MarkovChain):
+    """A MarkovChain that reports when it receives and learns the messages replayed by a Replay."""
+    def __init__(self, replay: "Replay") -> None:
+        self.replay = replay
+        self._learned = False
+        replay.bot = self
+        super().__init__()
+
+    def message_handler(self, m: Message) -> None:
+        self._learned = False
+        scheduled = self.replay.server.in_flight.pop(m.tags.get("id", ""), None) if m.type == "PRIVMSG" else None
+        if scheduled is not None:
+            self.replay.receive_lag.add(time.perf_counter() - scheduled)
+        super().message_handler(m)
+        if scheduled is not None:
+            self.replay.received += 1
+            if self._learned:
+                self.replay.learn_lag.add(time.perf_counter() - scheduled)
+
+    def learn_message(self, state, message: str, weight: int = 1) -> None:
+        super().learn_message(state, message, weight)
+        self._learned = True
+
+class Replay:
+    """
+    Replays recorded or synthetic chat to a complete MarkovChain bot through a FakeTwitchServer, and measures:
+
+    - the lag from the time a message was due to be sent until the bot received it, and until it was learned,
+      i.e. tokenized and queued for writing, or handed to the learning worker,
+    - the messages that were sent but never received, e.g. while the bot reconnected,
+    - the growth of the resident memory of the process while replaying.
+
+    The bot uses the settings file `Settings.PATH` points to, written by `run`, and joins the replayed
+    channels prefixed with "replay_", so the databases of real channels are never touched.
+    """
+    def __init__(self, lines: Iterator[Tuple[float, str]], channels: List[str], speed: float,
+                 reconnect_every: float = 0, settings: Optional[dict] = None) -> None:
+        self.lines = lines
+        self.channels = {channel: f"replay_{channel}" for channel in channels}
+        self.speed = speed
+        self.reconnect_every = reconnect_every
+        self.settings = settings or {}
+        self.server = FakeTwitchServer(self.channels)
+        self.bot: Optional[ReplayedMarkovChain] = None
+        self.received = 0
+        self.receive_lag = LagStats()
+        self.learn_lag = LagStats()
+        self.rss: List[int] = []
+
+    def write_settings(self, directory: str) -> None:
+        settings = dict(Settings.DEFAULTS, **self.settings)
+        settings.update({"Host": "127.0.0.1", "Port": self.server.port, "Channel": list(self.channels.values()),
+                         "Nickname": "justinfan12345", "Authentication": "oauth:replay", "MetricsPort": 0})
+        Settings.PATH = os.path.join(directory, "settings.json")
+        with open(Settings.PATH, "w") as f:
+            json.dump(settings, f, indent=4)
+
+    def sample_memory(self, stop: threading.Event) -> None:
+        while not stop.wait(1):
+            self.rss.append(rss_bytes())
+
+    def run(self, drain: float = 10) -> Dict[str, float]:
+        """Replay all lines, wait up to `drain` seconds for the bot to catch up, and stop the bot.
+
+        Returns:
+            Dict[str, float]: The measured metrics.
+        """
+        with tempfile.TemporaryDirectory() as directory:
+            self.write_settings(directory)
+            bot_thread = threading.Thread(target=ReplayedMarkovChain, args=(self,), name="ReplayedMarkovChain", daemon=True)
+            bot_thread.start()
+            if not self.server.ready.wait(120):
+                raise RuntimeError("The bot did not join all channels within 2 minutes.")
+            stop = threading.Event()
+            self.rss.append(rss_bytes())
+            threading.Thread(target=self.sample_memory, args=(stop,), daemon=True).start()
+
+            start = time.perf_counter()
+            self.server.replay(self.lines, self.speed, self.reconnect_every)
+            replayed = time.perf_counter() - start
+            logger.info(f"Sent {self.server.scheduled} messages in {replayed:.1f} seconds. Waiting for the bot to catch up.")
+            # Wait for the messages that are still in the socket buffers, until no more arrive
+            received, idle = self.received, time.perf_counter()
+            while self.server.in_flight and time.perf_counter() - idle < drain:
+                time.sleep(0.1)
+                if self.received != received:
+                    received, idle = self.received, time.perf_counter()
+            elapsed = time.perf_counter() - start
+            stop.set()
+            self.rss.append(rss_bytes())
+
+            shutdown = time.perf_counter()
+            self.bot.ws.stop()
+            self.server.close()
+            bot_thread.join(120)
+            shutdown = time.perf_counter() - shutdown
+
+        dropped = self.server.scheduled - self.received
+        results = {"replay.messages_per_second": self.received / elapsed if elapsed else 0.0,
+                   "replay.dropped_fraction": dropped / self.server.scheduled if self.server.scheduled else 0.0,
+                   "replay.rss_growth_bytes": self.rss[-1] - self.rss[0],
+                   "replay.rss_peak_bytes": max(self.rss),
+                   "replay.shutdown_seconds": shutdown}
+        results.update(self.receive_lag.summary("replay.receive_lag"))
+        results.update(self.learn_lag.summary("replay.learn_lag"))
+        logger.info(f"Received {self.received} of {self.server.scheduled} messages, of which {self.learn_lag.count} were learned. "
+                    f"{dropped} were dropped, {self.server.skipped} lines were sent while the bot was not connected or joined. "
+                    f"{self.server.reconnects} RECONNECTs, {self.server.logins} logins, {self.server.bot_messages} messages sent by the bot.")
+        return results
+
+    def counts(self) -> Dict[str, int]:
+        return {"scheduled": self.server.scheduled, "received": self.received, "learned": self.learn_lag.count,
+                "skipped": self.server.skipped, "reconnects": self.server.reconnects, "logins": self.server.logins,
+                "bot_messages": self.server.bot_messages}
+
+def recorded_channels(paths: List[str]) -> List[str]:
+    """Get the channels of the PRIVMSGs in recordings, in order of appearance."""
+    channels: Dict[str, None] = {}
+    for _, line in read_recording(paths):
+        command, channel, _ = split_line(line)
+        if command == "PRIVMSG" and channel:
+            channels[channel] = None
+    return list(channels)
+
+def parse_setting(setting: str) -> Tuple[str, object]:
+    """Parse a setting override such as "KeyLength=3" or "LearningWorker=true", with JSON values where possible."""
+    key, _, value = setting.partition("=")
+    if key not in Settings.DEFAULTS:
+        raise argparse.ArgumentTypeError(f"Unknown setting {key!r}.")
+    try:
+        return key, json.loads(value)
+    except ValueError:
+        return key, value
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay chat to the bot through a local fake Twitch server, and measure lag, drops and memory.")
+    parser.add_argument("recordings", nargs="*", help="Recordings made by Recorder.py. Without recordings, synthetic chat is replayed.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speed multiplier of the replay, or 0 for as fast as possible. Defaults to 1.")
+    parser.add_argument("--synthetic", type=int, default=20000, help="Number of synthetic messages to replay without recordings.")
+    parser.add_argument("--rate", type=float, default=20.0, help="Messages per second of the synthetic chat, before the speed multiplier.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic chat.")
+    parser.add_argument("--reconnect-every", type=float, default=0, help="Send a RECONNECT every this many seconds.")
+    parser.add_argument("--drain", type=float, default=10, help="Seconds to wait without progress for the bot to catch up at the end.")
+    parser.add_argument("--set", dest="settings", type=parse_setting, action="append", default=[],
+                        help="Override a setting of the bot, e.g. --set KeyLength=3 --set LearningWorker=true.")
+    parser.add_argument("--keep", action="store_true", help="Keep the databases of the replay_ channels.")
+    parser.add_argument("--output", default="", help="File to write the results to as JSON, comparable with Compare.py.")
+    args = parser.parse_args()
+
+    if args.recordings:
+        channels = recorded_channels(args.recordings)
+        lines = read_recording(args.recordings)
+    else:
+        generator = ChatGenerator(args.seed, rate=args.rate)
+        channels = [generator.channel]
+        lines = generator.lines(args.synthetic)
+    if not channels:
+        parser.error("The recordings contain no chat messages.")
+    for channel in channels:
+        remove_database(f"replay_{channel}")
+
+    replay = Replay(lines, channels, args.speed, args.reconnect_every, dict(args.settings))
+    results = replay.run(args.drain)
+    if not args.keep:
+        for channel in channels:
+            remove_database(f"replay_{channel}")
+
+    for name, value in sorted(results.items()):
+        print(f"{name:<40} {value:>16.3f}")
+    if args.output:
+        meta = metadata(seed=args.seed, recordings=args.recordings, speed=args.speed, settings=dict(args.settings), **replay.counts())
+        with open(args.output, "w") as f:
+            json.dump({"format": FORMAT, "meta": meta, "results": results}, f, indent=2, sort_keys=True)
+        logger.info(f"Wrote the results to {args.output}.")
+
+if __name__ == "__main__":
+    # Replay recorded or synthetic chat to the bot at a multiple of its original speed, entirely offline.
+    # Usage: python benchmarks/Replay.py [chat.log.gz ...] [--speed 10] [--reconnect-every 60] [--set KeyLength=3]
+    logging.basicConfig(level=logging.INFO, format="[%(asctime)s] [%(name)s] [%(levelname)-8s] - %(message)s")
+    main()